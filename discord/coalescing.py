@@ -0,0 +1,51 @@
+from typing import Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+
+INFLIGHT_KEY = "refresh:inflight:{}:{}"
+# on-demand refreshes only coalesce into pending on-demand ones: a user waiting in a bulk job would otherwise be
+# refreshed behind the whole bulk queue
+PRIORITY_LANE = "priority"
+BULK_LANE = "bulk"
+PAYLOAD_CACHE_KEY = "osu_user:{}"
+
+
+def claim_users(osu_user_ids: Iterable[int], connection=None, lane: str = BULK_LANE) -> list[int]:
+    """
+    Mark users as having a refresh pending in `lane`, in one pipelined round trip. Users that already have one in the
+    same lane are left out so the caller can skip them, their pending refresh covers it.
+    :return: the osu! user ids claimed by the caller, to `release_users` once they are refreshed
+    """
+    osu_user_ids = list(osu_user_ids)
+    if not osu_user_ids:
+        return []
+    pipeline = (connection or get_redis_connection("default")).pipeline()
+    for osu_user_id in osu_user_ids:
+        pipeline.set(INFLIGHT_KEY.format(lane, osu_user_id), 1, nx=True, ex=settings.REFRESH_INFLIGHT_TTL)
+    return [osu_user_id for osu_user_id, claimed in zip(osu_user_ids, pipeline.execute()) if claimed]
+
+
+def release_users(osu_user_ids: Iterable[int], connection=None, lane: str = BULK_LANE):
+    if keys := [INFLIGHT_KEY.format(lane, osu_user_id) for osu_user_id in osu_user_ids]:
+        (connection or get_redis_connection("default")).delete(*keys)
+
+
+def get_cached_users(osu_user_ids: Iterable[int]) -> dict[int, dict]:
+    """
+    `GET /users/{id}/osu` payloads fetched within the last OSU_USER_CACHE_TTL seconds.
+    :return: dict of osu! user id -> payload, for the users that are cached
+    """
+    keys = {PAYLOAD_CACHE_KEY.format(osu_user_id): osu_user_id for osu_user_id in osu_user_ids}
+    return {keys[key]: osu_data for key, osu_data in cache.get_many(keys).items()}
+
+
+def cache_users(osu_users: dict[int, dict]):
+    """
+    :param osu_users: dict of osu! user id -> `GET /users/{id}/osu` payload
+    """
+    if osu_users:
+        cache.set_many({PAYLOAD_CACHE_KEY.format(osu_user_id): osu_data for osu_user_id, osu_data in osu_users.items()},
+                       timeout=settings.OSU_USER_CACHE_TTL)
@@ -0,0 +1,109 @@
+import time
+import uuid
+
+from django.utils.functional import cached_property
+from django_redis import get_redis_connection
+
+
+JOB_KEY_PREFIX = "refresh_job"
+ACTIVE_JOB_KEY = f"{JOB_KEY_PREFIX}:active"
+JOB_TTL = 60 * 60 * 24  # seconds, refreshed on every update
+# seconds without progress after which an unfinished job no longer blocks new ones, e.g. if its tasks died
+JOB_STALE_AFTER = 10 * 60
+OUTCOMES = ('done', 'failed', 'skipped')
+
+
+class RefreshJob:
+    """
+    Progress of a bulk refresh, kept in a Redis hash so every worker can report to it.
+
+    Users are counted as `queued` when their tasks are enqueued, then as one of `done`, `failed` (osu! API error) or
+    `skipped` (not a player, or missing from the osu! API response) once processed. Each update is a single pipelined
+    round trip and reading the status is one HGETALL.
+    """
+
+    def __init__(self, job_id: str, connection=None):
+        self.id = job_id
+        if connection is not None:
+            self.connection = connection
+
+    @cached_property
+    def connection(self):
+        return get_redis_connection("default")
+
+    @property
+    def key(self):
+        return f"{JOB_KEY_PREFIX}:{self.id}"
+
+    @classmethod
+    def create(cls, connection=None) -> 'RefreshJob':
+        """
+        Start a new job and make it the active one.
+        """
+        job = cls(uuid.uuid4().hex, connection)
+        pipeline = job.connection.pipeline()
+        pipeline.hset(job.key, mapping={'queued': 0, **{outcome: 0 for outcome in OUTCOMES}, 'created': time.time()})
+        pipeline.expire(job.key, JOB_TTL)
+        pipeline.set(ACTIVE_JOB_KEY, job.id, ex=JOB_TTL)
+        pipeline.execute()
+        return job
+
+    @classmethod
+    def get_active(cls, connection=None) -> 'RefreshJob | None':
+        """
+        The most recently created job, if it still has users left to process and made progress recently.
+        """
+        job = cls(None, connection)
+        if (job_id := job.connection.get(ACTIVE_JOB_KEY)) is None:
+            return None
+        job.id = job_id.decode()
+        status = job.status()
+        return job if status is not None and not status['finished'] and not status['stale'] else None
+
+    def enqueue(self, count: int):
+        pipeline = self.connection.pipeline()
+        pipeline.hincrby(self.key, 'queued', count)
+        pipeline.hsetnx(self.key, 'enqueued', time.time())
+        pipeline.expire(self.key, JOB_TTL)
+        pipeline.execute()
+
+    def record(self, done: int = 0, failed: int = 0, skipped: int = 0):
+        """
+        Count processed users. The first call sets the `started` time, every call moves `updated`.
+        """
+        now = time.time()
+        pipeline = self.connection.pipeline()
+        for outcome, count in zip(OUTCOMES, (done, failed, skipped)):
+            if count:
+                pipeline.hincrby(self.key, outcome, count)
+        pipeline.hsetnx(self.key, 'started', now)
+        pipeline.hset(self.key, 'updated', now)
+        pipeline.expire(self.key, JOB_TTL)
+        pipeline.execute()
+
+    def status(self) -> dict | None:
+        """
+        :return: counters and timing of the job, None if it doesn't exist (or expired)
+        """
+        fields = {key.decode(): value for key, value in self.connection.hgetall(self.key).items()}
+        if not fields:
+            return None
+        counters = {counter: int(fields[counter]) for counter in ('queued', *OUTCOMES)}
+        processed = sum(counters[outcome] for outcome in OUTCOMES)
+        created, enqueued, started, updated = (float(fields[field]) if field in fields else None
+                                               for field in ('created', 'enqueued', 'started', 'updated'))
+        elapsed = (updated or created) - created
+        finished = enqueued is not None and processed >= counters['queued']
+        last_activity = max(timestamp for timestamp in (created, enqueued, updated) if timestamp is not None)
+        return {
+            'id': self.id,
+            **counters,
+            'remaining': counters['queued'] - processed,
+            'finished': finished,
+            'stale': not finished and time.time() - last_activity > JOB_STALE_AFTER,
+            'created': created,
+            'started': started,
+            'updated': updated,
+            'elapsed': elapsed,
+            'users_per_second': processed / elapsed if elapsed else None,
+        }
@@ -0,0 +1,52 @@
+import email.utils
+import time
+
+from django.conf import settings
+
+from fivedigitworldcup.circuitbreaker import osu_api_breaker
+from fivedigitworldcup.ratelimit import osu_api_limiter
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_retry_after(headers) -> float | None:
+    """
+    Seconds to wait according to a `Retry-After` header, given either in seconds or as an HTTP date.
+    """
+    if (retry_after := headers.get('Retry-After')) is None:
+        return None
+    try:
+        return max(float(retry_after), 0.)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_failure(retry_after: float = None) -> float:
+    """
+    Back the shared limiter off after a failed osu! API request: for `retry_after` seconds if the API said so,
+    otherwise exponentially in the number of consecutive failures.
+    :return: seconds to wait before retrying, at least the circuit breaker cooldown if this opened it
+    """
+    failures = osu_api_breaker.record_failure()
+    if retry_after is None:
+        retry_after = min(settings.OSU_API_BACKOFF_BASE * 2 ** (failures - 1), settings.OSU_API_BACKOFF_MAX)
+    osu_api_limiter.backoff(retry_after)
+    if failures >= osu_api_breaker.threshold:
+        return max(retry_after, osu_api_breaker.cooldown)
+    return retry_after
+
+
+def record_response(status_code: int, headers) -> float | None:
+    """
+    Feed the outcome of an osu! API request to the shared limiter and circuit breaker.
+    :return: seconds to wait before retrying, None if the request succeeded or retrying won't help (e.g. 404)
+    """
+    if status_code in RETRYABLE_STATUS_CODES:
+        return record_failure(get_retry_after(headers))
+    osu_api_breaker.record_success()
+    return None
@@ -0,0 +1,235 @@
+import asyncio
+import collections
+import datetime
+import logging
+import statistics
+import time
+
+import httpx
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from discord.coalescing import cache_users, claim_users, get_cached_users, release_users
+from discord.osu_api import record_failure, record_response
+from discord.scheduling import mark_fetched
+from fivedigitworldcup.circuitbreaker import osu_api_breaker
+from fivedigitworldcup.http import AsyncApiClient
+from fivedigitworldcup.ratelimit import TokenBucket, osu_api_limiter
+from userauth.authentication import bws, filter_badges, prep_badges_for_db, sync_badges, upsert_badges
+from userauth.models import TournamentPlayer
+
+
+logger = logging.getLogger(__name__)
+PLAYER_STATS_FIELDS = ['osu_rank_std', 'osu_rank_std_bws', 'osu_username', 'osu_stats_updated']
+
+
+def set_player_stats(tourney_player: TournamentPlayer, osu_rank_std: int | None, badge_count: int,
+                     osu_username: str) -> bool:
+    """
+    Set fresh osu! stats on `tourney_player`, without saving it.
+    :return: whether anything changed, `osu_stats_updated` is only bumped if so
+    """
+    player_stats = {'osu_rank_std': osu_rank_std,
+                    'osu_rank_std_bws': bws(badge_count, osu_rank_std) if osu_rank_std is not None else None,
+                    'osu_username': osu_username}
+    if all(getattr(tourney_player, field) == value for field, value in player_stats.items()):
+        return False
+    for field, value in player_stats.items():
+        setattr(tourney_player, field, value)
+    tourney_player.osu_stats_updated = datetime.datetime.now(tz=datetime.timezone.utc)
+    return True
+
+
+def write_user_stats(fetched: list[tuple[TournamentPlayer, dict]]) -> tuple[int, int, int]:
+    """
+    Write back `GET /users/{id}/osu` payloads of many players: one catalog upsert, one badge sync and one
+    `bulk_update`, in a single transaction.
+    :param fetched: (player, osu! API user) pairs
+    :return: number of players changed, badges added, badges removed
+    """
+    catalog = upsert_badges([badge for _, osu_data in fetched for badge in osu_data['badges']])
+    changed_players = []
+    player_badges = {}
+    for tourney_player, osu_data in fetched:
+        eligible_badges, player_badges[tourney_player] = prep_badges_for_db(osu_data, tourney_player, catalog)
+        if set_player_stats(tourney_player,
+                            osu_data['statistics'].get('global_rank', None),
+                            len(filter_badges(eligible_badges, filter_phrases=())),  # already filtered by phrase
+                            osu_data['username']):
+            changed_players.append(tourney_player)
+
+    with transaction.atomic():
+        added, removed = sync_badges(player_badges)
+        TournamentPlayer.objects.bulk_update(changed_players, fields=PLAYER_STATS_FIELDS)
+    mark_fetched(tourney_player.osu_user_id for tourney_player, _ in fetched)
+    return len(changed_players), added, removed
+
+
+class RefreshStats:
+    """
+    Counters and request latencies of a refresh run.
+    """
+
+    def __init__(self):
+        self.fetched = 0
+        self.cached = 0  # payloads reused from the cache instead of fetched
+        self.coalesced = 0  # players left to a refresh that was already pending
+        self.failed = 0
+        self.deferred = 0  # players left unfetched while the osu! API is unavailable
+        self.changed = 0
+        self.badges_added = 0
+        self.badges_removed = 0
+        self.latencies = []  # seconds per osu! API request, including the wait for a connection
+        self.write_time = 0.
+        self.elapsed = 0.
+
+    @property
+    def throughput(self) -> float:
+        return self.fetched / self.elapsed if self.elapsed else 0.
+
+    def latency_percentile(self, percentile: int) -> float:
+        if len(self.latencies) < 2:
+            return self.latencies[0] if self.latencies else 0.
+        return statistics.quantiles(self.latencies, n=100, method='inclusive')[percentile - 1]
+
+    def __str__(self):
+        return (f"{self.fetched} fetched, {self.cached} cached, {self.coalesced} coalesced, "
+                f"{self.failed} failed, {self.deferred} deferred, {self.changed} changed "
+                f"(+{self.badges_added}/-{self.badges_removed} badges) in {self.elapsed:.2f}s, "
+                f"{self.throughput:.1f} users/s, "
+                f"latency p50 {self.latency_percentile(50) * 1000:.0f}ms, "
+                f"p95 {self.latency_percentile(95) * 1000:.0f}ms, "
+                f"max {max(self.latencies, default=0) * 1000:.0f}ms, "
+                f"{self.write_time:.2f}s writing")
+
+
+class AsyncRefresher:
+    """
+    Refreshes players concurrently: `concurrency` fetchers share a pooled HTTP client and the osu! API rate limit,
+    parse the payloads as they arrive and hand them to a single writer, which saves them `batch_size` at a time
+    while the fetchers keep going.
+    """
+    def __init__(self, token: str, concurrency: int = 8, batch_size: int = 50, base_url: str = None,
+                 limiter: TokenBucket = None):
+        self.token = token
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_url = base_url or settings.OSU_API_ENDPOINT
+        self.limiter = limiter or osu_api_limiter
+        self.stats = RefreshStats()
+        self.cached_users = {}
+        self.retries = collections.Counter()  # osu! user id -> retries after a 429/5xx
+        self.paused = False  # set once the circuit breaker opens
+
+    def refresh(self, players: list[TournamentPlayer]) -> RefreshStats:
+        """
+        Refresh `players` from a synchronous caller. Database writes run in the calling thread.
+
+        Players with a refresh already pending are left to it, the others are claimed until this one is done.
+        """
+        claimed = set(claim_users(tourney_player.osu_user_id for tourney_player in players))
+        self.stats.coalesced += len(players) - len(claimed)
+        self.cached_users = get_cached_users(claimed)
+        try:
+            return async_to_sync(self.arefresh)([p for p in players if p.osu_user_id in claimed])
+        finally:
+            release_users(claimed)
+
+    async def arefresh(self, players: list[TournamentPlayer]) -> RefreshStats:
+        start_time = time.perf_counter()
+        pending = asyncio.Queue()
+        for tourney_player in players:
+            pending.put_nowait(tourney_player)
+        fetched = asyncio.Queue(maxsize=self.batch_size * 2)  # backpressure if writes fall behind
+
+        # a client of its own, closed once done: synchronous callers run every refresh in a new event loop
+        async with AsyncApiClient(pool_maxsize=self.concurrency) as client:
+            fetching = asyncio.gather(*[self.fetch(client, pending, fetched) for _ in range(self.concurrency)])
+            writer = asyncio.create_task(self.write(fetched))
+            try:
+                await asyncio.wait([fetching, writer], return_when=asyncio.FIRST_COMPLETED)
+                if writer.done():  # the writer only stops early if a write failed
+                    fetching.cancel()
+                    await writer
+                await fetching
+                await fetched.put(None)
+                await writer
+            finally:
+                fetching.cancel()
+                writer.cancel()
+            logger.info(f"[refresh] HTTP timings {client.get_timings()}")
+
+        if deferred := [pending.get_nowait().osu_user_id for _ in range(pending.qsize())]:
+            # the circuit breaker opened, the staleness scheduler picks these up again once it closes
+            self.stats.deferred = len(deferred)
+            await asyncio.to_thread(osu_api_breaker.defer, deferred)
+            logger.warning(f"[refresh] osu! API unavailable, {len(deferred)} players deferred")
+        self.stats.elapsed = time.perf_counter() - start_time
+        return self.stats
+
+    async def fetch(self, client: httpx.AsyncClient, pending: asyncio.Queue, fetched: asyncio.Queue):
+        while not pending.empty() and not self.paused:
+            tourney_player = pending.get_nowait()
+            if (osu_data := self.cached_users.get(tourney_player.osu_user_id)) is not None:
+                self.stats.cached += 1
+                await fetched.put((tourney_player, osu_data))
+                continue
+            await self.limiter.async_acquire()
+            request_time = time.perf_counter()
+            try:
+                response = await client.get(f"{self.base_url}/users/{tourney_player.osu_user_id}/osu",
+                                            headers={"Authorization": f"Bearer {self.token}"})
+            except httpx.HTTPError as e:
+                logger.warning(f"[refresh] failed to fetch {tourney_player.osu_user_id}: {e}")
+                response = None
+            finally:
+                self.stats.latencies.append(time.perf_counter() - request_time)
+
+            if response is None:
+                retry_in = await asyncio.to_thread(record_failure)
+            else:
+                retry_in = await asyncio.to_thread(record_response, response.status_code, response.headers)
+            if retry_in is not None and self.retries[tourney_player.osu_user_id] < settings.OSU_API_MAX_RETRIES:
+                # retried once the limiter lets requests through again, unless the circuit breaker opened
+                self.retries[tourney_player.osu_user_id] += 1
+                pending.put_nowait(tourney_player)
+                if await asyncio.to_thread(osu_api_breaker.retry_in):
+                    self.paused = True
+                continue
+            if response is None:
+                self.stats.failed += 1
+                continue
+            try:
+                response.raise_for_status()
+                osu_data = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                self.stats.failed += 1
+                logger.warning(f"[refresh] failed to fetch {tourney_player.osu_user_id}: {e}")
+                continue
+            self.stats.fetched += 1
+            await fetched.put((tourney_player, osu_data))
+
+    async def write(self, fetched: asyncio.Queue):
+        batch = []
+        while (item := await fetched.get()) is not None:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                await self.write_batch(batch)
+                batch = []
+        if batch:
+            await self.write_batch(batch)
+
+    async def write_batch(self, batch: list[tuple[TournamentPlayer, dict]]):
+        write_start = time.perf_counter()
+        changed, added, removed = await sync_to_async(self.save)(batch)
+        self.stats.write_time += time.perf_counter() - write_start
+        self.stats.changed += changed
+        self.stats.badges_added += added
+        self.stats.badges_removed += removed
+
+    def save(self, batch: list[tuple[TournamentPlayer, dict]]) -> tuple[int, int, int]:
+        changed, added, removed = write_user_stats(batch)
+        cache_users({tourney_player.osu_user_id: osu_data for tourney_player, osu_data in batch
+                     if tourney_player.osu_user_id not in self.cached_users})
+        return changed, added, removed
@@ -0,0 +1,61 @@
+import time
+from typing import Iterable
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from userauth.models import TournamentPlayer
+
+
+# sorted sets of osu! user id -> unix time, `osu_stats_updated` only moves when stats change so it can't tell when a
+# player was last fetched
+FETCHED_LEDGER_KEY = "refresh:last_fetched"
+SCHEDULED_LEDGER_KEY = "refresh:last_scheduled"
+
+
+def mark_fetched(osu_user_ids: Iterable[int], connection=None):
+    if mapping := {osu_user_id: time.time() for osu_user_id in osu_user_ids}:
+        (connection or get_redis_connection("default")).zadd(FETCHED_LEDGER_KEY, mapping)
+
+
+def mark_scheduled(osu_user_ids: Iterable[int], connection=None):
+    if mapping := {osu_user_id: time.time() for osu_user_id in osu_user_ids}:
+        (connection or get_redis_connection("default")).zadd(SCHEDULED_LEDGER_KEY, mapping)
+
+
+def get_max_age(in_roster: bool, is_captain: bool) -> float:
+    """
+    Seconds after which a player should be refreshed. Rostered players and captains matter most for seeding, so they
+    are kept fresher.
+    """
+    if in_roster or is_captain:
+        return settings.REFRESH_MAX_AGE_ROSTER
+    return settings.REFRESH_MAX_AGE
+
+
+def get_stale_players(limit: int = None, now: float = None, connection=None) -> list[int]:
+    """
+    Players that haven't been fetched within their max age (and weren't scheduled in the last scheduling interval),
+    most overdue first: staleness is the time since the last fetch relative to the player's max age.
+    :param limit: return at most this many players
+    :return: osu! user ids
+    """
+    connection = connection or get_redis_connection("default")
+    now = now or time.time()
+    pipeline = connection.pipeline()
+    pipeline.zrange(FETCHED_LEDGER_KEY, 0, -1, withscores=True)
+    pipeline.zrange(SCHEDULED_LEDGER_KEY, 0, -1, withscores=True)
+    fetched, scheduled = ({int(osu_user_id): score for osu_user_id, score in ledger} for ledger in pipeline.execute())
+
+    stale_players = []
+    players = TournamentPlayer.objects.values_list('osu_user_id', 'osu_stats_updated', 'in_roster', 'is_captain')
+    for osu_user_id, stats_updated, in_roster, is_captain in players.iterator():
+        if now - scheduled.get(osu_user_id, 0) < settings.REFRESH_SCHEDULE_INTERVAL:
+            continue
+        age = now - max(fetched.get(osu_user_id, 0), stats_updated.timestamp())
+        staleness = age / get_max_age(in_roster, is_captain)
+        if staleness >= 1:
+            stale_players.append((staleness, osu_user_id))
+    stale_players.sort(reverse=True)
+    return [osu_user_id for _, osu_user_id in stale_players[:limit]]
+
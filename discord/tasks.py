@@ -1,93 +1,321 @@
-import datetime
 import logging
 
-from celery import shared_task
+from celery import current_app, shared_task
 from django.db import transaction
+from kombu.exceptions import ChannelError
 
-from userauth.authentication import bws, filter_badges, prep_badges_for_db
-from userauth.models import TournamentPlayer, TournamentPlayerBadge
-from django.core.cache import cache
+from fivedigitworldcup.circuitbreaker import osu_api_breaker
+from fivedigitworldcup.http import api_client
+from fivedigitworldcup.ratelimit import osu_api_limiter
+from discord.coalescing import PRIORITY_LANE, cache_users, claim_users, get_cached_users, release_users
+from discord.jobs import RefreshJob
+from discord.osu_api import record_failure, record_response
+from discord.refresh import PLAYER_STATS_FIELDS, AsyncRefresher, set_player_stats, write_user_stats
+from discord.scheduling import get_stale_players, mark_fetched, mark_scheduled
+from discord.tokens import osu_token
+from userauth.authentication import count_eligible_badges, filter_badges, prep_badges_for_db, recompute_bws, \
+    sync_player_badges
+from userauth.models import TournamentPlayer
 from django.conf import settings
 import requests
 
 
 logger = logging.getLogger(__name__)
+OSU_USERS_LOOKUP_MAX = 50  # ids per `GET /users` request
 
 
 def get_osu_token() -> str | None:
-    token_dict = cache.get("osu_token", None)
-    if token_dict is None:
-        logger.warning("fetching new osu! token")
-        r = requests.post("https://osu.ppy.sh/oauth/token", {
-            "client_id": settings.OSU_CLIENT_ID,
-            "client_secret": settings.OSU_CLIENT_SECRET,
-            "grant_type": "client_credentials",
-            "scope": "public"
-        })
-        if r.status_code != 200:
-            print(f"[get_osu_token] got status code {r.status_code}")
-            cache.delete("osu_token")
-            return None
-        response_data = r.json()
-        cache.set("osu_token", response_data, timeout=response_data['expires_in'] - 30)
-
-        return response_data['access_token']
-    return token_dict['access_token']
-
-
-@shared_task(rate_limit="2/s")  # RATE LIMIT IS PER WORKER -- ONLY RUN ONE WORKER
-def update_user(user_id: int):
-    logger.info(f"[update_user] looking up user with osu id {user_id}...")
-    try:
-        tourney_player = TournamentPlayer.objects.get(osu_user_id=user_id)
-    except TournamentPlayer.DoesNotExist:
-        logger.info(f"[update_user] user with osu id {user_id} not found! Aborting.")
-        return
+    return osu_token.get()
 
-    token = get_osu_token()
-    if token is None:
+
+def get_queue_length(queue: str) -> int:
+    """
+    Number of messages waiting in the broker `queue`, not counting those already reserved by workers.
+    """
+    with current_app.connection_for_read() as connection:
+        try:
+            return connection.default_channel.queue_declare(queue, passive=True).message_count
+        except ChannelError:  # the redis transport deletes queues once they're empty
+            return 0
+
+
+def record_job(job_id: str | None, **counts):
+    if job_id is not None:
+        RefreshJob(job_id).record(**counts)
+
+
+def defer_users(task, user_ids: list[int], countdown: float, *args, **kwargs):
+    """
+    Enqueue `task` again in `countdown` seconds, while the osu! API is unavailable. The users stay claimed (see
+    `claim_users`), their refresh is still pending.
+    """
+    osu_api_breaker.defer(user_ids)
+    task.apply_async(args, kwargs, countdown=countdown)
+    logger.warning(f"[{task.__name__}] {len(user_ids)} users deferred by {countdown:.0f}s")
+
+
+@shared_task
+def update_user(user_id: int, job_id: str = None, retries: int = 0):
+    """
+    :param retries: times this refresh was already retried after a 429/5xx, up to OSU_API_MAX_RETRIES
+    """
+    if (retry_in := osu_api_breaker.retry_in()) > 0:
+        defer_users(update_user, [user_id], retry_in, user_id, job_id=job_id, retries=retries)
         return
+    release = True
+    try:
+        logger.info(f"[update_user] looking up user with osu id {user_id}...")
+        try:
+            tourney_player = TournamentPlayer.objects.get(osu_user_id=user_id)
+        except TournamentPlayer.DoesNotExist:
+            logger.info(f"[update_user] user with osu id {user_id} not found! Aborting.")
+            record_job(job_id, skipped=1)
+            return
+
+        # back-to-back refreshes reuse the last payload
+        if (osu_data := get_cached_users([user_id]).get(user_id)) is None:
+            token = get_osu_token()
+            if token is None:
+                record_job(job_id, failed=1)
+                return
+
+            osu_api_limiter.acquire()  # shared by all workers
+            try:
+                response = api_client.get(f"{settings.OSU_API_ENDPOINT}/users/{user_id}/osu",
+                                          headers={"Authorization": f"Bearer {token}"})
+                retry_in = record_response(response.status_code, response.headers)
+            except requests.RequestException as e:
+                logger.warning(f"[update_user] {user_id}: {e}")
+                response, retry_in = None, record_failure()
+            if retry_in is not None and retries < settings.OSU_API_MAX_RETRIES:
+                defer_users(update_user, [user_id], retry_in, user_id, job_id=job_id, retries=retries + 1)
+                release = False
+                return
+            if response is None or response.status_code != 200:
+                if response is not None:
+                    logger.warning(f"[update_user] got status code {response.status_code} for {user_id}")
+                record_job(job_id, failed=1)
+                return
+            osu_data = response.json()
+            cache_users({user_id: osu_data})
 
-    response = requests.get(f"https://osu.ppy.sh/api/v2/users/{user_id}/osu",
-                            headers={"Authorization": f"Bearer {token}"})
+        eligible_badges, db_badges = prep_badges_for_db(osu_data, tourney_player)
+        player_changed = set_player_stats(tourney_player,
+                                          osu_data['statistics'].get('global_rank', None),
+                                          # already filtered by phrase, only the award date is left to check
+                                          len(filter_badges(eligible_badges, filter_phrases=())),
+                                          osu_data['username'])
 
-    osu_data = response.json()
-    all_badges, db_badges = prep_badges_for_db(osu_data, tourney_player)
+        with transaction.atomic():
+            added, removed = sync_player_badges(tourney_player, db_badges)
+            if player_changed:
+                tourney_player.save(update_fields=PLAYER_STATS_FIELDS)
+        mark_fetched([user_id])
+        logger.debug(f"[update_user] {user_id}: {added} badges added, {removed} removed, "
+                     f"player {'updated' if player_changed else 'unchanged'}")
+        record_job(job_id, done=1)
+        logger.info(f"[update_user] {user_id} updated!")
+    finally:
+        if release:
+            release_users([user_id], lane=PRIORITY_LANE)
 
-    tourney_player.osu_rank_std = osu_data['statistics'].get('global_rank', None)
-    tourney_player.osu_rank_std_bws = bws(len(filter_badges(all_badges)),
-                                          tourney_player.osu_rank_std)
-    tourney_player.osu_username = osu_data['username']
-    tourney_player.osu_stats_updated = datetime.datetime.now(tz=datetime.timezone.utc)
 
-    with transaction.atomic():
-        # can't be arsed to update, just delete and recreate them all
-        TournamentPlayerBadge.objects.filter(user=tourney_player).delete()
-        TournamentPlayerBadge.objects.bulk_create(db_badges)
-        tourney_player.save()
+@shared_task
+def update_user_batch(user_ids: list[int], badges: bool = False, job_id: str = None, retries: int = 0):
+    """
+    Refresh many users together: players are read in one query and written back with one `bulk_update` and batched
+    badge writes, in a single transaction.
+
+    Without `badges`, up to OSU_USERS_LOOKUP_MAX users are looked up with one osu! API request. That lookup doesn't
+    include badges, so BWS is recomputed from the stored badges. With `badges`, each user is fetched separately (as
+    in `update_user`) and their badges are synced too, reusing payloads fetched within OSU_USER_CACHE_TTL.
+
+    Users are released once processed, so that later refreshes are no longer coalesced into this one. While the osu!
+    API is unavailable, the users that are left are deferred to a new batch instead.
+
+    :param job_id: `RefreshJob` to report the outcome of every user to
+    :param retries: times these users were already retried after a 429/5xx, up to OSU_API_MAX_RETRIES
+    """
+    if (retry_in := osu_api_breaker.retry_in()) > 0:
+        defer_users(update_user_batch, user_ids, retry_in, user_ids, badges=badges, job_id=job_id, retries=retries)
+        return
+    deferred = []
     try:
-        cache.decr("osu_queue_length")
-        cache.touch("osu_queue_length", 60)
-    except ValueError:
-        pass
-    logger.info(f"[update_user] {user_id} updated!")
+        logger.info(f"[update_user_batch] looking up {len(user_ids)} users...")
+        players = {player.osu_user_id: player for player in TournamentPlayer.objects.filter(osu_user_id__in=user_ids)}
+        not_found = len(user_ids) - len(players)
+        if not players:
+            record_job(job_id, skipped=not_found)
+            return
+
+        token = get_osu_token()
+        if token is None:
+            record_job(job_id, failed=len(players), skipped=not_found)
+            return
+
+        headers = {"Authorization": f"Bearer {token}"}
+        if badges:
+            cached = get_cached_users(players)
+            fetched = [(players[user_id], osu_data) for user_id, osu_data in cached.items()]
+            pending = [user_id for user_id in players if user_id not in cached]
+            for i, user_id in enumerate(pending):
+                osu_api_limiter.acquire()  # shared by all workers
+                try:
+                    response = api_client.get(f"{settings.OSU_API_ENDPOINT}/users/{user_id}/osu",
+                                              headers=headers)
+                    retry_in = record_response(response.status_code, response.headers)
+                except requests.RequestException as e:
+                    logger.warning(f"[update_user_batch] {user_id}: {e}")
+                    response, retry_in = None, record_failure()
+                if retry_in is not None and retries < settings.OSU_API_MAX_RETRIES:
+                    deferred = pending[i:]
+                    break
+                if response is None:
+                    continue
+                if response.status_code != 200:
+                    logger.warning(f"[update_user_batch] got status code {response.status_code} for {user_id}")
+                    continue
+                fetched.append((players[user_id], response.json()))
+            changed, added, removed = write_user_stats(fetched)
+            cache_users({tourney_player.osu_user_id: osu_data for tourney_player, osu_data in fetched
+                         if tourney_player.osu_user_id not in cached})
+            done, skipped = len(fetched), not_found
+        else:
+            osu_api_limiter.acquire()
+            try:
+                response = api_client.get(f"{settings.OSU_API_ENDPOINT}/users", params={"ids[]": list(players)},
+                                          headers=headers)
+                retry_in = record_response(response.status_code, response.headers)
+            except requests.RequestException as e:
+                logger.warning(f"[update_user_batch] {e}")
+                response, retry_in = None, record_failure()
+            if retry_in is not None and retries < settings.OSU_API_MAX_RETRIES:
+                deferred = list(players)
+                record_job(job_id, skipped=not_found)
+                return
+            if response is None or response.status_code != 200:
+                if response is not None:
+                    logger.warning(f"[update_user_batch] got status code {response.status_code}")
+                record_job(job_id, failed=len(players), skipped=not_found)
+                return
+            fetched = response.json()['users']
+            badge_counts = count_eligible_badges(players=players.values())
+            changed_players = []
+            for osu_data in fetched:
+                if (tourney_player := players.get(osu_data['id'])) is None:
+                    continue
+                if set_player_stats(tourney_player,
+                                    osu_data['statistics_rulesets'].get('osu', {}).get('global_rank', None),
+                                    badge_counts[tourney_player.pk],
+                                    osu_data['username']):
+                    changed_players.append(tourney_player)
+            TournamentPlayer.objects.bulk_update(changed_players, fields=PLAYER_STATS_FIELDS)
+            changed, added, removed = len(changed_players), 0, 0
+            # restricted or deleted users are left out of the response
+            fetched_ids = [osu_data['id'] for osu_data in fetched if osu_data['id'] in players]
+            mark_fetched(fetched_ids)
+            done = len(fetched_ids)
+            skipped = len(user_ids) - done
+        # deferred users are still pending
+        record_job(job_id, done=done, failed=len(user_ids) - done - skipped - len(deferred), skipped=skipped)
+        logger.info(f"[update_user_batch] {len(fetched)}/{len(players)} users fetched, {changed} updated, "
+                    f"{added} badges added, {removed} removed, HTTP timings {api_client.get_timings()}")
+    except Exception:
+        # nothing was recorded yet, the job would otherwise never finish
+        record_job(job_id, failed=len(user_ids) - len(deferred))
+        raise
+    finally:
+        if deferred:
+            defer_users(update_user_batch, deferred, retry_in, deferred, badges=badges, job_id=job_id,
+                        retries=retries + 1)
+        release_users(set(user_ids) - set(deferred))
 
 
 @shared_task
-def update_users(user_ids: list[int] | None = None):
+def update_users(user_ids: list[int] | None = None, badges: bool = True, batch_size: int = OSU_USERS_LOOKUP_MAX,
+                 job_id: str = None) -> str:
     """
-    Fetch new statistics for users in user_ids.
+    Fetch new statistics for users in user_ids, `batch_size` users per `update_user_batch` task.
 
     :param user_ids: list of user IDs to update. Defaults to None. If None, update all users in database.
-    :return: None
+    :param badges: also refresh badges, with one request per user. Otherwise, users are looked up
+        OSU_USERS_LOOKUP_MAX at a time and BWS is recomputed from their stored badges.
+    :param batch_size: users per task, at most OSU_USERS_LOOKUP_MAX without `badges`
+    :param job_id: `RefreshJob` tracking the progress, a new one is created if None. Users with a refresh already
+        pending are counted as skipped.
+    :return: id of the job
     """
 
     if user_ids is None:
-        all_users = TournamentPlayer.objects.all()
-        user_ids = [user.osu_user_id for user in all_users]
-    for user_id in user_ids:
-        cache.add("osu_queue_length", 0)  # only set if key not already present
-        cache.incr("osu_queue_length")
-        cache.touch("osu_queue_length", 60)
-        logger.debug(f"[update_users] queue now at: {cache.get('osu_queue_length')}")
-        update_user.delay(user_id)
+        user_ids = list(TournamentPlayer.objects.values_list('osu_user_id', flat=True))
+    if not badges:
+        batch_size = min(batch_size, OSU_USERS_LOOKUP_MAX)
+    job = RefreshJob(job_id) if job_id is not None else RefreshJob.create()
+    job.enqueue(len(user_ids))
+    # users that already have a refresh pending are covered by it
+    claimed = claim_users(user_ids)
+    if coalesced := len(user_ids) - len(claimed):
+        job.record(skipped=coalesced)
+    user_ids = claimed
+    for i in range(0, len(user_ids), batch_size):
+        try:
+            update_user_batch.delay(user_ids[i:i + batch_size], badges=badges, job_id=job.id)
+        except Exception:
+            # the users that weren't queued are failed, so that the job still finishes
+            job.record(failed=len(user_ids) - i)
+            release_users(user_ids[i:])
+            raise
+    logger.debug(f"[update_users] {len(user_ids)} users queued for job {job.id}")
+    return job.id
+
+
+@shared_task
+def refresh_all_users(user_ids: list[int] | None = None, concurrency: int = 8):
+    """
+    Refresh users (all if `user_ids` is None) in this worker with the asyncio refresher, as an alternative to fanning
+    out `update_user_batch` tasks.
+    """
+    players = TournamentPlayer.objects.all()
+    if user_ids is not None:
+        players = players.filter(osu_user_id__in=user_ids)
+    token = get_osu_token()
+    if token is None:
+        return
+    stats = AsyncRefresher(token, concurrency=concurrency).refresh(list(players))
+    logger.info(f"[refresh_all_users] {stats}")
+
+
+@shared_task
+def schedule_stale_refreshes(batch_size: int = 10) -> int:
+    """
+    Run by celery beat every REFRESH_SCHEDULE_INTERVAL. Enqueues refreshes of the most overdue players, as many as
+    REFRESH_RATE_BUDGET of the osu! API rate limit allows within the interval, in batches spread evenly over it.
+    :return: number of players scheduled
+    """
+    interval = settings.REFRESH_SCHEDULE_INTERVAL
+    budget = int(settings.OSU_API_RATE_LIMIT * settings.REFRESH_RATE_BUDGET * interval)
+    user_ids = claim_users(get_stale_players(limit=budget))
+    batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+    for i, batch in enumerate(batches):
+        update_user_batch.apply_async((batch,), {'badges': True}, countdown=round(i * interval / len(batches)))
+    mark_scheduled(user_ids)
+    logger.info(f"[schedule_stale_refreshes] scheduled {len(user_ids)} players in {len(batches)} batches")
+    return len(user_ids)
+
+
+@shared_task
+def renew_osu_token():
+    """
+    Run by celery beat every OSU_TOKEN_RENEW_BEFORE / 2, so the token is renewed before it expires.
+    """
+    if get_osu_token() is None:
+        logger.warning("[renew_osu_token] no valid osu! token")
+
+
+@shared_task
+def recompute_all_bws():
+    """
+    Recompute BWS for all users from their stored badges, e.g. after the badge filter or cutoff date changed.
+    """
+    updated = recompute_bws()
+    logger.info(f"[recompute_all_bws] BWS changed for {updated} users")
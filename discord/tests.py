@@ -1,22 +1,47 @@
 import datetime
-from unittest.mock import Mock, patch
-
+import email.utils
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest.mock import ANY, Mock, patch
+
+import fakeredis
+import requests
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from kombu import Connection, Queue
 from parameterized import parameterized
 from rest_framework.test import APIRequestFactory
 
 from discord import tasks
+from discord.coalescing import PRIORITY_LANE, cache_users, claim_users, release_users
+from discord.jobs import JOB_STALE_AFTER, RefreshJob
+from discord.osu_api import get_retry_after, record_response
+from discord.refresh import AsyncRefresher, write_user_stats
+from discord.scheduling import get_stale_players, mark_fetched
+from discord.tokens import RENEWAL_LOCK_KEY, TOKEN_CACHE_KEY, OsuTokenCache, osu_token
 from discord.views import TeamOrganizer, TournamentPlayerViewSet
+from fivedigitworldcup.circuitbreaker import CircuitBreaker, osu_api_breaker
+from fivedigitworldcup.http import ApiClient, AsyncApiClient, api_client
+from fivedigitworldcup.ratelimit import TokenBucket, osu_api_limiter
 from teammgmt.models import TournamentTeam
-from userauth.models import TournamentPlayer, TournamentPlayerBadge
+from userauth.authentication import bws
+from userauth.models import Badge, TournamentPlayer, TournamentPlayerBadge
 
 
 class MockResponse:
-    def __init__(self, json_data, status_code):
+    def __init__(self, json_data, status_code, headers=None):
         self.json_data = json_data
         self.status_code = status_code
+        self.headers = headers or {}
 
     def json(self):
         return self.json_data
@@ -64,6 +89,7 @@ class TestTournamentOrganizerPermissionClass(TestCase):
 class FetchOsuUserStatsTestCase(TestCase):
     def setUp(self):
         cache.clear()
+        osu_token.forget()
         self.user = User.objects.create()
         self.tourney_user = TournamentPlayer.objects.create(user=self.user,
                                                             osu_user_id=1,
@@ -82,10 +108,12 @@ class FetchOsuUserStatsTestCase(TestCase):
 
         self.assertEqual(200, res.status_code)
         self.assertEqual(1, mocked_tasks_update_users.call_count)
+        self.assertEqual(res.data['job']['id'], mocked_tasks_update_users.call_args.kwargs['job_id'])
+        self.assertTrue(res.data['status_url'].endswith(f"/registrants/jobs/{res.data['job']['id']}/"))
 
     @patch('discord.tasks.update_users.delay')
     def test_update_all_users_api_rate_limited(self, mocked_tasks_update_users):
-        cache.set("osu_queue_length", 100, timeout=1)
+        RefreshJob.create().enqueue(100)
         factory = APIRequestFactory()
         request = factory.post(f'/registrants/update_users')
         update_all_users_action = TournamentPlayerViewSet.as_view({'post': 'update_all_users'},
@@ -95,6 +123,16 @@ class FetchOsuUserStatsTestCase(TestCase):
         self.assertEqual(429, res.status_code)
         self.assertEqual(0, mocked_tasks_update_users.call_count)
 
+    @patch('discord.tasks.recompute_all_bws.delay')
+    def test_recompute_bws_api(self, mocked_recompute_all_bws):
+        request = APIRequestFactory().post('/registrants/recompute_bws/')
+        recompute_bws_action = TournamentPlayerViewSet.as_view({'post': 'recompute_bws'}, permission_classes=[])
+        res = recompute_bws_action(request)
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, mocked_recompute_all_bws.call_count)
+
+    @patch('discord.tasks.get_queue_length', new=Mock(return_value=1))
     @patch('discord.tasks.update_user.delay')
     def test_update_specific_user_api(self, mocked_tasks_update_user):
         factory = APIRequestFactory()
@@ -108,27 +146,64 @@ class FetchOsuUserStatsTestCase(TestCase):
         self.assertEqual(1, mocked_tasks_update_user.call_count)
         mocked_tasks_update_user.assert_called_with(self.tourney_user.osu_user_id)
 
+    @patch('discord.tasks.get_queue_length', new=Mock(return_value=1))
+    @patch('discord.tasks.update_user.delay')
+    def test_update_specific_user_api_coalesced(self, mocked_tasks_update_user):
+        """
+        Test that updates of a player with an update already pending aren't queued again
+        """
+        update_user_action = TournamentPlayerViewSet.as_view({'post': 'update_user'}, permission_classes=[],
+                                                             detail=True)
+        responses = [update_user_action(APIRequestFactory().post(f'/registrants/{self.tourney_user.pk}/update_user/'),
+                                        pk=self.tourney_user.pk)
+                     for _ in range(2)]
+
+        self.assertEqual([False, True], [res.data['coalesced'] for res in responses])
+        self.assertEqual(1, mocked_tasks_update_user.call_count)
+
+        # the pending update releases the player once it ran
+        release_users([self.tourney_user.osu_user_id], lane=PRIORITY_LANE)
+        update_user_action(APIRequestFactory().post(f'/registrants/{self.tourney_user.pk}/update_user/'),
+                           pk=self.tourney_user.pk)
+        self.assertEqual(2, mocked_tasks_update_user.call_count)
+
+    @patch('discord.tasks.get_queue_length', new=Mock(return_value=1))
+    @patch('discord.tasks.update_user.delay')
+    def test_update_specific_user_api_not_coalesced_into_bulk(self, mocked_tasks_update_user):
+        """
+        Test that a player pending in a bulk refresh is still queued on the priority lane
+        """
+        claim_users([self.tourney_user.osu_user_id])
+        update_user_action = TournamentPlayerViewSet.as_view({'post': 'update_user'}, permission_classes=[],
+                                                             detail=True)
+        res = update_user_action(APIRequestFactory().post(f'/registrants/{self.tourney_user.pk}/update_user/'),
+                                 pk=self.tourney_user.pk)
+
+        self.assertFalse(res.data['coalesced'])
+        mocked_tasks_update_user.assert_called_once_with(self.tourney_user.osu_user_id)
+
     def test_get_osu_token_invalid_credentials(self):
         response = MockResponse({}, 401)
 
-        with patch('discord.tasks.requests.post', new=Mock(return_value=response)):
+        with patch('discord.tokens.api_client.post', new=Mock(return_value=response)):
             token = tasks.get_osu_token()
             self.assertIsNone(token)
 
             # assert that we don't cache invalid credentials
-            self.assertIsNone(cache.get("osu_token", None))
+            self.assertIsNone(cache.get(TOKEN_CACHE_KEY, None))
 
     def test_get_osu_token_use_cache(self):
         """
         If an existing token exists in cache, use cached token
         """
-        cache.set("osu_token", {
+        cache.set(TOKEN_CACHE_KEY, {
             "token_type": "Bearer",
             "expires_in": 86400,
-            "access_token": (token_value := "wQZbHHT8wGnVUn4ABJugD7iID8Gnhvg8jLoCb0ALyj9Mylva9TD")
+            "access_token": (token_value := "wQZbHHT8wGnVUn4ABJugD7iID8Gnhvg8jLoCb0ALyj9Mylva9TD"),
+            "expires_at": time.time() + 86400
         }, timeout=30)
 
-        with patch('discord.tasks.requests.post') as p:
+        with patch('discord.tokens.api_client.post') as p:
             token = tasks.get_osu_token()
             self.assertEqual(token_value, token)
             self.assertEqual(0, p.call_count)
@@ -142,17 +217,42 @@ class FetchOsuUserStatsTestCase(TestCase):
         },
             200)
 
-        with patch('discord.tasks.requests.post', new=Mock(return_value=response)):
+        with patch('discord.tokens.api_client.post', new=Mock(return_value=response)):
             token = tasks.get_osu_token()
             self.assertEqual(token_value, token)
-            self.assertEqual(dict, type(cache.get("osu_token")))
-            self.assertEqual(token_value, cache.get("osu_token").get("access_token", None))  # ensure token is cached
+            self.assertEqual(dict, type(cache.get(TOKEN_CACHE_KEY)))
+            # ensure token is cached
+            self.assertEqual(token_value, cache.get(TOKEN_CACHE_KEY).get("access_token", None))
+
+    def test_update_specific_user_queue_position(self):
+        with Connection("memory://") as broker:
+            producer = broker.Producer()
+            for osu_user_id in (2, 3):  # already waiting
+                producer.publish({"osu_user_id": osu_user_id}, routing_key=settings.OSU_PRIORITY_QUEUE,
+                                 declare=[Queue(settings.OSU_PRIORITY_QUEUE)])
+            request = APIRequestFactory().post(f'/registrants/{self.tourney_user.pk}/update_user/')
+            update_user_action = TournamentPlayerViewSet.as_view({'post': 'update_user'}, permission_classes=[],
+                                                                 detail=True)
+            with patch('discord.tasks.current_app.connection_for_read', new=Mock(return_value=broker)), \
+                    patch('discord.tasks.update_user.delay',
+                          side_effect=lambda osu_user_id: producer.publish({"osu_user_id": osu_user_id},
+                                                                           routing_key=settings.OSU_PRIORITY_QUEUE)):
+                res = update_user_action(request, pk=self.tourney_user.pk)
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual((settings.OSU_PRIORITY_QUEUE, 3), (res.data['queue'], res.data['queue_position']))
+
+    def test_update_tasks_routing(self):
+        router = tasks.update_user.app.amqp.router
+        self.assertEqual(settings.OSU_PRIORITY_QUEUE, router.route({}, tasks.update_user.name)['queue'].name)
+        for task in (tasks.update_user_batch, tasks.update_users, tasks.refresh_all_users):
+            self.assertEqual(settings.OSU_BULK_QUEUE, router.route({}, task.name)['queue'].name)
 
     def test_user_not_in_db(self):
         """
         Test that we don't hit the osu! API if the registered user isn't in our own database
         """
-        with patch('discord.tasks.requests.get') as p:
+        with patch('discord.tasks.api_client.get') as p:
             tasks.update_user(self.tourney_user.osu_user_id + 727)
             self.assertEqual(0, p.call_count)
 
@@ -162,21 +262,119 @@ class FetchOsuUserStatsTestCase(TestCase):
         Test that we don't hit the osu! API if we fail to fetch a token
         """
         mocked_get_osu_token.return_value = None
-        with patch("discord.tasks.requests.get") as p:
+        with patch("discord.tasks.api_client.get") as p:
             tasks.update_user(self.tourney_user.osu_user_id)
             self.assertEqual(0, p.call_count)
 
-    @patch("discord.tasks.update_user.delay")
-    def test_update_all(self, mocked_update_user):
+    @patch("discord.tasks.update_user_batch.delay")
+    def test_update_all(self, mocked_update_user_batch):
         tasks.update_users()
         self.assertTrue(TournamentPlayer.objects.count() > 0)
-        self.assertEqual(TournamentPlayer.objects.count(), mocked_update_user.call_count)
+        self.assertEqual(1, mocked_update_user_batch.call_count)
+        mocked_update_user_batch.assert_called_with([self.tourney_user.osu_user_id], badges=True, job_id=ANY)
 
-    @patch("discord.tasks.update_user.delay")
-    def test_update_list(self, mocked_update_user):
+    @patch("discord.tasks.update_user_batch.delay")
+    def test_update_list(self, mocked_update_user_batch):
         users_to_update = [1, 2, 3]
-        tasks.update_users(users_to_update)
-        self.assertEqual(len(users_to_update), mocked_update_user.call_count)
+        tasks.update_users(users_to_update, batch_size=2)
+        self.assertEqual([[1, 2], [3]], [call.args[0] for call in mocked_update_user_batch.call_args_list])
+
+    @patch("discord.tasks.update_user_batch.delay")
+    def test_update_list_batched(self, mocked_update_user_batch):
+        job_id = tasks.update_users(list(range(120)), badges=False)
+        self.assertEqual([50, 50, 20], [len(call.args[0]) for call in mocked_update_user_batch.call_args_list])
+        self.assertEqual({job_id}, {call.kwargs['job_id'] for call in mocked_update_user_batch.call_args_list})
+        self.assertEqual(120, RefreshJob(job_id).status()['queued'])
+
+    @patch('discord.tasks.update_user_batch.delay')
+    def test_update_list_coalesced(self, mocked_update_user_batch):
+        claim_users([1, 2])  # already pending, e.g. scheduled as stale
+        job_id = tasks.update_users([1, 2, 3, 4], badges=False)
+
+        mocked_update_user_batch.assert_called_once_with([3, 4], badges=False, job_id=job_id)
+        job_status = RefreshJob(job_id).status()
+        self.assertEqual((4, 2, 2), (job_status['queued'], job_status['skipped'], job_status['remaining']))
+
+    @patch('discord.tasks.update_users.delay')
+    def test_update_all_users_api_batched(self, mocked_tasks_update_users):
+        request = APIRequestFactory().post('/registrants/update_users?badges=false')
+        update_all_users_action = TournamentPlayerViewSet.as_view({'post': 'update_all_users'},
+                                                                  permission_classes=[])
+        res = update_all_users_action(request)
+
+        self.assertEqual(200, res.status_code)
+        mocked_tasks_update_users.assert_called_once_with(badges=False, job_id=ANY)
+
+    @patch("discord.tasks.get_osu_token")
+    def test_update_user_batch(self, mocked_get_osu_token):
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        never_updated = self.tourney_user.osu_stats_updated
+        players = [self.tourney_user]
+        for osu_user_id in (2, 3):
+            players.append(TournamentPlayer.objects.create(user=User.objects.create(username=f"user_{osu_user_id}"),
+                                                           osu_user_id=osu_user_id,
+                                                           osu_username=f"player_{osu_user_id}",
+                                                           osu_rank_std=5000,
+                                                           osu_rank_std_bws=bws(0, 5000),
+                                                           osu_stats_updated=never_updated))
+        badge = Badge.objects.create(key=Badge.make_key("Some Tournament Winning Team", ""),
+                                     description="Some Tournament Winning Team", image_url="", image_url_2x="")
+        TournamentPlayerBadge.objects.create(user=self.tourney_user, badge=badge,
+                                             award_date=datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc))
+        response = MockResponse({"users": [
+            {"id": 1, "username": "new_username", "statistics_rulesets": {"osu": {"global_rank": 1000}}},
+            {"id": 2, "username": "player_2", "statistics_rulesets": {"osu": {"global_rank": 5000}}},
+            # user 3 is restricted and missing from the response
+        ]}, 200)
+
+        job = RefreshJob.create()
+        job.enqueue(3)
+        with patch('discord.tasks.api_client.get', new=Mock(return_value=response)) as p:
+            tasks.update_user_batch([1, 2, 3], job_id=job.id)
+            self.assertEqual(1, p.call_count)
+            self.assertEqual([1, 2, 3], p.call_args.kwargs['params']['ids[]'])
+        self.assertEqual((2, 0, 1), tuple(job.status()[outcome] for outcome in ('done', 'failed', 'skipped')))
+
+        for player in players:
+            player.refresh_from_db()
+        self.assertEqual(("new_username", 1000, bws(1, 1000)),
+                         (players[0].osu_username, players[0].osu_rank_std, players[0].osu_rank_std_bws))
+        self.assertGreater(players[0].osu_stats_updated, players[1].osu_stats_updated)
+        self.assertEqual(never_updated, players[1].osu_stats_updated)  # unchanged, not written
+        self.assertEqual(never_updated, players[2].osu_stats_updated)
+
+    @patch("discord.tasks.get_osu_token")
+    def test_update_user_batch_with_badges(self, mocked_get_osu_token):
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        other_player = TournamentPlayer.objects.create(user=User.objects.create(username="user_2"),
+                                                       osu_user_id=2,
+                                                       osu_stats_updated=self.tourney_user.osu_stats_updated)
+        shared_badge = {'awarded_at': '2023-01-19T02:08:46+00:00',
+                        'description': "Some Tournament Winning Team",
+                        'image@2x_url': 'https://assets.ppy.sh/profile-badges/some-tournament@2x.png',
+                        'image_url': 'https://assets.ppy.sh/profile-badges/some-tournament.png',
+                        'url': ''}
+        responses = {
+            f"{settings.OSU_API_ENDPOINT}/users/1/osu": MockResponse({
+                "id": 1, "badges": [shared_badge], "statistics": {"global_rank": 1000}, "username": "one"}, 200),
+            f"{settings.OSU_API_ENDPOINT}/users/2/osu": MockResponse({
+                "id": 2, "badges": [shared_badge], "statistics": {"global_rank": 2000}, "username": "two"}, 200),
+        }
+
+        with patch('discord.tasks.api_client.get', new=Mock(side_effect=lambda url, **kwargs: responses[url])) as p:
+            with CaptureQueriesContext(connection) as queries:
+                tasks.update_user_batch([1, 2], badges=True)
+            self.assertEqual(2, p.call_count)
+        writes = [query['sql'].split()[0] for query in queries.captured_queries
+                  if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertEqual(['INSERT', 'INSERT', 'UPDATE'], writes)  # catalog, badges of both players, both players
+
+        self.tourney_user.refresh_from_db()
+        other_player.refresh_from_db()
+        self.assertEqual(bws(1, 1000), self.tourney_user.osu_rank_std_bws)
+        self.assertEqual(bws(1, 2000), other_player.osu_rank_std_bws)
+        self.assertEqual(1, Badge.objects.count())
+        self.assertEqual(2, TournamentPlayerBadge.objects.count())
 
     @patch("discord.tasks.get_osu_token")
     def test_stats_update_no_badge(self, mocked_get_osu_token):
@@ -199,7 +397,7 @@ class FetchOsuUserStatsTestCase(TestCase):
 
         year_2000 = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
         self.assertLess(self.tourney_user.osu_stats_updated, year_2000)
-        with patch('discord.tasks.requests.get', new=Mock(return_value=response)) as p:
+        with patch('discord.tasks.api_client.get', new=Mock(return_value=response)) as p:
             tasks.update_user(self.tourney_user.osu_user_id)
             self.assertGreater(p.call_count, 0)
             self.tourney_user.refresh_from_db()
@@ -229,7 +427,7 @@ class FetchOsuUserStatsTestCase(TestCase):
         },
             200)
 
-        with patch('discord.tasks.requests.get', new=Mock(return_value=response)) as p:
+        with patch('discord.tasks.api_client.get', new=Mock(return_value=response)) as p:
             tasks.update_user(self.tourney_user.osu_user_id)
 
             self.assertGreater(p.call_count, 0)
@@ -237,9 +435,9 @@ class FetchOsuUserStatsTestCase(TestCase):
             self.assertEqual(new_username, self.tourney_user.osu_username)
 
     @patch("discord.tasks.get_osu_token")
-    def test_stats_update_queue_decr(self, mocked_get_osu_token):
+    def test_stats_update_job_progress(self, mocked_get_osu_token):
         """
-        Test that we decrement the "osu_queue_length" key in cache
+        Test that the update is counted in its job
         :return:
         """
         mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
@@ -250,12 +448,565 @@ class FetchOsuUserStatsTestCase(TestCase):
         },
             200)
 
-        with patch('discord.tasks.requests.get', new=Mock(return_value=response)):
-            with patch('discord.tasks.cache.decr') as cache_decr:
-                with patch('discord.tasks.cache.touch') as cache_touch:
+        job = RefreshJob.create()
+        job.enqueue(2)
+        with patch('discord.tasks.api_client.get', new=Mock(return_value=response)):
+            tasks.update_user(self.tourney_user.osu_user_id, job_id=job.id)
+            tasks.update_user(self.tourney_user.osu_user_id + 727, job_id=job.id)
+        job_status = job.status()
+        self.assertEqual((1, 0, 1, 0), (job_status['done'], job_status['failed'], job_status['skipped'],
+                                        job_status['remaining']))
+        self.assertTrue(job_status['finished'])
+        self.assertIsNone(RefreshJob.get_active())
+
+    @patch("discord.tasks.get_osu_token")
+    def test_update_user_batch_crash_recorded(self, mocked_get_osu_token):
+        """
+        Test that a batch raising counts its users as failed, so that its job still finishes
+        """
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        job = RefreshJob.create()
+        job.enqueue(1)
+        with patch('discord.tasks.api_client.get', new=Mock(side_effect=KeyError("users"))), \
+                self.assertRaises(KeyError):
+            tasks.update_user_batch([self.tourney_user.osu_user_id], job_id=job.id)
+        self.assertEqual((1, True), (job.status()['failed'], job.status()['finished']))
+        self.assertIsNone(RefreshJob.get_active())
+
+    def test_stale_job_inactive(self):
+        job = RefreshJob.create()  # its tasks never reported, e.g. `update_users` failed
+        self.assertEqual(job.id, RefreshJob.get_active().id)
+        with patch('discord.jobs.time.time', return_value=time.time() + JOB_STALE_AFTER + 1):
+            self.assertTrue(job.status()['stale'])
+            self.assertIsNone(RefreshJob.get_active())
+
+    def test_job_status_api(self):
+        job = RefreshJob.create()
+        job.enqueue(3)
+        job.record(done=1, failed=1)
+        job_status_action = TournamentPlayerViewSet.as_view({'get': 'job_status'}, permission_classes=[])
+
+        res = job_status_action(APIRequestFactory().get(f'/registrants/jobs/{job.id}/'), job_id=job.id)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual((3, 1, 1, 1, False), (res.data['queued'], res.data['done'], res.data['failed'],
+                                               res.data['remaining'], res.data['finished']))
+        self.assertFalse(res.data['osu_api']['open'])
+        self.assertIsInstance(res.data['http'], dict)
+
+        res = job_status_action(APIRequestFactory().get(f'/registrants/jobs/{"0" * 32}/'), job_id="0" * 32)
+        self.assertEqual(404, res.status_code)
+
+    @override_settings(OSU_USER_CACHE_TTL=0)  # every refresh fetches
+    @patch("discord.tasks.get_osu_token")
+    def test_stats_update_incremental_badges(self, mocked_get_osu_token):
+        """
+        Test that a refresh only writes the badges that changed, and skips the player row when nothing changed
+        """
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        badges = [{'awarded_at': f'2023-0{i + 1}-19T02:08:46+00:00',
+                   'description': f"Some Tournament {i} Winning Team",
+                   'image@2x_url': f'https://assets.ppy.sh/profile-badges/some-tournament-{i}@2x.png',
+                   'image_url': f'https://assets.ppy.sh/profile-badges/some-tournament-{i}.png',
+                   'url': ''}
+                  for i in range(3)]
+
+        def refresh(user_badges):
+            response = MockResponse({"badges": user_badges,
+                                     "statistics": {"global_rank": 1000},
+                                     "username": self.tourney_user.osu_username},
+                                    200)
+            with patch('discord.tasks.api_client.get', new=Mock(return_value=response)):
+                with CaptureQueriesContext(connection) as queries:
                     tasks.update_user(self.tourney_user.osu_user_id)
-                    self.assertEqual(cache_decr.call_count, 1)
-                    self.assertEqual(cache_touch.call_count, 1)
+            return [query['sql'].split()[0] for query in queries.captured_queries
+                    if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+
+        refresh(badges[:2])
+        kept_badge = TournamentPlayerBadge.objects.get(badge__description=badges[1]['description'])
+        stats_updated = TournamentPlayer.objects.get(pk=self.tourney_user.pk).osu_stats_updated
+
+        self.assertEqual([], refresh(badges[:2]))
+        self.assertEqual(stats_updated, TournamentPlayer.objects.get(pk=self.tourney_user.pk).osu_stats_updated)
+
+        # the new badge goes to the catalog and to the player, the dropped one is deleted, the kept one is untouched
+        self.assertEqual(['INSERT', 'DELETE', 'INSERT'], refresh(badges[1:]))
+        self.assertIn(kept_badge.pk, TournamentPlayerBadge.objects.values_list('pk', flat=True))
+        self.assertCountEqual([badge['description'] for badge in badges[1:]],
+                              TournamentPlayerBadge.objects.values_list('badge__description', flat=True))
+
+    @patch("discord.tasks.get_osu_token")
+    def test_stats_update_reuses_payload(self, mocked_get_osu_token):
+        """
+        Test that back-to-back refreshes of a player only fetch it once
+        """
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        response = MockResponse({"badges": [], "statistics": {"global_rank": 1000}, "username": "someone"}, 200)
+        with patch('discord.tasks.api_client.get', new=Mock(return_value=response)) as mocked_get:
+            tasks.update_user(self.tourney_user.osu_user_id)
+            tasks.update_user_batch([self.tourney_user.osu_user_id], badges=True)
+
+        self.assertEqual(1, mocked_get.call_count)
+        self.assertEqual("someone", TournamentPlayer.objects.get(pk=self.tourney_user.pk).osu_username)
+        # released, so that later refreshes aren't coalesced
+        self.assertEqual([self.tourney_user.osu_user_id], claim_users([self.tourney_user.osu_user_id]))
+
+    @patch('discord.tasks.update_user.apply_async')
+    @patch("discord.tasks.get_osu_token")
+    def test_stats_update_deferred_on_server_error(self, mocked_get_osu_token, mocked_apply_async):
+        """
+        Test that a refresh failing with a 5xx is retried after Retry-After, holding back other requests meanwhile
+        """
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        claim_users([self.tourney_user.osu_user_id], lane=PRIORITY_LANE)
+        job = RefreshJob.create()
+        job.enqueue(1)
+        response = MockResponse({"error": None}, 503, {"Retry-After": "7"})
+        with patch('discord.tasks.api_client.get', new=Mock(return_value=response)):
+            tasks.update_user(self.tourney_user.osu_user_id, job_id=job.id)
+
+        mocked_apply_async.assert_called_once_with((self.tourney_user.osu_user_id,),
+                                                   {'job_id': job.id, 'retries': 1}, countdown=7.)
+        self.assertEqual(1, job.status()['remaining'])  # still pending
+        self.assertEqual([], claim_users([self.tourney_user.osu_user_id], lane=PRIORITY_LANE))
+        self.assertGreater(osu_api_limiter.try_acquire(), 6)
+
+    @patch('discord.tasks.update_user.apply_async')
+    def test_stats_update_deferred_while_breaker_open(self, mocked_apply_async):
+        for _ in range(osu_api_breaker.threshold):
+            osu_api_breaker.record_failure()
+        with patch('discord.tasks.api_client.get') as mocked_get:
+            tasks.update_user(self.tourney_user.osu_user_id)
+
+        self.assertEqual(0, mocked_get.call_count)
+        self.assertAlmostEqual(osu_api_breaker.cooldown, mocked_apply_async.call_args.kwargs['countdown'], delta=1)
+        self.assertEqual(1, osu_api_breaker.status()['deferred'])
+
+        # the next successful request closes the circuit and reports what was deferred
+        self.assertIsNone(record_response(200, {}))
+        self.assertEqual(0, osu_api_breaker.retry_in())
+
+    @patch('discord.tasks.update_user_batch.apply_async')
+    @patch("discord.tasks.get_osu_token")
+    def test_update_user_batch_deferred_on_rate_limit(self, mocked_get_osu_token, mocked_apply_async):
+        """
+        Test that once rate limited, a batch writes what it fetched and defers the rest
+        """
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        for osu_user_id in (2, 3):
+            TournamentPlayer.objects.create(user=User.objects.create(username=f"user_{osu_user_id}"),
+                                            osu_user_id=osu_user_id,
+                                            osu_stats_updated=self.tourney_user.osu_stats_updated)
+        claim_users([1, 2, 3])
+        job = RefreshJob.create()
+        job.enqueue(3)
+        responses = [MockResponse({"badges": [], "statistics": {"global_rank": 1000}, "username": "someone"}, 200),
+                     MockResponse({}, 429, {"Retry-After": "3"})]
+        with patch('discord.tasks.api_client.get', new=Mock(side_effect=responses)):
+            tasks.update_user_batch([1, 2, 3], badges=True, job_id=job.id)
+
+        self.assertEqual("someone", TournamentPlayer.objects.get(osu_user_id=1).osu_username)
+        mocked_apply_async.assert_called_once_with(([2, 3],), {'badges': True, 'job_id': job.id, 'retries': 1},
+                                                   countdown=3.)
+        self.assertEqual((1, 0, 2), (job.status()['done'], job.status()['failed'], job.status()['remaining']))
+        self.assertEqual([1], claim_users([1, 2, 3]))
+
+    @patch("discord.tasks.osu_api_limiter")
+    @patch("discord.tasks.get_osu_token")
+    def test_stats_update_rate_limited(self, mocked_get_osu_token, mocked_limiter):
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        response = MockResponse({"badges": [], "statistics": {"global_rank": 1000}, "username": "someone"}, 200)
+
+        with patch('discord.tasks.api_client.get', new=Mock(return_value=response)):
+            tasks.update_user(self.tourney_user.osu_user_id)
+        self.assertEqual(1, mocked_limiter.acquire.call_count)
+
+
+class StaleRefreshSchedulingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.players = {}
+        for osu_user_id, age_hours, in_roster in [(1, 2, False),  # fresh
+                                                  (2, 30, False),  # 1.25 times its max age
+                                                  (3, 7, True),  # 1.17 times its max age
+                                                  (4, 3, True),  # fresh
+                                                  (5, 50, False)]:  # 2.08 times its max age
+            self.players[osu_user_id] = TournamentPlayer.objects.create(
+                user=User.objects.create(username=f"user_{osu_user_id}"),
+                osu_user_id=osu_user_id,
+                in_roster=in_roster,
+                osu_stats_updated=now - datetime.timedelta(hours=age_hours))
+
+    @override_settings(REFRESH_MAX_AGE=24 * 60 * 60, REFRESH_MAX_AGE_ROSTER=6 * 60 * 60)
+    def test_stale_players_by_staleness(self):
+        self.assertEqual([5, 2, 3], get_stale_players())
+        self.assertEqual([5], get_stale_players(limit=1))
+
+        # fetched without any change, so osu_stats_updated didn't move
+        mark_fetched([5])
+        self.assertEqual([2, 3], get_stale_players())
+
+    @override_settings(REFRESH_MAX_AGE=24 * 60 * 60, REFRESH_MAX_AGE_ROSTER=6 * 60 * 60,
+                       REFRESH_SCHEDULE_INTERVAL=600, OSU_API_RATE_LIMIT=1, REFRESH_RATE_BUDGET=0.005)
+    @patch("discord.tasks.update_user_batch.apply_async")
+    def test_schedule_stale_refreshes(self, mocked_apply_async):
+        # a budget of 3 requests in the interval, spread over it
+        self.assertEqual(3, tasks.schedule_stale_refreshes(batch_size=1))
+        self.assertEqual([[5], [2], [3]], [call.args[0][0] for call in mocked_apply_async.call_args_list])
+        self.assertEqual([0, 200, 400], [call.kwargs['countdown'] for call in mocked_apply_async.call_args_list])
+
+        # already scheduled in this interval
+        self.assertEqual(0, tasks.schedule_stale_refreshes(batch_size=1))
+
+
+class TokenBucketTestCase(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket("test_bucket", rate=2, capacity=3, connection=self.redis)
+        self.assertEqual([0, 0, 0], [bucket.try_acquire() for _ in range(3)])
+        self.assertAlmostEqual(0.5, bucket.try_acquire(), delta=0.05)
+
+    def test_shared_between_processes(self):
+        workers = [TokenBucket("test_bucket", rate=1, capacity=2, connection=self.redis) for _ in range(2)]
+        self.assertEqual(0, workers[0].try_acquire())
+        self.assertEqual(0, workers[1].try_acquire())
+        self.assertGreater(workers[0].try_acquire(), 0)
+        self.assertGreater(workers[1].try_acquire(), 0)
+
+    def test_acquire_waits_for_refill(self):
+        bucket = TokenBucket("test_bucket", rate=100, capacity=1, connection=self.redis)
+        self.assertTrue(bucket.acquire())
+        with patch('fivedigitworldcup.ratelimit.time.sleep', wraps=time.sleep) as sleep:
+            self.assertTrue(bucket.acquire())
+            self.assertGreater(sleep.call_count, 0)
+
+    def test_acquire_timeout(self):
+        bucket = TokenBucket("test_bucket", rate=0.1, capacity=1, connection=self.redis)
+        self.assertTrue(bucket.acquire(timeout=1))
+        with patch('fivedigitworldcup.ratelimit.time.sleep') as sleep:
+            self.assertFalse(bucket.acquire(timeout=1))
+            self.assertEqual(0, sleep.call_count)
+
+    def test_reserve(self):
+        bucket = TokenBucket("test_bucket", rate=2, capacity=5, reserve=2, connection=self.redis)
+        self.assertEqual([0, 0, 0], [bucket.try_acquire() for _ in range(3)])
+        # background callers wait for the bucket to refill past the reserve, which is left to the others
+        self.assertAlmostEqual(0.5, bucket.try_acquire(), delta=0.05)
+        self.assertEqual(0, bucket.try_acquire(2, use_reserve=True))
+        self.assertAlmostEqual(1.5, bucket.try_acquire(), delta=0.05)
+
+    def test_backoff(self):
+        bucket = TokenBucket("test_bucket", rate=10, capacity=5, connection=self.redis)
+        bucket.backoff(2)
+        self.assertAlmostEqual(2.1, bucket.try_acquire(), delta=0.05)
+        bucket.backoff(1)  # doesn't shorten a longer backoff
+        self.assertAlmostEqual(2.1, bucket.try_acquire(), delta=0.05)
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("test_circuit", threshold=3, window=60, cooldown=30,
+                                      connection=fakeredis.FakeRedis())
+
+    def test_opens_after_threshold(self):
+        self.assertEqual([1, 2], [self.breaker.record_failure() for _ in range(2)])
+        self.assertEqual(0, self.breaker.retry_in())
+        self.breaker.record_failure()
+        self.assertAlmostEqual(30, self.breaker.retry_in(), delta=1)
+        self.assertTrue(self.breaker.status()['open'])
+
+    def test_success_resets_failures(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertIsNone(self.breaker.record_success())
+        self.assertEqual(1, self.breaker.record_failure())
+
+    def test_closes_and_reports_deferred(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.breaker.defer([2, 1])
+        self.breaker.defer([2])
+        self.assertEqual(2, self.breaker.status()['deferred'])
+
+        self.assertEqual([1, 2], self.breaker.record_success())
+        self.assertEqual({'open': False, 'retry_in': 0, 'failures': 0, 'tripped': None, 'deferred': 0},
+                         self.breaker.status())
+        self.assertIsNone(self.breaker.record_success())
+
+    def test_retry_after(self):
+        self.assertEqual(5, get_retry_after({"Retry-After": "5"}))
+        in_ten_seconds = email.utils.formatdate(time.time() + 10, usegmt=True)
+        self.assertAlmostEqual(10, get_retry_after({"Retry-After": in_ten_seconds}), delta=1.5)
+        self.assertIsNone(get_retry_after({}))
+        self.assertIsNone(get_retry_after({"Retry-After": "soon"}))
+
+    @patch('discord.osu_api.osu_api_breaker')
+    @patch('discord.osu_api.osu_api_limiter')
+    def test_record_response(self, mocked_limiter, mocked_breaker):
+        mocked_breaker.record_failure.side_effect = [1, 2, 3]
+        mocked_breaker.threshold, mocked_breaker.cooldown = 3, 30
+
+        self.assertEqual(5, record_response(429, {"Retry-After": "5"}))
+        mocked_limiter.backoff.assert_called_with(5)
+        # exponential without Retry-After
+        self.assertEqual(settings.OSU_API_BACKOFF_BASE * 2, record_response(502, {}))
+        # the breaker opened
+        self.assertEqual(30, record_response(503, {}))
+
+        self.assertIsNone(record_response(404, {}))
+        mocked_breaker.record_success.assert_called_once_with()
+
+
+class OsuTokenCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tokens = OsuTokenCache(renew_before=600, lock_timeout=0.2)
+        self.response = MockResponse({"token_type": "Bearer", "expires_in": 86400, "access_token": "new_token"}, 200)
+
+    def set_shared_token(self, expires_in):
+        cache.set(TOKEN_CACHE_KEY, {"access_token": "old_token", "expires_at": time.time() + expires_in}, timeout=None)
+
+    def test_local_tier(self):
+        with patch('discord.tokens.api_client.post', new=Mock(return_value=self.response)) as mocked_post:
+            self.assertEqual("new_token", self.tokens.get())
+            with patch('discord.tokens.cache.get') as mocked_cache_get:
+                self.assertEqual("new_token", self.tokens.get())
+            self.assertEqual(0, mocked_cache_get.call_count)
+        self.assertEqual(1, mocked_post.call_count)
+
+    def test_shared_tier(self):
+        self.set_shared_token(expires_in=3600)
+        with patch('discord.tokens.api_client.post') as mocked_post:
+            self.assertEqual("old_token", self.tokens.get())
+        self.assertEqual(0, mocked_post.call_count)
+
+    def test_renewed_before_expiry(self):
+        self.set_shared_token(expires_in=60)  # still valid, but within the renewal window
+        with patch('discord.tokens.api_client.post', new=Mock(return_value=self.response)):
+            self.assertEqual("new_token", self.tokens.get())
+        self.assertEqual("new_token", cache.get(TOKEN_CACHE_KEY)['access_token'])
+
+    def test_token_without_expiry_renewed(self):
+        # as cached before expiries were tracked
+        cache.set(TOKEN_CACHE_KEY, {"access_token": "old_token", "expires_in": 86400}, timeout=None)
+        with patch('discord.tokens.api_client.post', new=Mock(return_value=self.response)):
+            self.assertEqual("new_token", self.tokens.get())
+
+    def test_single_flight_renewal(self):
+        """
+        Test that while another process renews the token, the current one is used without waiting
+        """
+        self.set_shared_token(expires_in=60)
+        lock = self.tokens.connection.lock(RENEWAL_LOCK_KEY, timeout=5)
+        self.assertTrue(lock.acquire(blocking=False))
+        with patch('discord.tokens.api_client.post') as mocked_post, \
+                patch('redis.lock.mod_time.sleep') as mocked_sleep:
+            self.assertEqual("old_token", self.tokens.get())
+        self.assertEqual(0, mocked_post.call_count)
+        self.assertEqual(0, mocked_sleep.call_count)
+
+        # once renewed, every process picks up the new token
+        lock.release()
+        cache.set(TOKEN_CACHE_KEY, {"access_token": "new_token", "expires_at": time.time() + 86400}, timeout=None)
+        self.assertEqual("new_token", self.tokens.get())
+
+    def test_expired_waits_for_renewal(self):
+        self.set_shared_token(expires_in=-1)
+        lock = self.tokens.connection.lock(RENEWAL_LOCK_KEY, timeout=5)
+        self.assertTrue(lock.acquire(blocking=False))
+        with patch('discord.tokens.api_client.post') as mocked_post:
+            self.assertIsNone(self.tokens.get())  # gave up after lock_timeout
+        self.assertEqual(0, mocked_post.call_count)
+
+    def test_renew_osu_token_scheduled(self):
+        self.assertEqual("discord.tasks.renew_osu_token", settings.CELERY_BEAT_SCHEDULE['renew-osu-token']['task'])
+        self.assertLess(settings.CELERY_BEAT_SCHEDULE['renew-osu-token']['schedule'], settings.OSU_TOKEN_RENEW_BEFORE)
+
+
+class FakeOsuApiHandler(BaseHTTPRequestHandler):
+    """
+    Serves `GET /users/{id}/osu` from `users`, a dict of osu! user id -> payload, after `delay` seconds.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+    users = {}
+    unavailable = False
+    delay = 0.
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        if self.unavailable:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        match = re.fullmatch(r"/users/(\d+)/osu", self.path)
+        user = self.users.get(int(match.group(1))) if match else None
+        body = json.dumps(user if user is not None else {"error": None}).encode()
+        self.send_response(200 if user is not None else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOsuApiTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOsuApiHandler)
+        cls.server.handle_error = lambda request, client_address: None  # e.g. clients that timed out
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        FakeOsuApiHandler.users = {1: {"id": 1, "username": "player_1"}}
+        FakeOsuApiHandler.unavailable = False
+        FakeOsuApiHandler.delay = 0.
+
+
+class ApiClientTestCase(FakeOsuApiTestCase):
+    def test_connections_reused(self):
+        client = ApiClient()
+        for _ in range(3):
+            self.assertEqual("player_1", client.get(f"{self.base_url}/users/1/osu").json()['username'])
+        pool = client.get_adapter(self.base_url).poolmanager.connection_from_url(self.base_url)
+        self.assertEqual(1, pool.num_connections)
+
+    def test_timings(self):
+        client = ApiClient()
+        client.get(f"{self.base_url}/users/1/osu")
+        client.get(f"{self.base_url}/users/2/osu")
+
+        timings = client.get_timings()[f"127.0.0.1:{self.server.server_port}"]
+        self.assertEqual((2, 0), (timings['count'], timings['errors']))
+        self.assertGreater(timings['max_time'], 0)
+
+    def test_read_timeout(self):
+        FakeOsuApiHandler.delay = 0.5
+        client = ApiClient(timeout=(1, 0.05))
+        with self.assertRaises(requests.Timeout):
+            client.get(f"{self.base_url}/users/1/osu")
+        self.assertEqual(1, client.get_timings()[f"127.0.0.1:{self.server.server_port}"]['errors'])
+
+    def test_default_timeout(self):
+        with patch('requests.Session.request') as mocked_request:
+            api_client.get(f"{self.base_url}/users/1/osu")
+            api_client.get(f"{self.base_url}/users/1/osu", timeout=1)
+        self.assertEqual([(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT), 1],
+                         [call.kwargs['timeout'] for call in mocked_request.call_args_list])
+
+
+class AsyncRefresherTestCase(FakeOsuApiTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.limiter = TokenBucket("test_bucket", rate=1000, capacity=1000, connection=fakeredis.FakeRedis())
+        self.players = []
+        FakeOsuApiHandler.users = {}
+        FakeOsuApiHandler.unavailable = False
+        for osu_user_id in range(1, 6):
+            self.players.append(TournamentPlayer.objects.create(
+                user=User.objects.create(username=f"user_{osu_user_id}"),
+                osu_user_id=osu_user_id,
+                osu_stats_updated=datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)))
+            FakeOsuApiHandler.users[osu_user_id] = {
+                "id": osu_user_id,
+                "username": f"player_{osu_user_id}",
+                "statistics": {"global_rank": osu_user_id * 1000},
+                "badges": [{'awarded_at': '2023-01-19T02:08:46+00:00',
+                            'description': f"Some Tournament {i} Winning Team",
+                            'image@2x_url': f'https://assets.ppy.sh/profile-badges/some-tournament-{i}@2x.png',
+                            'image_url': f'https://assets.ppy.sh/profile-badges/some-tournament-{i}.png',
+                            'url': ''}
+                           for i in range(osu_user_id % 3)],
+            }
+
+    def test_refresh(self):
+        refresher = AsyncRefresher("TEST_VALID_TOKEN", concurrency=3, batch_size=2, base_url=self.base_url,
+                                   limiter=self.limiter)
+        clients = []
+
+        def make_client(*args, **kwargs):
+            clients.append(AsyncApiClient(*args, **kwargs))
+            return clients[-1]
+
+        with patch('discord.refresh.write_user_stats', wraps=write_user_stats) as mocked_write, \
+                patch('discord.refresh.AsyncApiClient', side_effect=make_client):
+            stats = refresher.refresh(self.players)
+
+        self.assertEqual((5, 0, 5), (stats.fetched, stats.failed, stats.changed))
+        self.assertEqual(3, mocked_write.call_count)  # batches of 2, 2 and 1
+        self.assertEqual(1, len(clients))
+        self.assertTrue(clients[0].is_closed)  # its connections don't outlive the refresh
+        self.assertEqual(5, len(stats.latencies))
+        self.assertGreater(stats.throughput, 0)
+        for player in self.players:
+            player.refresh_from_db()
+            badge_count = player.osu_user_id % 3
+            self.assertEqual(f"player_{player.osu_user_id}", player.osu_username)
+            self.assertEqual(bws(badge_count, player.osu_user_id * 1000), player.osu_rank_std_bws)
+            self.assertEqual(badge_count, player.tournamentplayerbadge_set.count())
+        self.assertEqual(2, Badge.objects.count())
+
+    def test_refresh_failures(self):
+        del FakeOsuApiHandler.users[3]
+        refresher = AsyncRefresher("TEST_VALID_TOKEN", base_url=self.base_url, limiter=self.limiter)
+        stats = refresher.refresh(self.players)
+
+        self.assertEqual((4, 1), (stats.fetched, stats.failed))
+        self.assertEqual("", TournamentPlayer.objects.get(osu_user_id=3).osu_username)
+        self.assertIn("1 failed", str(stats))
+
+    def test_refresh_coalesced(self):
+        claim_users([1])  # already pending
+        cache_users({2: {**FakeOsuApiHandler.users[2], "username": "cached_2"}})
+        refresher = AsyncRefresher("TEST_VALID_TOKEN", base_url=self.base_url, limiter=self.limiter)
+        stats = refresher.refresh(self.players)
+
+        self.assertEqual((3, 1, 1), (stats.fetched, stats.cached, stats.coalesced))
+        self.assertEqual("", TournamentPlayer.objects.get(osu_user_id=1).osu_username)
+        self.assertEqual("cached_2", TournamentPlayer.objects.get(osu_user_id=2).osu_username)
+        self.assertEqual([2, 3, 4, 5], claim_users([2, 3, 4, 5]))
+
+    @patch.object(osu_api_breaker, 'threshold', 2)
+    def test_refresh_deferred_when_breaker_opens(self):
+        FakeOsuApiHandler.unavailable = True
+        refresher = AsyncRefresher("TEST_VALID_TOKEN", concurrency=1, base_url=self.base_url, limiter=self.limiter)
+        stats = refresher.refresh(self.players)
+
+        self.assertEqual((0, 0, 5), (stats.fetched, stats.failed, stats.deferred))
+        self.assertEqual(2, len(stats.latencies))  # the first player was tried again before the circuit opened
+        self.assertEqual(5, osu_api_breaker.status()['deferred'])
+
+    @patch("discord.tasks.get_osu_token")
+    def test_refresh_users_command(self, mocked_get_osu_token):
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        out = StringIO()
+        with self.settings(OSU_API_ENDPOINT=self.base_url):
+            with patch('discord.refresh.osu_api_limiter', new=self.limiter):
+                call_command("refresh_users", "1", "2", stdout=out)
+        self.assertIn("2 fetched", out.getvalue())
+        self.assertEqual("player_1", TournamentPlayer.objects.get(osu_user_id=1).osu_username)
+
+    @patch("discord.tasks.get_osu_token")
+    def test_update_user(self, mocked_get_osu_token):
+        mocked_get_osu_token.return_value = "TEST_VALID_TOKEN"
+        with self.settings(OSU_API_ENDPOINT=self.base_url):
+            with patch('discord.tasks.osu_api_limiter', new=self.limiter):
+                tasks.update_user(1)
+        self.assertEqual("player_1", TournamentPlayer.objects.get(osu_user_id=1).osu_username)
 
 
 class ReturnBadgesOnDetailViewTestCase(TestCase):
@@ -292,12 +1043,14 @@ class ReturnBadgesOnDetailViewTestCase(TestCase):
 
     def create_badges_in_db(self, badges):
         for badge in badges:
-            TournamentPlayerBadge.objects.create(user=self.test_tourney_player,
+            catalog_badge = Badge.objects.create(key=Badge.make_key(badge['description'], badge['image_url']),
                                                  description=badge['description'],
-                                                 award_date=datetime.datetime.fromisoformat(badge['awarded_at']),
                                                  url=badge['url'],
                                                  image_url=badge['image_url'],
                                                  image_url_2x=badge['image_url_2x'])
+            TournamentPlayerBadge.objects.create(user=self.test_tourney_player,
+                                                 badge=catalog_badge,
+                                                 award_date=datetime.datetime.fromisoformat(badge['awarded_at']))
 
     def test_badges_present_in_details_empty(self):
         request = self.request_factory.get(f'/registrants/{self.test_user.pk}/')
@@ -395,6 +1148,25 @@ class ReturnBadgesOnDetailViewTestCase(TestCase):
         self.assertEqual(len(self.sample_badges), len(response.data['badges']))
         self.assertCountEqual(self.sample_badges, response.data['badges'])
 
+    def test_badges_ineligible_excluded(self):
+        self.create_badges_in_db(self.sample_badges)
+        description = "Outstanding contribution to the osu! tournament scene"
+        TournamentPlayerBadge.objects.create(user=self.test_tourney_player,
+                                             badge=Badge.objects.create(key=Badge.make_key(description, ""),
+                                                                        description=description,
+                                                                        image_url="",
+                                                                        image_url_2x="",
+                                                                        is_eligible=False),
+                                             award_date=datetime.datetime.now(datetime.timezone.utc))
+
+        request = self.request_factory.get(f'/registrants/{self.test_user.pk}/')
+        registrant_detail = TournamentPlayerViewSet.as_view({'get': 'retrieve'})
+        with self.assertNumQueries(2):  # player and eligible badges
+            response = registrant_detail(request, pk=self.test_user.pk)
+
+        self.assertCountEqual(self.sample_badges, response.data['badges'])
+        self.assertEqual(len(self.sample_badges), response.data['filtered_badges_count'])
+
     def test_badges_not_present_in_list(self):
         self.create_badges_in_db(self.sample_badges)
 
@@ -456,3 +1228,108 @@ class UpdateTournamentPlayerRolesTestCase(TestCase):
         res = set_tourney_user_staff(request, pk=self.tourney_user.discord_user_id)
 
         self.assertEqual(400, res.status_code)
+
+
+class RegistrantsListQueryCountTestCase(TestCase):
+    def setUp(self):
+        self.team = TournamentTeam.objects.create(osu_flag="NZ")
+        self.organizer = self.create_player(1, is_organizer=True)
+
+    def create_player(self, pk, **kwargs):
+        user = User.objects.create(pk=pk, username=f"user_{pk}")
+        return TournamentPlayer.objects.create(user=user,
+                                               team=self.team,
+                                               osu_user_id=pk,
+                                               discord_user_id=pk,
+                                               osu_stats_updated=datetime.datetime.now(tz=datetime.timezone.utc),
+                                               **kwargs)
+
+    def count_list_queries(self):
+        request = APIRequestFactory().get('/registrants/')
+        request.user = User.objects.get(pk=self.organizer.pk)
+        list_view = TournamentPlayerViewSet.as_view({'get': 'list'})
+        with CaptureQueriesContext(connection) as queries:
+            response = list_view(request)
+        self.assertEqual(200, response.status_code)
+        return len(response.data['results']), len(queries)
+
+    def test_list_query_count_independent_of_row_count(self):
+        rows_few, queries_few = self.count_list_queries()
+
+        for pk in range(2, 30):
+            self.create_player(pk)
+        rows_many, queries_many = self.count_list_queries()
+
+        self.assertLess(rows_few, rows_many)
+        self.assertEqual(queries_few, queries_many)
+
+    def test_retrieve_query_count(self):
+        request = APIRequestFactory().get(f'/registrants/{self.organizer.pk}/')
+        request.user = User.objects.get(pk=self.organizer.pk)
+        detail_view = TournamentPlayerViewSet.as_view({'get': 'retrieve'})
+        # player lookup, organizer's own player and badges
+        with self.assertNumQueries(3):
+            response = detail_view(request, pk=self.organizer.pk)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('in_roster', response.data)
+
+
+class RegistrantsCursorPaginationTestCase(TestCase):
+    def setUp(self):
+        self.team = TournamentTeam.objects.create(osu_flag="KR")
+        self.players = []
+        for pk, bws in enumerate([500, 20, 3000, 20, 1, 4000, 700]):
+            user = User.objects.create(pk=pk + 1, username=f"user_{pk + 1}")
+            self.players.append(TournamentPlayer.objects.create(
+                user=user,
+                team=self.team,
+                osu_user_id=pk + 1,
+                discord_user_id=pk + 1,
+                osu_rank_std_bws=bws,
+                osu_stats_updated=datetime.datetime.now(tz=datetime.timezone.utc)
+            ))
+
+    def walk_pages(self, query):
+        list_view = TournamentPlayerViewSet.as_view({'get': 'list'})
+        pages = []
+        url = f'/registrants/{query}'
+        while url is not None:
+            response = list_view(APIRequestFactory().get(url))
+            self.assertEqual(200, response.status_code)
+            pages.append(response.data)
+            url = response.data['next']
+        return pages
+
+    def test_page_number_pagination_is_default(self):
+        pages = self.walk_pages('?limit=3')
+        self.assertEqual(3, len(pages))
+        self.assertEqual(len(self.players), pages[0]['count'])
+
+    def test_cursor_pagination_by_pk(self):
+        pages = self.walk_pages('?pagination=cursor&limit=3')
+
+        self.assertEqual(3, len(pages))
+        self.assertEqual(len(self.players), pages[0]['count'])
+        self.assertEqual([player.pk for player in self.players],
+                         [player['user_id'] for page in pages for player in page['results']])
+
+    def test_cursor_pagination_by_bws(self):
+        pages = self.walk_pages('?pagination=cursor&limit=2&ordering=osu_rank_std_bws&count=false')
+
+        expected = sorted(self.players, key=lambda player: (player.osu_rank_std_bws, player.pk))
+        self.assertNotIn('count', pages[0])
+        self.assertEqual([player.pk for player in expected],
+                         [player['user_id'] for page in pages for player in page['results']])
+
+    def test_cursor_pagination_by_bws_with_nulls(self):
+        TournamentPlayer.objects.filter(pk__in=[2, 5, 6]).update(osu_rank_std_bws=None)
+        pages = self.walk_pages('?pagination=cursor&limit=1&ordering=osu_rank_std_bws&count=false')
+
+        # players without BWS come last, page boundaries fall on them
+        self.assertEqual([4, 1, 7, 3, 2, 5, 6], [player['user_id'] for page in pages for player in page['results']])
+
+    def test_cursor_pagination_query_count(self):
+        list_view = TournamentPlayerViewSet.as_view({'get': 'list'})
+        with self.assertNumQueries(1):
+            response = list_view(APIRequestFactory().get('/registrants/?pagination=cursor&count=false'))
+        self.assertEqual(len(self.players), len(response.data['results']))
@@ -0,0 +1,98 @@
+import logging
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+from fivedigitworldcup.http import api_client
+from fivedigitworldcup.ratelimit import osu_api_limiter
+
+
+logger = logging.getLogger(__name__)
+TOKEN_CACHE_KEY = "osu_token:v2"  # "osu_token" held tokens without `expires_at`
+RENEWAL_LOCK_KEY = "osu_token:renewal"
+
+
+class OsuTokenCache:
+    """
+    osu! API client credentials token, kept in this process and in the cache shared by every worker.
+
+    The in-process copy is used without going to Redis until the token is within `renew_before` seconds of expiring.
+    From then on, the first process to take the renewal lock requests a new token while the others keep using the
+    current one, so a single `POST /oauth/token` is made and nobody waits for it. Only without any valid token do
+    processes wait for the lock holder, up to `lock_timeout` seconds.
+    """
+
+    def __init__(self, renew_before: float = None, lock_timeout: float = 10., connection=None):
+        self.renew_before = renew_before if renew_before is not None else settings.OSU_TOKEN_RENEW_BEFORE
+        self.lock_timeout = lock_timeout
+        self.local_token = None
+        if connection is not None:
+            self.connection = connection
+
+    @cached_property
+    def connection(self):
+        return get_redis_connection("default")
+
+    def is_valid(self, token: dict | None, margin: float = 0) -> bool:
+        return token is not None and 'expires_at' in token and time.time() < token['expires_at'] - margin
+
+    def get(self) -> str | None:
+        """
+        :return: a valid access token, None if none could be obtained
+        """
+        if self.is_valid(self.local_token, self.renew_before):
+            return self.local_token['access_token']
+        token = cache.get(TOKEN_CACHE_KEY)
+        if self.is_valid(token, self.renew_before):
+            self.local_token = token
+            return token['access_token']
+
+        lock = self.connection.lock(RENEWAL_LOCK_KEY, timeout=self.lock_timeout)
+        if lock.acquire(blocking=not self.is_valid(token), blocking_timeout=self.lock_timeout):
+            try:
+                # the previous lock holder may have renewed it already
+                if not self.is_valid(renewed := cache.get(TOKEN_CACHE_KEY), self.renew_before):
+                    renewed = self.request_token()
+                if renewed is not None:
+                    token = self.local_token = renewed
+            finally:
+                try:
+                    lock.release()
+                except LockError:  # expired while renewing
+                    pass
+        return token['access_token'] if self.is_valid(token) else None
+
+    def request_token(self) -> dict | None:
+        logger.warning("fetching new osu! token")
+        osu_api_limiter.acquire(use_reserve=True)  # every task waits on it
+        try:
+            r = api_client.post(f"{settings.OSU_OAUTH_ENDPOINT}/token", {
+                "client_id": settings.OSU_CLIENT_ID,
+                "client_secret": settings.OSU_CLIENT_SECRET,
+                "grant_type": "client_credentials",
+                "scope": "public"
+            }, timeout=self.lock_timeout)
+        except requests.RequestException as e:
+            logger.warning(f"[get_osu_token] {e}")
+            return None
+        if r.status_code != 200:
+            logger.warning(f"[get_osu_token] got status code {r.status_code}")
+            return None
+        response_data = r.json()
+        token = {**response_data, 'expires_at': time.time() + response_data['expires_in']}
+        cache.set(TOKEN_CACHE_KEY, token, timeout=response_data['expires_in'])
+        return token
+
+    def forget(self):
+        """
+        Drop the in-process copy, the next call reads the shared one again.
+        """
+        self.local_token = None
+
+
+osu_token = OsuTokenCache()
@@ -2,8 +2,8 @@ import datetime
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
-from django.core.cache import cache
 from django.http import Http404
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from rest_framework import exceptions, permissions, serializers, status, viewsets
 from rest_framework.authentication import TokenAuthentication
@@ -12,9 +12,15 @@ from rest_framework.exceptions import ValidationError
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 
 from discord import tasks
-from userauth.authentication import filter_badges, IsSuperUser
+from discord.coalescing import PRIORITY_LANE, claim_users
+from discord.jobs import RefreshJob
+from fivedigitworldcup.circuitbreaker import osu_api_breaker
+from fivedigitworldcup.http import api_client
+from fivedigitworldcup.pagination import get_paginator
+from userauth.authentication import BADGE_CUTOFF_DATE, IsSuperUser
 from userauth.models import TournamentPlayer, TournamentPlayerBadge
 
 
@@ -35,18 +41,55 @@ class PreSharedKeyAuthentication(TokenAuthentication, BasePermission):
         return None, key
 
 
-class TeamOrganizer(BasePermission):
-    def has_object_permission(self, request, view, obj):
-        if isinstance(request.user, AnonymousUser):
-            return False
+class RequestPermissions:
+    """
+    Permissions of the requesting user that do not depend on the object being looked at.
+
+    Resolved lazily at most once per request and cached on the request object, so serializing many players only
+    costs a set lookup per row instead of re-running authentication and reloading the requesting player.
+    """
+    _request_attr = '_tournament_permissions'
+
+    def __init__(self, request):
+        self._request = request
+
+    @classmethod
+    def for_request(cls, request):
+        request_permissions = getattr(request, cls._request_attr, None)
+        if request_permissions is None:
+            request_permissions = cls(request)
+            setattr(request, cls._request_attr, request_permissions)
+        return request_permissions
+
+    @cached_property
+    def is_admin(self) -> bool:
+        return (IsSuperUser | PreSharedKeyAuthentication)().has_permission(self._request, None)
+
+    @cached_property
+    def organized_team_ids(self) -> frozenset[str]:
+        user = self._request.user
+        if user is None or isinstance(user, AnonymousUser):
+            return frozenset()
         try:
-            tourney_player = request.user.tournamentplayer
+            tourney_player = user.tournamentplayer
         except TournamentPlayer.DoesNotExist:
-            return False
-        if not tourney_player.is_organizer or tourney_player.team != obj:
-            return False
+            return frozenset()
+        if not tourney_player.is_organizer:
+            return frozenset()
+        return frozenset((tourney_player.team_id, ))
+
+    def organizes(self, team_id) -> bool:
+        return team_id in self.organized_team_ids
 
-        return True
+    def can_view_roster(self, team_id) -> bool:
+        return self.is_admin or self.organizes(team_id)
+
+
+class TeamOrganizer(BasePermission):
+    def has_object_permission(self, request, view, obj):
+        if obj is None:
+            return False
+        return RequestPermissions.for_request(request).organizes(obj.pk)
 
 
 class TournamentPlayerSerializer(serializers.HyperlinkedModelSerializer):
@@ -56,14 +99,41 @@ class TournamentPlayerSerializer(serializers.HyperlinkedModelSerializer):
     rank_standard = serializers.ReadOnlyField(source='osu_rank_std')
     rank_standard_bws = serializers.ReadOnlyField(source='osu_rank_std_bws')
 
+    # query plan for querysets rendered by this serializer, applied through `setup_eager_loading`
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    only_fields = ('user_id',
+                   'discord_user_id',
+                   'discord_username',
+                   'osu_user_id',
+                   'osu_username',
+                   'osu_flag',
+                   'osu_stats_updated',
+                   'osu_rank_std',
+                   'osu_rank_std_bws',
+                   'is_organizer',
+                   'is_captain',
+                   'in_roster',
+                   'in_backup_roster',
+                   'team')
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """
+        Apply this serializer's query plan so that serializing `queryset` runs a fixed number of queries no matter
+        how many rows it contains.
+        """
+        return (queryset
+                .select_related(*cls.select_related_fields)
+                .prefetch_related(*cls.prefetch_related_fields)
+                .only(*cls.only_fields))
+
     def to_representation(self, instance):
         representation = super(TournamentPlayerSerializer, self).to_representation(instance=instance)
 
-        request = self._context['request']
         # kinda don't like that I have to put these conditions here, but it is what it is
-        has_admin_perms = (IsSuperUser | PreSharedKeyAuthentication)().has_permission(request, None)
-        has_team_perms = TeamOrganizer().has_object_permission(request, None, instance.team)
-        if not has_admin_perms and not has_team_perms:
+        request_permissions = RequestPermissions.for_request(self._context['request'])
+        if not request_permissions.can_view_roster(instance.team_id):
             del representation['is_captain']
             del representation['in_roster']
             del representation['in_backup_roster']
@@ -93,6 +163,10 @@ class TournamentPlayerSerializer(serializers.HyperlinkedModelSerializer):
 class BadgeSerializer(serializers.HyperlinkedModelSerializer):
     # awarded_at = serializers.DateTimeField(source='award_date', format='%Y-%m-%dT%H:%M:%S%:z')  # %:z does not work
     awarded_at = serializers.SerializerMethodField()
+    description = serializers.CharField(source='badge.description')
+    url = serializers.CharField(source='badge.url')
+    image_url = serializers.CharField(source='badge.image_url')
+    image_url_2x = serializers.CharField(source='badge.image_url_2x')
 
     @staticmethod
     def get_awarded_at(badge):
@@ -118,19 +192,21 @@ class TournamentPlayerSerializerWithBadges(TournamentPlayerSerializer):
         return representation
 
     def get_badges(self, tournament_player: TournamentPlayer):
-        serializer = BadgeSerializer(instance=TournamentPlayerBadge.objects.filter(user=tournament_player),
-                                     many=True,
-                                     read_only=True,
-                                     source='tournamentplayerbadge_set')
-        unfiltered_badges = serializer.data
         cutoff_date = self.context['request'].query_params.get('badge_cutoff_date', None)
         if cutoff_date is not None:
             try:
                 cutoff_date = datetime.datetime.fromtimestamp(int(cutoff_date), tz=datetime.timezone.utc)
             except ValueError:
                 raise ValueError("Invalid badge_cutoff_date provided, please provide a unix timestamp")
-            return filter_badges(unfiltered_badges, [], cutoff_date=cutoff_date)
-        return filter_badges(unfiltered_badges, [])  # use default cutoff
+        else:
+            cutoff_date = BADGE_CUTOFF_DATE  # use default cutoff
+
+        # eligibility is stored in the badge catalog, the cutoff is an index range on (user, award_date)
+        badges = (TournamentPlayerBadge.objects
+                  .filter(user=tournament_player, award_date__gt=cutoff_date, badge__is_eligible=True)
+                  .select_related('badge'))
+        serializer = BadgeSerializer(instance=badges, many=True, read_only=True)
+        return serializer.data
 
     class Meta(TournamentPlayerSerializer.Meta):
         fields = TournamentPlayerSerializer.Meta.fields + ['badges', ]
@@ -141,6 +217,15 @@ class TournamentPlayerViewSet(viewsets.ModelViewSet):
     queryset_include_staff = TournamentPlayer.objects.all()
     permission_classes = [PreSharedKeyAuthentication | ReadOnly]
 
+    @property
+    def paginator(self):
+        """
+        Page-number pagination by default, keyset pagination when the client opts in with `?pagination=cursor`.
+        """
+        if not hasattr(self, '_paginator'):
+            self._paginator = get_paginator(self.request, self.pagination_class)
+        return self._paginator
+
     def handle_exception(self, exc):
         if isinstance(exc, Http404) and str(exc):
             return Response({'detail': str(exc)},
@@ -156,21 +241,53 @@ class TournamentPlayerViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, permission_classes=[PreSharedKeyAuthentication | IsSuperUser], methods=["POST"])
     def update_all_users(self, request):
-        queue_len = cache.get("osu_queue_length", 0)
-        if queue_len > 0:
-            return Response({"message": f"update tasks queue is not empty, {queue_len} tasks remaining"},
+        if (active_job := RefreshJob.get_active()) is not None:
+            job_status = active_job.status()
+            return Response({"message": f"update job {active_job.id} is still running, "
+                                        f"{job_status['remaining']} users remaining",
+                             "job": job_status},
                             status=status.HTTP_429_TOO_MANY_REQUESTS)
-        tasks.update_users.delay()
-        return Response({"message": "Scheduled all users to be updated"})
+        # `?badges=false` looks users up in batches and keeps their stored badges, for quick rank refreshes
+        badges = request.query_params.get("badges", "true").lower() not in ("false", "0", "no")
+        job = RefreshJob.create()
+        tasks.update_users.delay(badges=badges, job_id=job.id)
+        return Response({"message": "Scheduled all users to be updated",
+                         "job": job.status(),
+                         "status_url": reverse('tournamentplayer-job-status', args=[job.id], request=request)})
+
+    @action(detail=False, permission_classes=[PreSharedKeyAuthentication | IsSuperUser],
+            url_path=r'jobs/(?P<job_id>[0-9a-f]{32})', url_name='job-status')
+    def job_status(self, request, job_id=None):
+        job_status = RefreshJob(job_id).status()
+        if job_status is None:
+            return Response({"error": f"no update job {job_id}"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({**job_status,
+                         # while the circuit breaker is open, the job's remaining users are deferred until it closes
+                         "osu_api": osu_api_breaker.status(),
+                         # request timings of this process, the workers log theirs with every batch
+                         "http": api_client.get_timings()})
+
+    @action(detail=False, permission_classes=[PreSharedKeyAuthentication | IsSuperUser], methods=["POST"])
+    def recompute_bws(self, request):
+        tasks.recompute_all_bws.delay()
+        return Response({"message": "Scheduled BWS to be recomputed for all users"})
 
     @action(detail=True, permission_classes=[PreSharedKeyAuthentication | IsSuperUser], methods=["POST"])
     def update_user(self, request, **kwargs):
-        queue_len = cache.get("osu_queue_length", 0)
-
         tournament_player = self.get_object()
+        # an on-demand refresh that is already pending covers this one, bulk ones don't as they may be far behind
+        if not claim_users([tournament_player.osu_user_id], lane=PRIORITY_LANE):
+            return Response({"message": f"{tournament_player.osu_username} ({tournament_player.osu_user_id}) "
+                                        f"is already scheduled for update.",
+                             "coalesced": True})
+        # routed to the priority queue, ahead of bulk refreshes
         tasks.update_user.delay(tournament_player.osu_user_id)
+        queue_position = tasks.get_queue_length(settings.OSU_PRIORITY_QUEUE)
         return Response({"message": f"Scheduled {tournament_player.osu_username} ({tournament_player.osu_user_id}) "
-                                    f"for update. {queue_len + 1} tasks in queue"})
+                                    f"for update, position {queue_position} in the priority queue.",
+                         "coalesced": False,
+                         "queue": settings.OSU_PRIORITY_QUEUE,
+                         "queue_position": queue_position})
 
     # todo: this should really go...
     def retrieve(self, request, *args, **kwargs):
@@ -181,10 +298,13 @@ class TournamentPlayerViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self, include_staff=False):
         if not include_staff:
-            return super().get_queryset()
+            queryset = super().get_queryset()
+        else:
+            # Ensure queryset is re-evaluated on each request.
+            queryset = self.queryset_include_staff.all()
 
-        # Ensure queryset is re-evaluated on each request.
-        queryset = self.queryset_include_staff.all()
+        if self.action in ("list", "retrieve"):
+            queryset = self.get_serializer_class().setup_eager_loading(queryset)
         return queryset
 
     def get_object(self, include_staff=False):
@@ -0,0 +1,120 @@
+import logging
+import time
+from typing import Iterable
+
+from django.conf import settings
+from django.utils.functional import cached_property
+from django_redis import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker kept in Redis, shared by every process that uses the same `key`.
+
+    `threshold` consecutive failures (without a success in between, and each within `window` seconds of the previous
+    one) open the circuit for `cooldown` seconds, during which callers should defer their work instead of calling the
+    failing service. Once the cooldown is over the next call goes through: a failure opens the circuit again right
+    away, a success closes it and reports the work deferred in the meantime.
+    """
+
+    def __init__(self, key: str, threshold: int, window: float, cooldown: float, connection=None):
+        self.key = key
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        if connection is not None:
+            self.connection = connection
+
+    @cached_property
+    def connection(self):
+        return get_redis_connection("default")
+
+    @property
+    def failures_key(self):
+        return f"{self.key}:failures"
+
+    @property
+    def open_key(self):
+        return f"{self.key}:open"
+
+    @property
+    def tripped_key(self):
+        return f"{self.key}:tripped"
+
+    @property
+    def deferred_key(self):
+        return f"{self.key}:deferred"
+
+    def retry_in(self) -> float:
+        """
+        :return: seconds until the circuit closes, 0 if it is closed
+        """
+        return max(self.connection.pttl(self.open_key), 0) / 1000
+
+    def record_failure(self) -> int:
+        """
+        Count a failed call, opening the circuit if that makes `threshold` failures.
+        :return: number of consecutive failures
+        """
+        pipeline = self.connection.pipeline()
+        pipeline.incr(self.failures_key)
+        pipeline.expire(self.failures_key, int(self.window))
+        failures, _ = pipeline.execute()
+        if failures >= self.threshold:
+            pipeline = self.connection.pipeline()
+            pipeline.set(self.open_key, failures, px=int(self.cooldown * 1000))
+            pipeline.set(self.tripped_key, time.time(), nx=True)
+            pipeline.execute()
+            logger.warning(f"[circuit breaker] {self.key} open for {self.cooldown}s after {failures} failures")
+        return failures
+
+    def record_success(self) -> list[int] | None:
+        """
+        Count a successful call, closing the circuit if it had been opened.
+        :return: ids deferred while it was open if this closed it, otherwise None
+        """
+        pipeline = self.connection.pipeline()
+        pipeline.get(self.tripped_key)
+        pipeline.smembers(self.deferred_key)
+        pipeline.delete(self.failures_key, self.open_key, self.tripped_key, self.deferred_key)
+        tripped, deferred, _ = pipeline.execute()
+        if tripped is None:
+            return None
+        deferred = sorted(int(deferred_id) for deferred_id in deferred)
+        logger.warning(f"[circuit breaker] {self.key} closed after {time.time() - float(tripped):.0f}s, "
+                       f"{len(deferred)} deferred")
+        return deferred
+
+    def defer(self, ids: Iterable[int]):
+        """
+        Note work put off while the circuit is open, to report when it closes.
+        """
+        if ids := list(ids):
+            pipeline = self.connection.pipeline()
+            pipeline.sadd(self.deferred_key, *ids)
+            pipeline.expire(self.deferred_key, 60 * 60 * 24)
+            pipeline.execute()
+
+    def status(self) -> dict:
+        pipeline = self.connection.pipeline()
+        pipeline.pttl(self.open_key)
+        pipeline.get(self.failures_key)
+        pipeline.get(self.tripped_key)
+        pipeline.scard(self.deferred_key)
+        open_ttl, failures, tripped, deferred = pipeline.execute()
+        return {
+            'open': open_ttl > 0,
+            'retry_in': max(open_ttl, 0) / 1000,
+            'failures': int(failures or 0),
+            'tripped': float(tripped) if tripped is not None else None,
+            'deferred': deferred,
+        }
+
+
+osu_api_breaker = CircuitBreaker("circuit:osu_api",
+                                 threshold=settings.OSU_API_BREAKER_THRESHOLD,
+                                 window=settings.OSU_API_BREAKER_WINDOW,
+                                 cooldown=settings.OSU_API_BREAKER_COOLDOWN)
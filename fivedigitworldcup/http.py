@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import http.cookiejar
+import logging
+import threading
+import time
+import urllib.parse
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimings:
+    """
+    Number and duration of the requests made to one host.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0  # connection errors and timeouts, not error responses
+        self.total_time = 0.
+        self.max_time = 0.
+
+    def record(self, elapsed: float, error: bool):
+        self.count += 1
+        self.errors += error
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean_time': self.total_time / self.count if self.count else 0.,
+            'max_time': self.max_time,
+        }
+
+
+class TimedClientMixin:
+    """
+    Request timings per host, for HTTP clients.
+    """
+
+    def init_timings(self):
+        self.timings = collections.defaultdict(RequestTimings)
+        self.timings_lock = threading.Lock()
+
+    def record_timing(self, method: str, url: str, elapsed: float, error: bool):
+        split_url = urllib.parse.urlsplit(str(url))
+        with self.timings_lock:
+            self.timings[split_url.netloc].record(elapsed, error)
+        logger.debug(f"[http] {method} {split_url.netloc}{split_url.path} "
+                     f"{'failed' if error else 'took'} {elapsed * 1000:.0f}ms")
+
+    def get_timings(self) -> dict[str, dict]:
+        """
+        :return: dict of host -> request count, connection errors and timings in seconds, since the client was created
+        """
+        with self.timings_lock:
+            return {host: timings.as_dict() for host, timings in self.timings.items()}
+
+
+class ApiClient(TimedClientMixin, requests.Session):
+    """
+    HTTP session shared by everything in the process that calls the osu! or Discord APIs.
+
+    Connections are kept alive and pooled, keeping up to `pool_maxsize` per host. Requests get `timeout` (connect,
+    read) unless they pass their own, and their timings are recorded per host, see `get_timings`. Cookies are never
+    stored since the session is shared by the requests of every user.
+    """
+
+    def __init__(self, timeout: tuple[float, float] = None, pool_maxsize: int = None):
+        super().__init__()
+        self.timeout = timeout or (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize or settings.HTTP_POOL_MAXSIZE)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        self.init_timings()
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start_time = time.perf_counter()
+        error = True
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            error = False
+            return response
+        finally:
+            self.record_timing(method, url, time.perf_counter() - start_time, error)
+
+
+class AsyncApiClient(TimedClientMixin, httpx.AsyncClient):
+    """
+    `ApiClient` for async views, with the same timeouts and cookie handling. httpx has no per-host pool limit, up to
+    `pool_maxsize` connections are kept alive in total.
+    """
+
+    def __init__(self, timeout: tuple[float, float] = None, pool_maxsize: int = None):
+        connect_timeout, read_timeout = timeout or (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+        super().__init__(timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                         limits=httpx.Limits(max_keepalive_connections=pool_maxsize or settings.HTTP_POOL_MAXSIZE))
+        self.cookies.jar.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        self.init_timings()
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        start_time = time.perf_counter()
+        error = True
+        try:
+            response = await super().send(request, **kwargs)
+            error = False
+            return response
+        finally:
+            self.record_timing(request.method, request.url, time.perf_counter() - start_time, error)
+
+
+api_client = ApiClient()
+async_api_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncApiClient
+
+
+def get_async_api_client() -> AsyncApiClient:
+    """
+    The process' `AsyncApiClient` for the running event loop, as its connections can't be shared between loops.
+    """
+    loop = asyncio.get_running_loop()
+    if (client := async_api_clients.get(loop)) is None:
+        client = async_api_clients[loop] = AsyncApiClient()
+    return client
@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.utils.functional import cached_property
+from django_redis import get_redis_connection
+
+
+# Refill the bucket for the time elapsed since the last call. Redis' clock is used so that every worker agrees on the
+# elapsed time. Tokens go negative while backing off.
+REFILL = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+"""
+
+# Keep the bucket until it would be full again
+SAVE = """
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+"""
+
+# Take `requested` tokens if there are enough, leaving `reserve` tokens in the bucket. Returns the seconds to wait
+# before enough tokens are available (0 if they were taken), as a string since Lua numbers are truncated to integers
+# on return.
+TOKEN_BUCKET_SCRIPT = REFILL + """
+local requested = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local wait = 0
+if tokens - reserve >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested + reserve - tokens) / rate
+end
+""" + SAVE + """
+return tostring(wait)
+"""
+
+# Empty the bucket so that the next token is only available in `delay` seconds, unless it already was for longer.
+BACKOFF_SCRIPT = REFILL + """
+tokens = math.min(tokens, -tonumber(ARGV[3]) * rate)
+""" + SAVE
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter kept in Redis, shared by every process that uses the same `key`.
+
+    The bucket holds up to `capacity` tokens and refills at `rate` tokens per second; each call takes one token.
+    `reserve` tokens are kept for callers passing `use_reserve`, e.g. users waiting on a response: other callers wait
+    for the bucket to refill past the reserve, so they can't drain it and always yield to those that can use it.
+    """
+
+    def __init__(self, key: str, rate: float, capacity: int, reserve: int = 0, connection=None):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = reserve
+        if connection is not None:
+            self.connection = connection
+
+    @cached_property
+    def connection(self):
+        return get_redis_connection("default")
+
+    @cached_property
+    def _script(self):
+        return self.connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+    @cached_property
+    def _backoff_script(self):
+        return self.connection.register_script(BACKOFF_SCRIPT)
+
+    def try_acquire(self, tokens: int = 1, use_reserve: bool = False) -> float:
+        """
+        Take `tokens` from the bucket if there are enough.
+        :param use_reserve: whether the reserved tokens can be taken too
+        :return: 0 if the tokens were taken, otherwise the seconds to wait before trying again
+        """
+        reserve = 0 if use_reserve else self.reserve
+        return float(self._script(keys=[self.key], args=[self.rate, self.capacity, tokens, reserve]))
+
+    def acquire(self, tokens: int = 1, timeout: float = None, use_reserve: bool = False) -> bool:
+        """
+        Block until `tokens` are taken from the bucket.
+        :param timeout: give up after this many seconds, wait indefinitely if None
+        :return: whether the tokens were taken
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while (wait := self.try_acquire(tokens, use_reserve)) > 0:
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+        return True
+
+    async def async_acquire(self, tokens: int = 1, timeout: float = None, use_reserve: bool = False) -> bool:
+        """
+        `acquire` for coroutines: Redis is called from a worker thread and waits don't block the event loop.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while (wait := await asyncio.to_thread(self.try_acquire, tokens, use_reserve)) > 0:
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+    def backoff(self, delay: float):
+        """
+        Hold back every caller for `delay` seconds, e.g. after being told to slow down.
+        """
+        self._backoff_script(keys=[self.key], args=[self.rate, self.capacity, delay])
+
+
+osu_api_limiter = TokenBucket("ratelimit:osu_api",
+                              rate=settings.OSU_API_RATE_LIMIT,
+                              capacity=settings.OSU_API_RATE_LIMIT_BURST,
+                              reserve=settings.OSU_API_RATE_LIMIT_RESERVE)
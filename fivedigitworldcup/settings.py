@@ -256,6 +256,41 @@ OSU_OAUTH_ENDPOINT = "https://osu.ppy.sh/oauth"
 OSU_CLIENT_ID = os.environ.get("OSU_CLIENT_ID", None)
 OSU_CLIENT_SECRET = os.environ.get("OSU_CLIENT_SECRET", None)
 OSU_REDIRECT_URI_SUFFIX = "/auth/osu/code"
+# outbound requests to the osu! and Discord APIs, see fivedigitworldcup.http
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05))  # seconds
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 10))  # seconds
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 10))  # kept-alive connections per host
+# shared by every process calling the osu! API, see fivedigitworldcup.ratelimit
+OSU_API_RATE_LIMIT = float(os.environ.get("OSU_API_RATE_LIMIT", 2))  # requests per second
+OSU_API_RATE_LIMIT_BURST = int(os.environ.get("OSU_API_RATE_LIMIT_BURST", 5))
+OSU_API_RATE_LIMIT_TIMEOUT = float(os.environ.get("OSU_API_RATE_LIMIT_TIMEOUT", 5))  # max wait in user-facing views
+# tokens background refreshes leave in the bucket for logins and token renewals, which always go first. Kept below
+# OSU_API_RATE_LIMIT_BURST
+OSU_API_RATE_LIMIT_RESERVE = int(os.environ.get("OSU_API_RATE_LIMIT_RESERVE", 2))
+# 429s and 5xx back the limiter off for their Retry-After, or exponentially up to OSU_API_BACKOFF_MAX seconds. Enough
+# of them in a row open a circuit breaker that defers refreshes for a while, see fivedigitworldcup.circuitbreaker
+OSU_API_BACKOFF_BASE = float(os.environ.get("OSU_API_BACKOFF_BASE", 1))
+OSU_API_BACKOFF_MAX = float(os.environ.get("OSU_API_BACKOFF_MAX", 60))
+OSU_API_MAX_RETRIES = int(os.environ.get("OSU_API_MAX_RETRIES", 5))  # per refresh, outages don't count
+OSU_API_BREAKER_THRESHOLD = int(os.environ.get("OSU_API_BREAKER_THRESHOLD", 5))
+OSU_API_BREAKER_WINDOW = int(os.environ.get("OSU_API_BREAKER_WINDOW", 60))  # seconds
+OSU_API_BREAKER_COOLDOWN = int(os.environ.get("OSU_API_BREAKER_COOLDOWN", 2 * 60))  # seconds
+# client credentials tokens are renewed this many seconds before they expire, see discord.tokens
+OSU_TOKEN_RENEW_BEFORE = int(os.environ.get("OSU_TOKEN_RENEW_BEFORE", 10 * 60))
+
+# staleness-driven refreshes, see discord.scheduling. All durations in seconds
+REFRESH_SCHEDULE_INTERVAL = int(os.environ.get("REFRESH_SCHEDULE_INTERVAL", 10 * 60))
+REFRESH_MAX_AGE = int(os.environ.get("REFRESH_MAX_AGE", 24 * 60 * 60))
+REFRESH_MAX_AGE_ROSTER = int(os.environ.get("REFRESH_MAX_AGE_ROSTER", 6 * 60 * 60))  # rostered players and captains
+REFRESH_RATE_BUDGET = float(os.environ.get("REFRESH_RATE_BUDGET", 0.5))  # share of OSU_API_RATE_LIMIT to use
+# duplicate refreshes coalesce into the pending one, see discord.coalescing. Must outlast the scheduling countdowns
+REFRESH_INFLIGHT_TTL = int(os.environ.get("REFRESH_INFLIGHT_TTL", 30 * 60))
+OSU_USER_CACHE_TTL = int(os.environ.get("OSU_USER_CACHE_TTL", 60))  # reuse of fetched `GET /users/{id}/osu` payloads
+# registration events are published from an outbox by a periodic dispatch once their transaction commits, see
+# userauth.outbox. The interval is how late the Discord bot may hear of a registration
+OUTBOX_DISPATCH_BATCH_SIZE = int(os.environ.get("OUTBOX_DISPATCH_BATCH_SIZE", 100))
+OUTBOX_DISPATCH_INTERVAL = int(os.environ.get("OUTBOX_DISPATCH_INTERVAL", 5))  # seconds
+OUTBOX_DISPATCH_LOCK_TIMEOUT = int(os.environ.get("OUTBOX_DISPATCH_LOCK_TIMEOUT", 60))  # seconds
 
 TEAM_ROSTER_SIZE_MIN = int(os.environ.get("TEAM_ROSTER_SIZE_MIN", 6))  # fatal if not parseable
 TEAM_ROSTER_SIZE_MAX = int(os.environ.get("TEAM_ROSTER_SIZE_MAX", 8))
@@ -275,3 +310,31 @@ TEAM_ROSTER_SELECTION_END = datetime.datetime.fromtimestamp(
 
 # CELERY_BACKEND_URL = 'redis://localhost:6379/0'  # not needed now... may need to re-enable it for chains/groups
 CELERY_BROKER_URL = 'redis://redis:6379/0;redis://127.0.0.1:6379/0'
+# on-demand refreshes get their own queue, which workers (`-Q osu_priority,osu_bulk,celery`) always check first. Both
+# lanes share the osu! API rate limit
+OSU_PRIORITY_QUEUE = "osu_priority"
+OSU_BULK_QUEUE = "osu_bulk"
+CELERY_TASK_ROUTES = {
+    "discord.tasks.update_user": {"queue": OSU_PRIORITY_QUEUE},
+    "discord.tasks.renew_osu_token": {"queue": OSU_PRIORITY_QUEUE},
+    "discord.tasks.update_user_batch": {"queue": OSU_BULK_QUEUE},
+    "discord.tasks.update_users": {"queue": OSU_BULK_QUEUE},
+    "discord.tasks.refresh_all_users": {"queue": OSU_BULK_QUEUE},
+}
+CELERY_BROKER_TRANSPORT_OPTIONS = {"queue_order_strategy": "priority"}
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1  # don't let a worker hoard bulk tasks while priority ones come in
+CELERY_BEAT_SCHEDULE = {
+    "schedule-stale-refreshes": {
+        "task": "discord.tasks.schedule_stale_refreshes",
+        "schedule": REFRESH_SCHEDULE_INTERVAL,
+    },
+    # renews the token within its renewal window even if no task needs one then
+    "renew-osu-token": {
+        "task": "discord.tasks.renew_osu_token",
+        "schedule": OSU_TOKEN_RENEW_BEFORE / 2,
+    },
+    "dispatch-registration-events": {
+        "task": "userauth.tasks.dispatch_registration_events",
+        "schedule": OUTBOX_DISPATCH_INTERVAL,
+    },
+}
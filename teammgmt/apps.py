@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class TeammgmtConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'teammgmt'
+
+    def ready(self):
+        import teammgmt.teams  # noqa: F401, connects the team cache invalidation
@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from teammgmt.teams import preload_teams
+
+
+class Command(BaseCommand):
+    help = "Creates the team of every country code ahead of registrations"
+
+    def handle(self, *args, **options):
+        start_time = time.perf_counter()
+        count = preload_teams()
+        self.stdout.write(
+            self.style.SUCCESS(f"{count} teams ready in {time.perf_counter() - start_time:.3f}s")
+        )
@@ -1,13 +1,17 @@
 from django.db import models
 
 
+DEFAULT_TEAM_FLAG = 'WYSI'
+
+
 # Create your models here.
 class TournamentTeam(models.Model):
     osu_flag = models.CharField(max_length=4, primary_key=True)
 
     @classmethod
     def get_default_pk(cls):
+        # straight from the database, as migrations and every other use of model defaults must work without Redis
         default_team, _ = cls.objects.get_or_create(
-            osu_flag='WYSI',
+            osu_flag=DEFAULT_TEAM_FLAG,
         )
         return default_team.pk
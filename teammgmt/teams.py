@@ -0,0 +1,105 @@
+import logging
+import uuid
+from typing import Iterable
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from teammgmt.countries import COUNTRY_CODES
+from teammgmt.models import DEFAULT_TEAM_FLAG, TournamentTeam
+
+
+logger = logging.getLogger(__name__)
+VERSION_CACHE_KEY = "teams:version"
+
+
+class TeamCache:
+    """
+    Flags of the existing teams, kept in this process so that resolving a player's team rarely writes.
+
+    The flags are reloaded whenever the version shared by every process in the cache changes, which deleting a team
+    does. Flags are only remembered once committed: a rolled back team must not be taken for an existing one. A known
+    flag is still confirmed with a primary key lookup before it's relied on, as teams can disappear without the cache
+    hearing of it (a restored database, a delete that skips signals), and an unreachable cache only costs the insert.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.flags = frozenset()
+
+    def current_version(self) -> str:
+        if (version := cache.get(VERSION_CACHE_KEY)) is None:
+            cache.add(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(VERSION_CACHE_KEY)
+        return version
+
+    def get_flags(self) -> frozenset[str]:
+        return self.load()[0]
+
+    def load(self) -> tuple[frozenset[str], bool]:
+        """
+        :return: the known flags, and whether they were just read from the database rather than from this process
+        """
+        try:
+            version = self.current_version()
+        except Exception as e:
+            logger.warning(f"[teams] cache unavailable, teams are looked up in the database: {e}")
+            return frozenset(), False
+        if version == self.version:
+            return self.flags, False
+        flags = frozenset(TournamentTeam.objects.values_list('osu_flag', flat=True))
+        if not connection.in_atomic_block:
+            self.version, self.flags = version, flags
+        return flags, True
+
+    def ensure(self, flags: Iterable[str]):
+        """
+        Create the teams of `flags` that don't exist yet. Teams known to this process cost one primary key lookup, the
+        others one INSERT that ignores concurrently created ones.
+        """
+        flags = set(flags)
+        known, fresh = self.load()
+        missing = flags - known
+        if (known := flags - missing) and not fresh:
+            confirmed = set(TournamentTeam.objects.filter(osu_flag__in=known).values_list('osu_flag', flat=True))
+            if gone := known - confirmed:
+                logger.warning(f"[teams] cached teams {sorted(gone)} no longer exist, reloading")
+                self.invalidate()
+                missing |= gone
+        if missing:
+            TournamentTeam.objects.bulk_create([TournamentTeam(osu_flag=flag) for flag in missing],
+                                               ignore_conflicts=True)
+            version = self.version
+            transaction.on_commit(lambda: self.remember(version, missing))
+
+    def remember(self, version: str, flags: set[str]):
+        if version is not None and version == self.version:
+            self.flags = self.flags | flags
+
+    def invalidate(self):
+        self.version = None
+        try:
+            cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+        except Exception as e:
+            logger.warning(f"[teams] failed to invalidate the cache of other processes: {e}")
+
+
+team_cache = TeamCache()
+
+
+def preload_teams() -> int:
+    """
+    Create the team of every country (and the default team) up front, so that registrations don't insert teams.
+    :return: number of flags the team cache holds
+    """
+    team_cache.ensure(COUNTRY_CODES | {DEFAULT_TEAM_FLAG})
+    flags = team_cache.get_flags()
+    logger.info(f"[teams] {len(flags)} teams preloaded")
+    return len(flags)
+
+
+@receiver(post_delete, sender=TournamentTeam)
+def invalidate_team_cache(**kwargs):
+    transaction.on_commit(team_cache.invalidate)
@@ -1,14 +1,18 @@
 import datetime
 from datetime import timedelta
+from unittest.mock import patch
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import IntegrityError
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
 from rest_framework.authentication import TokenAuthentication
 
-from discord.views import TournamentPlayerSerializer, TournamentPlayerViewSet
-from teammgmt.models import TournamentTeam
+from discord.views import PreSharedKeyAuthentication, TournamentPlayerSerializer, TournamentPlayerViewSet
+from teammgmt.countries import COUNTRY_CODES
+from teammgmt.models import DEFAULT_TEAM_FLAG, TournamentTeam
+from teammgmt.teams import TeamCache, preload_teams
 from teammgmt.views import TournamentTeamViewSet
 from userauth.authentication import IsSuperUser
 from userauth.models import TournamentPlayer
@@ -270,3 +274,151 @@ class TestViewRosterMembership(TestCaseWithTourneyUsers):
 
         for field in self.restricted_fields:
             self.assertIn(field, serializer.data.keys())
+
+    def test_permissions_resolved_once_per_request(self):
+        request = APIRequestFactory().get(f'/does_not_matter/',
+                                          HTTP_AUTHORIZATION=f"{TokenAuthentication.keyword} {settings.DISCORD_PSK}")
+        request.user = User.objects.create()
+        with patch.object(PreSharedKeyAuthentication, 'authenticate_credentials',
+                          autospec=True, side_effect=lambda _, key: (None, key)) as authenticate_credentials:
+            data = TournamentPlayerSerializer(self.tourney_players, many=True, context={'request': request}).data
+
+        self.assertEqual(len(self.tourney_players), len(data))
+        self.assertEqual(1, authenticate_credentials.call_count)
+        for player in data:
+            for field in self.restricted_fields:
+                self.assertIn(field, player.keys())
+
+    def test_team_members_permissions_resolved_once(self):
+        self.tourney_players[0].is_organizer = True
+        self.tourney_players[0].save()
+
+        request = APIRequestFactory().get(f'/teams/{self.tourney_team.osu_flag}/members/')
+        request.user = User.objects.get(pk=self.tourney_players[0].pk)
+        members_view = TournamentTeamViewSet.as_view({'get': 'members'})
+        with patch.object(IsSuperUser, 'has_permission', autospec=True, return_value=False) as is_superuser:
+            res = members_view(request, pk=self.tourney_team.pk)
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, is_superuser.call_count)
+        for player in res.data['candidates']['results']:
+            for field in self.restricted_fields:
+                self.assertIn(field, player.keys())
+
+
+class TestTeamMembersQueries(TestCaseWithTourneyUsers):
+    def setUp(self):
+        super().setUp()
+        self.tourney_players[0].in_roster = True
+        self.tourney_players[0].is_captain = True
+        self.tourney_players[0].save()
+        self.tourney_players[1].in_roster = True
+        self.tourney_players[1].save()
+        self.tourney_players[2].in_backup_roster = True
+        self.tourney_players[2].save()
+
+        self.superuser = User.objects.create(is_superuser=True)
+
+    def get_members(self, query=''):
+        request = APIRequestFactory().get(f'/teams/{self.tourney_team.osu_flag}/members/{query}')
+        request.user = self.superuser
+        members_view = TournamentTeamViewSet.as_view({'get': 'members'}, permission_classes=[])
+        return members_view(request, pk=self.tourney_team.pk)
+
+    def test_members_split(self):
+        res = self.get_members('?limit=5')
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(self.tourney_players[0].pk, res.data['captain']['user_id'])
+        self.assertEqual([self.tourney_players[0].pk, self.tourney_players[1].pk],
+                         [player['user_id'] for player in res.data['roster']])
+        self.assertEqual([self.tourney_players[2].pk], [player['user_id'] for player in res.data['backups']])
+        self.assertEqual(len(self.tourney_players), res.data['candidates']['count'])
+        self.assertEqual([player.pk for player in self.tourney_players[:5]],
+                         [player['user_id'] for player in res.data['candidates']['results']])
+
+    def test_members_page_number_candidates(self):
+        # team, selected players, candidates COUNT and candidates page: the team isn't loaded whole
+        with self.assertNumQueries(4) as queries:
+            res = self.get_members('?limit=2')
+        self.assertEqual(200, res.status_code)
+        self.assertIn("LIMIT 2", queries.captured_queries[-1]['sql'])
+        self.assertEqual(len(self.tourney_players), res.data['candidates']['count'])
+        self.assertEqual([player.pk for player in self.tourney_players[:2]],
+                         [player['user_id'] for player in res.data['candidates']['results']])
+
+    def test_members_keyset_candidates(self):
+        with self.assertNumQueries(4):  # team, selected players, candidates COUNT and candidates page
+            res = self.get_members('?pagination=cursor&limit=4')
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(self.tourney_players[0].pk, res.data['captain']['user_id'])
+        self.assertEqual(2, len(res.data['roster']))
+        self.assertEqual(1, len(res.data['backups']))
+        self.assertEqual(len(self.tourney_players), res.data['candidates']['count'])
+        self.assertIsNone(res.data['candidates']['previous'])
+
+        candidate_ids = [player['user_id'] for player in res.data['candidates']['results']]
+        next_link = res.data['candidates']['next']
+        while next_link is not None:
+            res = self.get_members(next_link[next_link.index('?'):])
+            candidate_ids += [player['user_id'] for player in res.data['candidates']['results']]
+            next_link = res.data['candidates']['next']
+        self.assertEqual([player.pk for player in self.tourney_players], candidate_ids)
+
+    def test_members_keyset_candidates_without_count(self):
+        with self.assertNumQueries(3):  # team, selected players and candidates page
+            res = self.get_members('?pagination=cursor&count=false')
+
+        self.assertEqual(200, res.status_code)
+        self.assertNotIn('count', res.data['candidates'])
+        self.assertEqual(len(self.tourney_players), len(res.data['candidates']['results']))
+
+
+class TeamCacheTestCase(TransactionTestCase):
+    # outside of a test transaction, so that the team cache keeps what it reads
+    def setUp(self):
+        cache.clear()
+        self.team_cache = TeamCache()
+
+    def test_ensure(self):
+        TournamentTeam.objects.create(osu_flag="CA")
+        with self.assertNumQueries(4):  # teams load, then BEGIN, INSERT of the missing one, COMMIT
+            self.team_cache.ensure(["CA", "US"])
+        with self.assertNumQueries(1):  # known teams are still confirmed
+            self.team_cache.ensure(["CA", "US"])
+        self.assertEqual(2, TournamentTeam.objects.filter(osu_flag__in=["CA", "US"]).count())
+
+    def test_rolled_back_team_not_kept(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.team_cache.ensure(["CA"])
+            raise ValueError
+        self.assertNotIn("CA", self.team_cache.get_flags())
+        self.team_cache.ensure(["CA"])
+        self.assertTrue(TournamentTeam.objects.filter(osu_flag="CA").exists())
+
+    def test_invalidated_on_delete(self):
+        self.team_cache.ensure(["CA"])
+        TournamentTeam.objects.filter(osu_flag="CA").delete()
+        with self.assertNumQueries(4):  # teams reload, then the insert
+            self.team_cache.ensure(["CA"])
+        self.assertTrue(TournamentTeam.objects.filter(osu_flag="CA").exists())
+
+    def test_deleted_without_signal(self):
+        self.team_cache.ensure(["CA"])
+        # a restored database, or a raw delete, doesn't go through the post_delete signal
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM teammgmt_tournamentteam WHERE osu_flag = 'CA'")
+        self.team_cache.ensure(["CA"])
+        self.assertTrue(TournamentTeam.objects.filter(osu_flag="CA").exists())
+        self.assertIsNone(self.team_cache.version)
+
+    def test_cache_unavailable(self):
+        with patch.object(cache, 'get', side_effect=ConnectionError):
+            self.team_cache.ensure(["CA"])
+        self.assertTrue(TournamentTeam.objects.filter(osu_flag="CA").exists())
+
+    def test_preload_teams(self):
+        self.assertEqual(len(COUNTRY_CODES) + 1, preload_teams())
+        self.assertEqual(len(COUNTRY_CODES) + 1, TournamentTeam.objects.count())
+        self.assertEqual(DEFAULT_TEAM_FLAG, TournamentTeam.get_default_pk())
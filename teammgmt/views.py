@@ -2,14 +2,16 @@ import datetime
 
 from django.conf import settings
 from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.utils.functional import cached_property
 
 from rest_framework import serializers, viewsets, status
 from rest_framework.decorators import action
 from rest_framework.exceptions import PermissionDenied
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
 from discord.views import TournamentPlayerSerializer, PreSharedKeyAuthentication, TeamOrganizer, ReadOnly
+from fivedigitworldcup.pagination import get_paginator
 from userauth.authentication import IsSuperUser
 from teammgmt.models import TournamentTeam
 from userauth.models import TournamentPlayer
@@ -31,53 +33,56 @@ class TournamentTeamMembersSerializer(serializers.HyperlinkedModelSerializer):
         model = TournamentTeam
         fields = ['url', 'osu_flag', 'captain', 'roster', 'backups', 'candidates']
 
-    def get_candidates(self, team: TournamentTeam):
-        qs = TournamentPlayer.objects.filter(team=team)
-        pagination_class = viewsets.GenericViewSet.pagination_class
-        all_candidates_serializer = TournamentPlayerSerializer(instance=qs,
-                                                               context=self.context,
-                                                               many=True,
-                                                               read_only=True)
-
-        if pagination_class is None or not issubclass(pagination_class, PageNumberPagination):
-            return all_candidates_serializer.data
-
-        request = self.context['request']
-        drf_paginator = pagination_class()
-
-        paginated_qs = drf_paginator.paginate_queryset(queryset=qs, request=request)
-
-        # paginator was misconfigured
-        if paginated_qs is None:
-            return all_candidates_serializer.data
+    @cached_property
+    def candidates_paginator(self):
+        return get_paginator(self.context['request'], viewsets.GenericViewSet.pagination_class)
 
-        paginated_response = drf_paginator.get_paginated_response(paginated_qs)
-
-        # get_page_size cannot be None here else paginated_qs would've been None
-        django_paginator = drf_paginator.django_paginator_class(qs, drf_paginator.get_page_size(request))
-        page_num = drf_paginator.get_page_number(self.context['request'], django_paginator)
+    def get_members(self, team: TournamentTeam) -> list[TournamentPlayer]:
+        """
+        Fetch the selected players of `team` in a single query, captain, roster and backups are split from this list
+        in memory. Without pagination it holds every player, candidates included. Memoized per team for the lifetime
+        of the serializer.
+        """
+        if not hasattr(self, '_members'):
+            self._members = {}
+        if team.pk not in self._members:
+            players = team.players.all()
+            if self.candidates_paginator is not None:
+                # candidates are fetched page by page, only the selected players are needed here
+                players = players.filter(Q(is_captain=True) | Q(in_roster=True) | Q(in_backup_roster=True))
+            self._members[team.pk] = list(TournamentPlayerSerializer.setup_eager_loading(players))
+        return self._members[team.pk]
 
-        page_results = django_paginator.page(page_num)
-        paginated_response_data = paginated_response.data
-        paginated_response_data['results'] = TournamentPlayerSerializer(instance=page_results,
-                                                                        context=self.context,
-                                                                        many=True,
-                                                                        read_only=True).data
-        return paginated_response_data
+    def get_candidates(self, team: TournamentTeam):
+        paginator = self.candidates_paginator
+        if paginator is None:
+            candidates = self.get_members(team)
+        else:
+            # paginated in the database, whichever the pagination mode
+            candidates = TournamentPlayerSerializer.setup_eager_loading(team.players.all())
+
+        page = None
+        if paginator is not None:
+            page = paginator.paginate_queryset(candidates, self.context['request'])
+        if page is None:
+            return TournamentPlayerSerializer(instance=candidates, context=self.context, many=True, read_only=True).data
+
+        serializer = TournamentPlayerSerializer(instance=page, context=self.context, many=True, read_only=True)
+        return paginator.get_paginated_response(serializer.data).data
 
     def get_roster(self, team):
-        players = TournamentPlayer.objects.filter(team=team, in_roster=True)
+        players = [player for player in self.get_members(team) if player.in_roster]
         serializer = TournamentPlayerSerializer(instance=players, context=self.context, many=True)
         return serializer.data
 
     def get_backups(self, team):
-        players = TournamentPlayer.objects.filter(team=team, in_backup_roster=True)
+        players = [player for player in self.get_members(team) if player.in_backup_roster]
         serializer = TournamentPlayerSerializer(instance=players, context=self.context, many=True)
         return serializer.data
 
     def get_captain(self, team):
-        if (captain := TournamentPlayer.objects.filter(team=team, is_captain=True)).exists():
-            serializer = TournamentPlayerSerializer(instance=captain[0], context=self.context, many=False)
+        if (captain := next((player for player in self.get_members(team) if player.is_captain), None)) is not None:
+            serializer = TournamentPlayerSerializer(instance=captain, context=self.context, many=False)
             return serializer.data
         return None
 
@@ -1,9 +1,11 @@
 from django.contrib import admin
-from userauth.models import DisqualifiedUser, TournamentPlayer, TournamentPlayerBadge
+from userauth.models import Badge, DisqualifiedUser, RegistrationEvent, TournamentPlayer, TournamentPlayerBadge
 from teammgmt.models import TournamentTeam
 
 # Register your models here.
 admin.site.register(TournamentPlayer)
 admin.site.register(TournamentPlayerBadge)
+admin.site.register(Badge)
 admin.site.register(TournamentTeam)
 admin.site.register(DisqualifiedUser)
+admin.site.register(RegistrationEvent)
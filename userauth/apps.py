@@ -1,6 +1,21 @@
+import logging
+
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_badge_eligibility(using: str, **kwargs):
+    from userauth.authentication import refresh_badge_eligibility
+    if using == 'default' and (refreshed := refresh_badge_eligibility()):
+        logger.info(f"[badges] re-evaluated eligibility of {refreshed} badges against the current filter phrases")
 
 
 class UserauthConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'userauth'
+
+    def ready(self):
+        post_migrate.connect(refresh_badge_eligibility, sender=self)
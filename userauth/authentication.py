@@ -1,20 +1,23 @@
 import datetime
-import json
+import functools
+import hashlib
 import math
+import re
+from collections import Counter, defaultdict
 from typing import Iterable
 
 from django.conf import settings
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.models import User
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Count
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import BasePermission
 
-from teammgmt.models import TournamentTeam
-from userauth.models import TournamentPlayer, TournamentPlayerBadge
+from teammgmt.teams import team_cache
+from userauth.models import Badge, TournamentPlayer, TournamentPlayerBadge
+from userauth.outbox import record_event
 
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import logging
 
 
@@ -25,29 +28,194 @@ FILTER_PHRASES = {"contrib", "nomination", "assessment", "moderation", "spotligh
                   "community favourite", "mania", "taiko", "catch"}
 
 
-def filter_badges(badges: list[dict],
-                  filter_phrases: Iterable[str] = None,
-                  cutoff_date=datetime.datetime(2021, 1, 1, 0, 0, 0,
-                                                tzinfo=datetime.timezone.utc)):
+BADGE_CUTOFF_DATE = datetime.datetime(2021, 1, 1, 0, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+class BadgeFilter:
+    """
+    Badge filter compiled once per set of filter phrases.
+
+    All phrases are folded into a single regex alternation, so a description is lowercased and scanned once instead of
+    once per phrase. Matching is plain substring search on the lowercased description, exactly like
+    `word.lower() in description.lower()`.
+    """
+
+    def __init__(self, filter_phrases: Iterable[str]):
+        # longest first so that overlapping phrases do not depend on set iteration order
+        phrases = sorted({word.lower() for word in filter_phrases}, key=lambda word: (-len(word), word))
+        self.filter_phrases = frozenset(phrases)
+        # identifies the phrase set that eligibility stored in the database was evaluated against
+        self.version = hashlib.sha1('\n'.join(sorted(phrases)).encode()).hexdigest()[:16]
+        self._pattern = re.compile('|'.join(map(re.escape, phrases))) if phrases else None
+
+    def is_filtered(self, description: str) -> bool:
+        """
+        True if `description` contains any of the filter phrases, case-insensitively.
+        """
+        return self._pattern is not None and self._pattern.search(description.lower()) is not None
+
+    def filter(self, badges: list[dict], cutoff_date=BADGE_CUTOFF_DATE) -> list[dict]:
+        search = self._pattern.search if self._pattern is not None else None
+        fromisoformat = datetime.datetime.fromisoformat
+        return [badge for badge in badges
+                if (search is None or search(badge['description'].lower()) is None)
+                and (cutoff_date is None or fromisoformat(badge['awarded_at']) > cutoff_date)]
+
+    def filter_many(self, badge_lists: Iterable[list[dict]], cutoff_date=BADGE_CUTOFF_DATE) -> list[list[dict]]:
+        """
+        Filter the badges of many players in one pass. Widely awarded badges share their description, so each distinct
+        description is only matched once per call.
+        :param badge_lists: one list of osu! API badge dicts per player
+        :return: the eligible badges of each player, in the order of `badge_lists`
+        """
+        if self._pattern is None:
+            return [self.filter(badges, cutoff_date) for badges in badge_lists]
+
+        filtered_descriptions = {}
+        fromisoformat = datetime.datetime.fromisoformat
+        results = []
+        for badges in badge_lists:
+            eligible = []
+            for badge in badges:
+                description = badge['description']
+                is_filtered = filtered_descriptions.get(description)
+                if is_filtered is None:
+                    is_filtered = filtered_descriptions[description] = self.is_filtered(description)
+                if not is_filtered and (cutoff_date is None or fromisoformat(badge['awarded_at']) > cutoff_date):
+                    eligible.append(badge)
+            results.append(eligible)
+        return results
+
+
+@functools.lru_cache(maxsize=16)
+def _get_badge_filter(filter_phrases: frozenset[str]) -> BadgeFilter:
+    return BadgeFilter(filter_phrases)
+
+
+def get_badge_filter(filter_phrases: Iterable[str] = None) -> BadgeFilter:
+    """
+    Compiled `BadgeFilter` for `filter_phrases` (defaults to FILTER_PHRASES), cached per distinct phrase set.
+    """
     if filter_phrases is None:
         filter_phrases = FILTER_PHRASES
-    return [badge for badge in badges
-            if not any([word.lower() in badge['description'].lower() for word in filter_phrases])
-            and (cutoff_date is None or datetime.datetime.fromisoformat(badge['awarded_at']) > cutoff_date)]
+    return _get_badge_filter(frozenset(filter_phrases))
+
+
+def filter_badges(badges: list[dict],
+                  filter_phrases: Iterable[str] = None,
+                  cutoff_date=BADGE_CUTOFF_DATE):
+    return get_badge_filter(filter_phrases).filter(badges, cutoff_date)
+
+
+def filter_badges_many(badge_lists: Iterable[list[dict]],
+                       filter_phrases: Iterable[str] = None,
+                       cutoff_date=BADGE_CUTOFF_DATE) -> list[list[dict]]:
+    return get_badge_filter(filter_phrases).filter_many(badge_lists, cutoff_date)
 
 
-def prep_badges_for_db(osu_data, tourney_player):
-    # cutoff_date date of 0 timestamp to keep all badges in DB
-    all_badges = filter_badges(osu_data['badges'],
-                               cutoff_date=datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc))
-    db_badges = [TournamentPlayerBadge(user=tourney_player,
-                                       description=badge['description'],
-                                       award_date=datetime.datetime.fromisoformat(badge['awarded_at']),
-                                       url=badge['url'],
-                                       image_url=badge['image_url'],
-                                       image_url_2x=badge['image@2x_url'])
-                 for badge in all_badges]
-    return all_badges, db_badges
+def upsert_badges(badges: list[dict]) -> dict[str, Badge]:
+    """
+    Get or create the catalog entries of osu! API `badges` in three queries at most, however many there are.
+    New entries are flagged against the current filter phrases.
+    :return: dict of `Badge.make_key` -> Badge
+    """
+    badge_filter = get_badge_filter()
+    keys = {Badge.make_key(badge['description'], badge['image_url']): badge for badge in badges}
+    catalog = Badge.objects.in_bulk(keys, field_name='key')
+    missing = [Badge(key=key,
+                     description=badge['description'],
+                     url=badge['url'],
+                     image_url=badge['image_url'],
+                     image_url_2x=badge['image@2x_url'],
+                     is_eligible=not badge_filter.is_filtered(badge['description']),
+                     filter_version=badge_filter.version)
+               for key, badge in keys.items() if key not in catalog]
+    if missing:
+        # another worker may have created some of them in the meantime, re-read to get their pks
+        Badge.objects.bulk_create(missing, ignore_conflicts=True)
+        catalog.update(Badge.objects.in_bulk([badge.key for badge in missing], field_name='key'))
+    return catalog
+
+
+def prep_badges_for_db(osu_data, tourney_player, catalog: dict[str, Badge] = None):
+    """
+    Build the badge rows of `tourney_player`, adding badges not seen before to the catalog. Every badge is stored,
+    eligibility is kept on the catalog entry so a change of filter phrases only needs `refresh_badge_eligibility`.
+    :param catalog: result of `upsert_badges` covering these badges, to share one upsert between many players
+    :return: badges passing the filter phrases (regardless of award date), TournamentPlayerBadge rows for all badges
+    """
+    badge_filter = get_badge_filter()
+    if catalog is None:
+        catalog = upsert_badges(osu_data['badges'])
+    eligible_badges = []
+    db_badges = []
+    for badge in osu_data['badges']:
+        if not badge_filter.is_filtered(badge['description']):
+            eligible_badges.append(badge)
+        db_badges.append(TournamentPlayerBadge(user=tourney_player,
+                                               badge=catalog[Badge.make_key(badge['description'], badge['image_url'])],
+                                               award_date=datetime.datetime.fromisoformat(badge['awarded_at'])))
+    return eligible_badges, db_badges
+
+
+def sync_player_badges(tourney_player, db_badges: list[TournamentPlayerBadge]) -> tuple[int, int]:
+    """
+    Bring the stored badges of `tourney_player` in line with `db_badges` (from `prep_badges_for_db`), inserting and
+    deleting only the badges that changed. An unchanged badge list costs a single SELECT.
+    :return: number of badges added, number of badges removed
+    """
+    return sync_badges({tourney_player: db_badges})
+
+
+def sync_badges(player_badges: dict[TournamentPlayer, list[TournamentPlayerBadge]]) -> tuple[int, int]:
+    """
+    `sync_player_badges` for many players at once, with one SELECT, one DELETE and one INSERT at most.
+    :return: number of badges added, number of badges removed
+    """
+    if not player_badges:
+        return 0, 0
+    stored = defaultdict(list)
+    for pk, user_id, badge_id, award_date in (TournamentPlayerBadge.objects
+                                              .filter(user__in=player_badges)
+                                              .values_list('pk', 'user_id', 'badge_id', 'award_date')):
+        stored[user_id, badge_id, award_date].append(pk)
+
+    added = []
+    for tourney_player, db_badges in player_badges.items():
+        for db_badge in db_badges:
+            if pks := stored.get((tourney_player.pk, db_badge.badge_id, db_badge.award_date)):
+                pks.pop()
+            else:
+                added.append(db_badge)
+    removed = [pk for pks in stored.values() for pk in pks]
+
+    if removed:
+        TournamentPlayerBadge.objects.filter(pk__in=removed).delete()
+    if added:
+        TournamentPlayerBadge.objects.bulk_create(added)
+    return len(added), len(removed)
+
+
+def refresh_badge_eligibility(batch_size: int = 500) -> int:
+    """
+    Re-evaluate `is_eligible` of catalog badges that were flagged against a different set of filter phrases. Runs after
+    every `migrate`, so that the deploy of new filter phrases brings the catalog up to date.
+    :return: number of catalog badges re-evaluated
+    """
+    badge_filter = get_badge_filter()
+    stale_badges = Badge.objects.exclude(filter_version=badge_filter.version)
+    pks = {True: [], False: []}
+    for pk, description in stale_badges.values_list('pk', 'description'):
+        pks[not badge_filter.is_filtered(description)].append(pk)
+
+    updated = 0
+    with transaction.atomic():
+        for is_eligible, group in pks.items():
+            for i in range(0, len(group), batch_size):
+                updated += (Badge.objects
+                            .filter(pk__in=group[i:i + batch_size])
+                            .update(is_eligible=is_eligible, filter_version=badge_filter.version))
+    return updated
 
 
 def bws(badges_count: int, global_rank: int) -> int:
@@ -68,6 +236,104 @@ def bws(badges_count: int, global_rank: int) -> int:
     )
 
 
+def count_eligible_badges(filter_phrases: Iterable[str] = None,
+                          cutoff_date=BADGE_CUTOFF_DATE,
+                          chunk_size: int = 5000,
+                          players: Iterable[TournamentPlayer] = None) -> Counter:
+    """
+    Count the stored badges that pass `filter_badges` for every player, or only for `players` if given.
+
+    With the default filter phrases, the eligibility stored in the badge catalog is counted in the database, it is
+    re-evaluated after every `migrate` and by `recompute_bws`. Other phrase sets are matched once per catalog badge,
+    then counted in one pass over the awards.
+    :return: Counter of TournamentPlayer pk -> number of eligible badges
+    """
+    awards = TournamentPlayerBadge.objects.all()
+    if players is not None:
+        awards = awards.filter(user__in=players)
+    if cutoff_date is not None:
+        awards = awards.filter(award_date__gt=cutoff_date)
+
+    if filter_phrases is None:
+        return Counter(dict(awards
+                            .filter(badge__is_eligible=True)
+                            .order_by()
+                            .values_list('user_id')
+                            .annotate(badge_count=Count('pk'))))
+
+    badge_filter = get_badge_filter(filter_phrases)
+    eligible_badge_ids = {pk for pk, description in Badge.objects.values_list('pk', 'description')
+                          if not badge_filter.is_filtered(description)}
+    badge_counts = Counter()
+    for user_id, badge_id in awards.values_list('user_id', 'badge_id').iterator(chunk_size=chunk_size):
+        if badge_id in eligible_badge_ids:
+            badge_counts[user_id] += 1
+    return badge_counts
+
+
+def bulk_update_bws(new_bws: list[tuple[int, int | None]]):
+    """
+    Write `(player pk, BWS)` pairs in a single `UPDATE ... SET osu_rank_std_bws = CASE pk WHEN ... END` statement.
+
+    Same statement as `bulk_update`, without building an ORM `Case(When(...))` expression per row, which dominates
+    the cost of writing back tens of thousands of players.
+    """
+    if not new_bws:
+        return
+    quote_name = connection.ops.quote_name
+    table = quote_name(TournamentPlayer._meta.db_table)
+    pk_column = quote_name(TournamentPlayer._meta.pk.column)
+    bws_column = quote_name(TournamentPlayer._meta.get_field('osu_rank_std_bws').column)
+    whens = ' '.join(['WHEN %s THEN %s'] * len(new_bws))
+    placeholders = ', '.join(['%s'] * len(new_bws))
+    params = [value for pair in new_bws for value in pair] + [pk for pk, _ in new_bws]
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE {table} SET {bws_column} = CASE {pk_column} {whens} END "
+                       f"WHERE {pk_column} IN ({placeholders})", params)
+
+
+def recompute_bws(batch_size: int = 1000,
+                  filter_phrases: Iterable[str] = None,
+                  cutoff_date=BADGE_CUTOFF_DATE) -> int:
+    """
+    Recompute `osu_rank_std_bws` for all players from their stored badges and rank, without calling the osu! API.
+
+    The BWS exponent only depends on the badge count, so it is computed once per distinct count and the per-player work
+    is a single power. `math.pow` is kept (rather than a vectorized float power) so results match `bws` exactly.
+    :param batch_size: number of players written per UPDATE statement, each in its own transaction
+    :param filter_phrases: badge filter phrases, defaults to FILTER_PHRASES
+    :param cutoff_date: only badges awarded after this date are eligible
+    :return: number of players whose BWS changed
+    """
+    if connection.features.max_query_params is not None:
+        # each player takes three parameters: pk and BWS in the CASE, pk in the WHERE
+        batch_size = min(batch_size, connection.features.max_query_params // 3)
+    if filter_phrases is None:
+        refresh_badge_eligibility()
+    badge_counts = count_eligible_badges(filter_phrases, cutoff_date)
+    exponents = {badge_count: math.pow(0.9937, badge_count ** 2) for badge_count in set(badge_counts.values()) | {0}}
+
+    updated = 0
+    batch = []
+    players = TournamentPlayer.objects.values_list('pk', 'osu_rank_std', 'osu_rank_std_bws')
+    # batches commit on their own, so that a full recompute doesn't hold the row locks of every player until it ends
+    for pk, rank, old_bws in players.iterator(chunk_size=batch_size):
+        new_bws = None if rank is None else round(math.pow(rank, exponents[badge_counts[pk]]))
+        if new_bws == old_bws:
+            continue
+        batch.append((pk, new_bws))
+        if len(batch) >= batch_size:
+            with transaction.atomic():
+                bulk_update_bws(batch)
+            updated += len(batch)
+            batch = []
+    if batch:
+        with transaction.atomic():
+            bulk_update_bws(batch)
+        updated += len(batch)
+    return updated
+
+
 class DiscordAndOsuAuthBackend(BaseBackend):
     @staticmethod
     def validate_data(discord_user_data, osu_user_data):
@@ -101,101 +367,82 @@ class DiscordAndOsuAuthBackend(BaseBackend):
 
         logger.info(f"attempting auth with discord user id {discord_data['id']}, osu user id {osu_data['id']}")
         username = f"{discord_data['id']}.{osu_data['id']}"
-        try:
-            # check both user and TournamentPlayer exist
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            try:
-                # found existing TournamentPlayer with different discord id
-                tournament_player: TournamentPlayer = TournamentPlayer.objects.filter(osu_user_id=osu_data['id'])[0]
-                logger.info(f"found user {tournament_player} with  discord id {tournament_player.discord_user_id}. "
-                            f"Updating discord id to {discord_data['id']}")
-                old_discord_id = tournament_player.discord_user_id
-
-                tournament_player.discord_user_id = discord_data['id']
-                tournament_player.discord_username = discord_data['composite_username']
-                tournament_player.user.username = username
-                tournament_player.user.save()
-                tournament_player.save()
-                try:
-                    channel_layer = get_channel_layer()
-                    # noinspection PyArgumentList
-                    async_to_sync(channel_layer.group_send)(
-                        settings.CHANNELS_DISCORD_WS_GROUP_NAME,
-                        {
-                            "type": "registration.discord.switch",
-                            "message": json.dumps({
-                                "old_discord_user_id": old_discord_id,
-                                "new_discord_user_id": tournament_player.discord_user_id,
-                                "action": "discord_switch"
-                            })
-                        })
-                finally:
-                    logger.info(f"successfully authenticated user {tournament_player}")
-                    return tournament_player.user
-            except IndexError:
-                pass
+        # the osu! account identifies the player, whichever Discord account they log in with
+        tournament_player = (TournamentPlayer.objects
+                             .select_related('user')
+                             .filter(osu_user_id=osu_data['id'])
+                             .first())
+        if tournament_player is None:
+            tournament_player = self.register(username, discord_data, osu_data)
+        elif tournament_player.discord_user_id != discord_data['id']:
+            self.switch_discord(tournament_player, username, discord_data)
+        logger.info(f"successfully authenticated user {tournament_player}")
+        return tournament_player.user
+
+    @staticmethod
+    def register(username, discord_data, osu_data) -> TournamentPlayer:
+        request_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        if request_time > settings.USER_REGISTRATION_END:
+            time_delta = (request_time - settings.USER_REGISTRATION_END)
+            time_delta = time_delta - datetime.timedelta(microseconds=time_delta.microseconds)
+            raise PermissionDenied(f"User registrations closed {time_delta} ago "
+                                   f"({time_delta.total_seconds():.0f} seconds).")
 
+        # shared by every player, catalog entries and teams don't need to roll back with this one. Teams are
+        # preloaded, see teammgmt.teams
+        catalog = upsert_badges(osu_data['badges'])
+        team_cache.ensure([osu_data['country_code']])
+        with transaction.atomic():
             # Create a new user. There's no need to set a password
             # because only the password from settings.py is checked.
-            user = User(username=username, is_staff=False, is_superuser=False)
-            user.save()
+            user, _ = User.objects.get_or_create(username=username,
+                                                 defaults={'is_staff': False, 'is_superuser': False})
+            logger.info(f"no TournamentPlayer found, creating for {user}")
+            tourney_player = TournamentPlayer(user=user,
+                                              discord_user_id=discord_data['id'],
+                                              discord_username=discord_data['composite_username'],
+                                              discord_global_name=discord_data.get('global_name', None),
+                                              discord_avatar=discord_data.get('avatar', None),
+                                              osu_user_id=osu_data['id'],
+                                              osu_username=osu_data['username'],
+                                              osu_flag=osu_data['country_code'],
+                                              team_id=osu_data['country_code'],
+                                              # global_rank can be null, but I'm not sure if global_rank is
+                                              # always present
+                                              osu_rank_std=osu_data['statistics'].get('global_rank', None),
+                                              osu_stats_updated=datetime.datetime.now(datetime.timezone.utc))
+            eligible_badges, db_badges = prep_badges_for_db(osu_data, tourney_player, catalog)
+            # already filtered by phrase, only the award date is left to check
+            tourney_player.osu_rank_std_bws = bws(len(filter_badges(eligible_badges, filter_phrases=())),
+                                                  tourney_player.osu_rank_std)
+            # the pk is the user's, without force_insert saving would try an UPDATE first
+            tourney_player.save(force_insert=True)
+            TournamentPlayerBadge.objects.bulk_create(db_badges)
+            record_event("registration.new", {"discord_user_id": tourney_player.discord_user_id,
+                                              "osu_user_id": tourney_player.osu_user_id,
+                                              "osu_username": tourney_player.osu_username,
+                                              "osu_global_rank": tourney_player.osu_rank_std,
+                                              "osu_global_rank_bws": tourney_player.osu_rank_std_bws,
+                                              "osu_flag": tourney_player.osu_flag,
+                                              "is_organizer": tourney_player.is_organizer,
+                                              "action": "register"})
+        return tourney_player
 
-        try:
-            TournamentPlayer.objects.get(discord_user_id=discord_data['id'], osu_user_id=osu_data['id'])
-            logger.info(f"found existing TournamentPlayer {user.tournamentplayer}")
-        except TournamentPlayer.DoesNotExist:
-            request_time = datetime.datetime.now(tz=datetime.timezone.utc)
-            if request_time > settings.USER_REGISTRATION_END:
-                time_delta = (request_time - settings.USER_REGISTRATION_END)
-                time_delta = time_delta - datetime.timedelta(microseconds=time_delta.microseconds)
-                raise PermissionDenied(f"User registrations closed {time_delta} ago "
-                                       f"({time_delta.total_seconds():.0f} seconds).")
-            with transaction.atomic():
-                # create tournament player
-                logger.info(f"no TournamentPlayer found, creating for {user}")
-                tournament_team, _ = TournamentTeam.objects.get_or_create(osu_flag=osu_data['country_code'])
-                tourney_player = TournamentPlayer(user=user,
-                                                  discord_user_id=discord_data['id'],
-                                                  discord_username=discord_data['composite_username'],
-                                                  discord_global_name=discord_data.get('global_name', None),
-                                                  discord_avatar=discord_data.get('avatar', None),
-                                                  osu_user_id=osu_data['id'],
-                                                  osu_username=osu_data['username'],
-                                                  osu_flag=osu_data['country_code'],
-                                                  team=tournament_team,
-                                                  # global_rank can be null, but I'm not sure if global_rank is
-                                                  # always present
-                                                  osu_rank_std=osu_data['statistics'].get('global_rank', None),
-                                                  osu_stats_updated=datetime.datetime.now(datetime.timezone.utc))
-
-                # save user badges
-                all_badges, db_badges = prep_badges_for_db(osu_data, tourney_player)
-
-                TournamentPlayerBadge.objects.bulk_create(db_badges)
-
-                # filter again to filter by cutoff date, calculate BWS
-                tourney_player.osu_rank_std_bws = bws(len(filter_badges(all_badges)),
-                                                      tourney_player.osu_rank_std)
-                tourney_player.save()
-
-                channel_layer = get_channel_layer()
-                # noinspection PyArgumentList
-                async_to_sync(channel_layer.group_send)(
-                    settings.CHANNELS_DISCORD_WS_GROUP_NAME,
-                    {
-                        "type": "registration.new",
-                        "message": json.dumps({"discord_user_id": tourney_player.discord_user_id,
-                                               "osu_user_id": tourney_player.osu_user_id,
-                                               "osu_username": tourney_player.osu_username,
-                                               "osu_global_rank": tourney_player.osu_rank_std,
-                                               "osu_global_rank_bws": tourney_player.osu_rank_std_bws,
-                                               "osu_flag": tourney_player.osu_flag,
-                                               "is_organizer": tourney_player.is_organizer,
-                                               "action": "register"})
-                    })
-        logger.info(f"successfully authenticated user {user.tournamentplayer}")
-        return user
+    @staticmethod
+    def switch_discord(tournament_player: TournamentPlayer, username, discord_data):
+        logger.info(f"found user {tournament_player} with  discord id {tournament_player.discord_user_id}. "
+                    f"Updating discord id to {discord_data['id']}")
+        old_discord_id = tournament_player.discord_user_id
+
+        tournament_player.discord_user_id = discord_data['id']
+        tournament_player.discord_username = discord_data['composite_username']
+        tournament_player.user.username = username
+        with transaction.atomic():
+            tournament_player.user.save(update_fields=['username'])
+            tournament_player.save(update_fields=['discord_user_id', 'discord_username'])
+            record_event("registration.discord.switch", {"old_discord_user_id": old_discord_id,
+                                                         "new_discord_user_id": tournament_player.discord_user_id,
+                                                         "action": "discord_switch"})
 
     def get_user(self, user_id):
         try:
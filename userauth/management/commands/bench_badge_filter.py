@@ -0,0 +1,97 @@
+import datetime
+import random
+import timeit
+from typing import Iterable
+
+from django.core.management.base import BaseCommand, CommandError
+
+from userauth.authentication import BADGE_CUTOFF_DATE, FILTER_PHRASES, filter_badges, filter_badges_many, \
+    get_badge_filter
+
+BADGE_DESCRIPTIONS = [
+    "osu! World Cup {year} Winning Team",
+    "osu! World Cup {year} 3rd Place (Canada)",
+    "Corsace Open {year} Winning Team",
+    "Spring Flower Scramble: Wisteria Winning Team",
+    "SST Summer {year} Winning Team",
+    "Z-Tournament {year} Winning Team",
+    "Villoux Tournament #6 Winner",
+    "Outstanding contribution to the osu! tournament scene and the World Cups",
+    "Longstanding commitment to World Cup Commentary (6 years)",
+    "Longstanding commitment to World Cup Pooling (3 years)",
+    "Mapper's Choice Awards {year}: Top 3 in the user/beatmap category Hitsounding",
+    "Beatmap Spotlights: Winter {year}",
+    "Exemplary performance as a member of the Beatmap Nominators during {year}!",
+    "osu!mania World Cup {year} Winning Team",
+    "osu!taiko World Cup {year} 2nd Place",
+    "osu!catch World Cup {year} Winning Team",
+    "Pending Cup {year} Winning Team",
+    "Community Choice Award {year}",
+    "Labour of Love: {year}",
+    "Fanart Contest {year} Winner",
+]
+
+
+def reference_filter_badges(badges: list[dict],
+                            filter_phrases: Iterable[str] = None,
+                            cutoff_date=BADGE_CUTOFF_DATE):
+    """
+    The original per-phrase implementation of `filter_badges`, kept as the baseline for benchmarks and equivalence
+    checks.
+    """
+    if filter_phrases is None:
+        filter_phrases = FILTER_PHRASES
+    return [badge for badge in badges
+            if not any([word.lower() in badge['description'].lower() for word in filter_phrases])
+            and (cutoff_date is None or datetime.datetime.fromisoformat(badge['awarded_at']) > cutoff_date)]
+
+
+def generate_badges(count: int, rng: random.Random) -> list[dict]:
+    badges = []
+    for i in range(count):
+        year = rng.randint(2012, 2024)
+        award_date = datetime.datetime(year, rng.randint(1, 12), rng.randint(1, 28),
+                                       rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                                       tzinfo=datetime.timezone.utc)
+        badges.append({
+            "awarded_at": award_date.isoformat(),
+            "description": rng.choice(BADGE_DESCRIPTIONS).format(year=year),
+            "image@2x_url": f"https://assets.ppy.sh/profile-badges/badge-{i}@2x.png",
+            "image_url": f"https://assets.ppy.sh/profile-badges/badge-{i}.png",
+            "url": ""
+        })
+    return badges
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the compiled badge filter against the original per-phrase implementation"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--players", default=1000, type=int)
+        parser.add_argument("--badges", default=40, type=int, help="badges per player")
+        parser.add_argument("--repeat", default=5, type=int)
+        parser.add_argument("--seed", default=727, type=int)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        payloads = [generate_badges(options['badges'], rng) for _ in range(options['players'])]
+
+        expected = [reference_filter_badges(badges) for badges in payloads]
+        if [filter_badges(badges) for badges in payloads] != expected or filter_badges_many(payloads) != expected:
+            raise CommandError("compiled badge filter results differ from the reference implementation")
+
+        get_badge_filter()  # compile outside the timed runs
+        candidates = {
+            "reference": lambda: [reference_filter_badges(badges) for badges in payloads],
+            "filter_badges": lambda: [filter_badges(badges) for badges in payloads],
+            "filter_badges_many": lambda: filter_badges_many(payloads),
+        }
+        badge_count = options['players'] * options['badges']
+        self.stdout.write(self.style.NOTICE(f"filtering {options['players']} players x {options['badges']} badges, "
+                                            f"best of {options['repeat']}"))
+        baseline = None
+        for name, candidate in candidates.items():
+            best = min(timeit.repeat(candidate, number=1, repeat=options['repeat']))
+            baseline = baseline or best
+            self.stdout.write(f"{name:>20}: {best * 1000:9.2f}ms "
+                              f"({badge_count / best:,.0f} badges/s, {baseline / best:.2f}x)")
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from userauth.authentication import recompute_bws, refresh_badge_eligibility
+
+
+class Command(BaseCommand):
+    help = ("Re-evaluates stored badge eligibility against the current filter phrases and recomputes BWS for all "
+            "tournament players, without calling the osu! API")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", default=1000, type=int)
+
+    def handle(self, *args, **options):
+        start_time = time.perf_counter()
+        refreshed = refresh_badge_eligibility()
+        self.stdout.write(
+            self.style.NOTICE(f"Re-evaluated eligibility of {refreshed} badges "
+                              f"in {time.perf_counter() - start_time:.3f}s")
+        )
+        start_time = time.perf_counter()
+        updated = recompute_bws(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f"Recomputed BWS, {updated} players changed in {time.perf_counter() - start_time:.3f}s")
+        )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from discord.refresh import AsyncRefresher
+from discord.tasks import get_osu_token
+from userauth.models import TournamentPlayer
+
+
+class Command(BaseCommand):
+    help = "Refreshes osu! stats and badges of tournament players concurrently, under the shared osu! API rate limit"
+
+    def add_arguments(self, parser):
+        parser.add_argument("user_ids", nargs="*", type=int, help="osu! user ids, defaults to every player")
+        parser.add_argument("--concurrency", default=8, type=int)
+        parser.add_argument("--batch-size", default=50, type=int, help="players per database write")
+
+    def handle(self, *args, **options):
+        players = TournamentPlayer.objects.all()
+        if options['user_ids']:
+            players = players.filter(osu_user_id__in=options['user_ids'])
+        token = get_osu_token()
+        if token is None:
+            raise CommandError("could not get an osu! API token")
+
+        stats = AsyncRefresher(token,
+                               concurrency=options['concurrency'],
+                               batch_size=options['batch_size']).refresh(list(players))
+        self.stdout.write(self.style.SUCCESS(f"Refreshed players: {stats}"))
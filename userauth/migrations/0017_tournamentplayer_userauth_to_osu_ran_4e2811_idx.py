@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0016_tournamentplayer_is_captain_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tournamentplayer',
+            index=models.Index(fields=['osu_rank_std_bws'], name='userauth_to_osu_ran_4e2811_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0017_tournamentplayer_userauth_to_osu_ran_4e2811_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournamentplayerbadge',
+            name='filter_version',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='tournamentplayerbadge',
+            name='is_eligible',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='tournamentplayerbadge',
+            index=models.Index(fields=['user', 'award_date'], name='userauth_to_user_id_89f0c5_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='tournamentplayerbadge',
+            name='userauth_to_user_id_e2d512_idx',
+        ),
+    ]
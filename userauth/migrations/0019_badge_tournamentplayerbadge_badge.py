@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0018_tournamentplayerbadge_is_eligible_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Badge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('description', models.TextField()),
+                ('url', models.TextField(blank=True)),
+                ('image_url', models.TextField()),
+                ('image_url_2x', models.TextField()),
+                ('is_eligible', models.BooleanField(default=True)),
+                ('filter_version', models.CharField(blank=True, max_length=16)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='tournamentplayerbadge',
+            name='badge',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='awards', to='userauth.badge'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+import hashlib
+
+from django.db import migrations
+
+
+BATCH_SIZE = 500
+
+
+def make_key(description, image_url):
+    # copy of Badge.make_key, historical models don't carry custom methods
+    return hashlib.sha256(f"{image_url}\n{description}".encode()).hexdigest()
+
+
+def populate_badge_catalog(apps, schema_editor):
+    Badge = apps.get_model('userauth', 'Badge')
+    TournamentPlayerBadge = apps.get_model('userauth', 'TournamentPlayerBadge')
+
+    catalog = {}
+    for badge in (TournamentPlayerBadge.objects
+                  .values('description', 'url', 'image_url', 'image_url_2x', 'is_eligible', 'filter_version')
+                  .distinct()
+                  .iterator()):
+        catalog.setdefault(make_key(badge['description'], badge['image_url']), badge)
+    Badge.objects.bulk_create([Badge(key=key, **badge) for key, badge in catalog.items()], batch_size=BATCH_SIZE)
+
+    # awards are linked in pk order, a batch at a time, rather than looked up by their unindexed text columns
+    badge_pks = dict(Badge.objects.values_list('key', 'pk'))
+    awards = TournamentPlayerBadge.objects.order_by('pk').values_list('pk', 'description', 'image_url')
+    last_pk = 0
+    while batch := list(awards.filter(pk__gt=last_pk)[:BATCH_SIZE]):
+        TournamentPlayerBadge.objects.bulk_update(
+            [TournamentPlayerBadge(pk=pk, badge_id=badge_pks[make_key(description, image_url)])
+             for pk, description, image_url in batch],
+            fields=['badge'],
+        )
+        last_pk = batch[-1][0]
+
+
+def depopulate_badge_catalog(apps, schema_editor):
+    Badge = apps.get_model('userauth', 'Badge')
+    for badge in Badge.objects.iterator():
+        badge.awards.update(description=badge.description,
+                            url=badge.url,
+                            image_url=badge.image_url,
+                            image_url_2x=badge.image_url_2x,
+                            is_eligible=badge.is_eligible,
+                            filter_version=badge.filter_version,
+                            badge=None)
+    Badge.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0019_badge_tournamentplayerbadge_badge'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_badge_catalog, depopulate_badge_catalog),
+    ]
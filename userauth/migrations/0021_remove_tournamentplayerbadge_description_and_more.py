@@ -0,0 +1,59 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0020_populate_badge_catalog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tournamentplayerbadge',
+            name='badge',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='awards', to='userauth.badge'),
+        ),
+        # defaults only let the columns be re-added to a populated table when migrating backwards
+        migrations.AlterField(
+            model_name='tournamentplayerbadge',
+            name='description',
+            field=models.TextField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='tournamentplayerbadge',
+            name='image_url',
+            field=models.TextField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='tournamentplayerbadge',
+            name='image_url_2x',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='tournamentplayerbadge',
+            name='description',
+        ),
+        migrations.RemoveField(
+            model_name='tournamentplayerbadge',
+            name='filter_version',
+        ),
+        migrations.RemoveField(
+            model_name='tournamentplayerbadge',
+            name='image_url',
+        ),
+        migrations.RemoveField(
+            model_name='tournamentplayerbadge',
+            name='image_url_2x',
+        ),
+        migrations.RemoveField(
+            model_name='tournamentplayerbadge',
+            name='is_eligible',
+        ),
+        migrations.RemoveField(
+            model_name='tournamentplayerbadge',
+            name='url',
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0021_remove_tournamentplayerbadge_description_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=64)),
+                ('message', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['pk'],
+            },
+        ),
+    ]
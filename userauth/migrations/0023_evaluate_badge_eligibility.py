@@ -0,0 +1,39 @@
+import hashlib
+
+from django.db import migrations
+
+
+# copy of userauth.authentication.FILTER_PHRASES as of this migration, later changes are applied by
+# refresh_badge_eligibility after every migrate
+FILTER_PHRASES = {"contrib", "nomination", "assessment", "moderation", "spotlight", "mapper", "mapping", "aspire",
+                  "monthly", "exemplary", "outstanding", "longstanding", "idol", "pending", "gmt", "global moderators",
+                  "trivium", "pickem", "fanart", "fan art", "skinning", "labour of love", "community choice",
+                  "community favourite", "mania", "taiko", "catch"}
+
+
+def evaluate_badge_eligibility(apps, schema_editor):
+    # badges stored before eligibility was, and the catalog populated from them, were all flagged eligible
+    Badge = apps.get_model('userauth', 'Badge')
+    phrases = sorted({phrase.lower() for phrase in FILTER_PHRASES})
+    # same as BadgeFilter.version, so that the phrases of this migration aren't evaluated again
+    filter_version = hashlib.sha1('\n'.join(phrases).encode()).hexdigest()[:16]
+    pks = {True: [], False: []}
+    for pk, description in Badge.objects.values_list('pk', 'description').iterator():
+        description = description.lower()
+        pks[not any(phrase in description for phrase in phrases)].append(pk)
+    for is_eligible, group in pks.items():
+        for i in range(0, len(group), 500):
+            (Badge.objects
+             .filter(pk__in=group[i:i + 500])
+             .update(is_eligible=is_eligible, filter_version=filter_version))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0022_registrationevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(evaluate_badge_eligibility, migrations.RunPython.noop),
+    ]
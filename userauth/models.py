@@ -1,3 +1,5 @@
+import hashlib
+
 from django.conf import settings
 from django.db import models
 from django.db.models import CheckConstraint, Q
@@ -39,7 +41,8 @@ class TournamentPlayer(models.Model):
         indexes = [
             models.Index(fields=['discord_user_id', 'osu_user_id']),
             models.Index(fields=['osu_user_id']),
-            models.Index(fields=['team'])
+            models.Index(fields=['team']),
+            models.Index(fields=['osu_rank_std_bws'])
         ]
         constraints = [
             CheckConstraint(name="not_both_roster_and_backup",
@@ -49,17 +52,37 @@ class TournamentPlayer(models.Model):
         ]
 
 
-class TournamentPlayerBadge(models.Model):
-    user = models.ForeignKey(TournamentPlayer, on_delete=models.CASCADE)
+class Badge(models.Model):
+    """
+    Catalog of osu! profile badges, one row per distinct badge however many players hold it.
+    """
+    key = models.CharField(max_length=64, unique=True)  # see `make_key`
     description = models.TextField()
-    award_date = models.DateTimeField()
     url = models.TextField(blank=True)
     image_url = models.TextField()
     image_url_2x = models.TextField()
 
+    # whether the description passes the badge filter phrases, as of the phrase set identified by `filter_version`
+    is_eligible = models.BooleanField(default=True)
+    filter_version = models.CharField(max_length=16, blank=True)
+
+    @staticmethod
+    def make_key(description: str, image_url: str) -> str:
+        # image urls are shared by some badges (and empty for others), the description tells those apart
+        return hashlib.sha256(f"{image_url}\n{description}".encode()).hexdigest()
+
+    def __str__(self):
+        return self.description
+
+
+class TournamentPlayerBadge(models.Model):
+    user = models.ForeignKey(TournamentPlayer, on_delete=models.CASCADE)
+    badge = models.ForeignKey(Badge, related_name='awards', on_delete=models.PROTECT)
+    award_date = models.DateTimeField()
+
     class Meta:
         indexes = (
-            models.Index(fields=('user',)),
+            models.Index(fields=('user', 'award_date')),
         )
 
 
@@ -68,3 +91,19 @@ class DisqualifiedUser(models.Model):
 
     def __str__(self):
         return f"https://osu.ppy.sh/users/{self.osu_user_id}"
+
+
+class RegistrationEvent(models.Model):
+    """
+    Outbox of the registration events sent to the Discord bot. Written in the transaction of the change they announce,
+    and published once it commits, see `userauth.outbox`.
+    """
+    type = models.CharField(max_length=64)  # channel layer message type, e.g. "registration.new"
+    message = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['pk']
+
+    def __str__(self):
+        return f"{self.type} {self.message}"
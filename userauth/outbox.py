@@ -0,0 +1,72 @@
+import json
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+from userauth.models import RegistrationEvent
+
+
+logger = logging.getLogger(__name__)
+DISPATCH_LOCK_KEY = "outbox:dispatch"
+
+
+def record_event(event_type: str, message: dict) -> RegistrationEvent:
+    """
+    Add an event to the outbox, as part of the current transaction. It is published by the next periodic dispatch after
+    the transaction commits, and never if it rolls back.
+    """
+    return RegistrationEvent.objects.create(type=event_type, message=message)
+
+
+async def publish(events: list[RegistrationEvent], published: list[int]):
+    channel_layer = get_channel_layer()
+    for event in events:
+        await channel_layer.group_send(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
+                                       {"type": event.type, "message": json.dumps(event.message)})
+        published.append(event.pk)
+
+
+def dispatch_events(batch_size: int = None, connection=None) -> int:
+    """
+    Publish the outbox to the Discord bot's channel group in order, `batch_size` events per transaction, deleting
+    them once sent. A single dispatch runs at a time, the others return straight away. If publishing fails, the events
+    left are retried by the next dispatch: delivery is at least once.
+    :return: number of events published
+    """
+    batch_size = batch_size or settings.OUTBOX_DISPATCH_BATCH_SIZE
+    lock = (connection or get_redis_connection("default")).lock(DISPATCH_LOCK_KEY,
+                                                                 timeout=settings.OUTBOX_DISPATCH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+    total = 0
+    try:
+        while True:
+            with transaction.atomic():
+                # should the lock expire mid-dispatch, the next one waits for these rows rather than overtaking them
+                events = list(RegistrationEvent.objects.select_for_update()[:batch_size])
+                if not events:
+                    break
+                published = []
+                failed = False
+                try:
+                    async_to_sync(publish)(events, published)
+                except Exception as e:  # keep what was sent deleted, the transaction must commit
+                    logger.warning(f"[outbox] publishing failed after {len(published)} of {len(events)} events: {e}")
+                    failed = True
+                RegistrationEvent.objects.filter(pk__in=published).delete()
+                total += len(published)
+            if failed or len(events) < batch_size:
+                break
+    finally:
+        try:
+            lock.release()
+        except LockError:  # expired while dispatching
+            pass
+    if total:
+        logger.info(f"[outbox] published {total} registration events")
+    return total
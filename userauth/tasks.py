@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from userauth.outbox import dispatch_events
+
+
+@shared_task
+def dispatch_registration_events() -> int:
+    return dispatch_events()
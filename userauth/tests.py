@@ -1,16 +1,34 @@
 import datetime
+import json
+import random
+from io import StringIO
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import fakeredis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from parameterized import parameterized
+import httpx
 from rest_framework.exceptions import PermissionDenied
 
-from userauth.authentication import filter_badges, bws, DiscordAndOsuAuthBackend
+from teammgmt.models import TournamentTeam
+from userauth.authentication import BADGE_CUTOFF_DATE, FILTER_PHRASES, filter_badges, filter_badges_many, \
+    get_badge_filter, bws, count_eligible_badges, prep_badges_for_db, recompute_bws, refresh_badge_eligibility, \
+    upsert_badges, DiscordAndOsuAuthBackend
+from userauth.management.commands.bench_badge_filter import generate_badges, reference_filter_badges
 from rest_framework.test import APIRequestFactory
 from django.contrib.auth import authenticate
 
-from userauth.models import DisqualifiedUser
-from userauth.views import DiscordAuth, OsuAuth, SessionDetails
+from userauth.models import Badge, DisqualifiedUser, RegistrationEvent, TournamentPlayer, TournamentPlayerBadge
+from userauth.outbox import DISPATCH_LOCK_KEY, dispatch_events, record_event
+from fivedigitworldcup.http import get_async_api_client
+from userauth.views import DiscordAuth, OsuAuth, SessionDetails, SessionLogin
 
 
 class NoOpAuthEndpointsTestCase(TestCase):
@@ -27,6 +45,28 @@ class NoOpAuthEndpointsTestCase(TestCase):
         self.assertDictEqual({"727": "when you see it"}, response.data)
 
 
+class OauthUpstreamTimeoutTestCase(TestCase):
+    @parameterized.expand([
+        ('/auth/osu/code/',),
+        ('/auth/discord/discord_code/',),
+    ])
+    def test_upstream_timeout(self, url):
+        client = MagicMock()
+        client.post = AsyncMock(side_effect=httpx.ReadTimeout("read timed out"))
+        with patch('userauth.views.get_async_api_client', return_value=client):
+            res = self.client.get(f'{url}?code=727')
+        self.assertEqual(504, res.status_code)
+        client.get.assert_not_called()
+
+    def test_async_api_client_per_loop(self):
+        async def get_clients():
+            return get_async_api_client(), get_async_api_client()
+
+        first, second = async_to_sync(get_clients)()
+        self.assertIs(first, second)
+        self.assertIsNot(first, async_to_sync(get_clients)()[0])
+
+
 class DiscordAndOsuLoginTestCase(TestCase):
     def setUp(self):
         settings.USER_REGISTRATION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
@@ -78,10 +118,9 @@ class DiscordAndOsuLoginTestCase(TestCase):
         dq_user_id = 1234727
         DisqualifiedUser.objects.get_or_create(osu_user_id=dq_user_id)
         req.session = {"osu_user_data": {"id": dq_user_id}, "discord_user_data": {}}
-        session_login_view = SessionDetails.as_view({'get': 'login'})
-        response = session_login_view(req)
+        response = async_to_sync(SessionLogin.as_view())(req)
         self.assertEqual(403, response.status_code)
-        self.assertEqual("user disqualified", response.data["error"])
+        self.assertEqual("user disqualified", json.loads(response.content)["error"])
 
     def test_login_not_disqualified_user(self):
         factory = APIRequestFactory()
@@ -89,18 +128,16 @@ class DiscordAndOsuLoginTestCase(TestCase):
 
         dq_user_id = 1234727
         req.session = {"osu_user_data": {"id": dq_user_id}, "discord_user_data": {}}
-        session_login_view = SessionDetails.as_view({'get': 'login'})
-        response = session_login_view(req)
-        self.assertNotEqual("user disqualified", response.data["error"])
+        response = async_to_sync(SessionLogin.as_view())(req)
+        self.assertNotEqual("user disqualified", json.loads(response.content)["error"])
 
     def test_login_no_session(self):
         factory = APIRequestFactory()
         req = factory.get('/auth/session/login/')
         req.session = {}
-        session_login_view = SessionDetails.as_view({'get': 'login'})
-        response = session_login_view(req)
+        response = async_to_sync(SessionLogin.as_view())(req)
         self.assertEqual(401, response.status_code)
-        self.assertEqual("required discord or osu! session missing", response.data["msg"])
+        self.assertEqual("required discord or osu! session missing", json.loads(response.content)["msg"])
 
     @parameterized.expand([
         ({'id': "874598213518214312", 'username': 'jame', 'discriminator': '0443'}, 'jame#0443'),
@@ -539,6 +576,159 @@ class DiscordAndOsuLoginTestCase(TestCase):
         self.assertEqual(expected_bws, user.tournamentplayer.osu_rank_std_bws)
 
 
+class AuthenticateQueryCountTestCase(TestCase):
+    osu_data = {
+        'id': 2155578,
+        'username': 'Azer',
+        'country_code': 'CA',
+        'statistics': {"global_rank": 1292},
+        'badges': [{"awarded_at": "2023-03-30T07:08:21+00:00",
+                    "description": "Americas Draft Showdown 2023 Division 2 Winning Team",
+                    "image@2x_url": "https://assets.ppy.sh/profile-badges/ads-d2-2023@2x.png",
+                    "image_url": "https://assets.ppy.sh/profile-badges/ads-d2-2023.png",
+                    "url": "https://osu.ppy.sh/community/forums/topics/1705194"},
+                   {"awarded_at": "2020-12-15T08:19:07+00:00",
+                    "description": "Dio's Autumn Singles Tier 3 Winner",
+                    "image@2x_url": "https://assets.ppy.sh/profile-badges/dios-t3-2020@2x.png",
+                    "image_url": "https://assets.ppy.sh/profile-badges/dios-t3-2020.png",
+                    "url": ""}]
+    }
+
+    def setUp(self):
+        settings.USER_REGISTRATION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                                          datetime.timedelta(days=2))
+
+    def login(self, discord_id: str):
+        return authenticate(APIRequestFactory().get('/auth/session/login/'),
+                            discord_user_data={"id": discord_id, "username": "azer", "discriminator": "0"},
+                            osu_user_data=self.osu_data)
+
+    def test_new_user(self):
+        # player lookup, badge catalog upsert (3), team lookup and insert (teams read within the test's transaction
+        # aren't kept by the team cache), user get_or_create (2), player, badges and outbox event inserts, and the
+        # SAVEPOINT/RELEASE pairs of the transaction and of get_or_create
+        with self.assertNumQueries(15):
+            user = self.login("0")
+        self.assertEqual("0.2155578", user.username)
+        self.assertEqual("CA", user.tournamentplayer.team_id)
+        self.assertEqual(2, TournamentPlayerBadge.objects.filter(user=user.tournamentplayer).count())
+        self.assertEqual(bws(1, 1292), user.tournamentplayer.osu_rank_std_bws)
+
+    def test_new_user_known_badges(self):
+        upsert_badges(self.osu_data['badges'])
+        TournamentTeam.objects.create(osu_flag='CA')
+        with self.assertNumQueries(12):
+            user = self.login("0")
+        self.assertEqual("CA", user.tournamentplayer.team_id)
+
+    def test_returning_user(self):
+        self.login("0")
+        with self.assertNumQueries(1):
+            user = self.login("0")
+        self.assertEqual("0.2155578", user.username)
+        self.assertEqual(1, TournamentPlayer.objects.count())
+
+    def test_discord_switch(self):
+        old_user = self.login("0")
+        # player lookup, user and player updates and the outbox event in a transaction
+        with self.assertNumQueries(6):
+            user = self.login("1")
+        self.assertEqual(old_user.pk, user.pk)
+        user.refresh_from_db()
+        self.assertEqual("1.2155578", user.username)
+        self.assertEqual("1", user.tournamentplayer.discord_user_id)
+        self.assertEqual(1, User.objects.count())
+
+
+class RegistrationOutboxTestCase(TestCase):
+    def setUp(self):
+        settings.USER_REGISTRATION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                                          datetime.timedelta(days=2))
+        self.channel_layer = get_channel_layer()
+        self.channel_name = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)(settings.CHANNELS_DISCORD_WS_GROUP_NAME, self.channel_name)
+
+    def tearDown(self):
+        async_to_sync(self.channel_layer.flush)()
+
+    def receive(self) -> dict:
+        return async_to_sync(self.channel_layer.receive)(self.channel_name)
+
+    def test_event_recorded(self):
+        # left to the periodic dispatch: the request never waits on the broker
+        with patch('userauth.tasks.dispatch_registration_events.delay') as mocked_delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            authenticate(APIRequestFactory().get('/auth/session/login/'),
+                         discord_user_data={"id": "0", "username": "0", "discriminator": "0"},
+                         osu_user_data=AuthenticateQueryCountTestCase.osu_data)
+        self.assertFalse(mocked_delay.called)
+        event = RegistrationEvent.objects.get()
+        self.assertEqual("registration.new", event.type)
+        self.assertEqual(2155578, event.message['osu_user_id'])
+
+    def test_no_event_on_rollback(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(ValueError), transaction.atomic():
+                record_event("registration.new", {"action": "register"})
+                raise ValueError
+        self.assertFalse(RegistrationEvent.objects.exists())
+        self.assertEqual([], callbacks)
+
+    def test_delete_account(self):
+        user = User.objects.create(username="0.2155578")
+        TournamentPlayer.objects.create(user=user, discord_user_id="0", discord_username="0", osu_user_id=2155578,
+                                        osu_username="Azer", osu_flag="CA",
+                                        osu_stats_updated=datetime.datetime.now(tz=datetime.timezone.utc))
+        req = APIRequestFactory().delete('/auth/session/delete_account/')
+        req.user = user
+        req.session = self.client.session
+        res = SessionDetails.as_view({'delete': 'delete_account'})(req)
+        self.assertEqual(204, res.status_code)
+        self.assertFalse(User.objects.filter(pk=user.pk).exists())
+        event = RegistrationEvent.objects.get()
+        self.assertEqual("registration.delete", event.type)
+        self.assertEqual({"discord_user_id": "0", "osu_user_id": 2155578, "action": "delete"}, event.message)
+
+    def test_dispatch_events(self):
+        for i in range(3):
+            RegistrationEvent.objects.create(type="registration.new", message={"osu_user_id": i})
+        self.assertEqual(3, dispatch_events(batch_size=2))
+        self.assertFalse(RegistrationEvent.objects.exists())
+        for i in range(3):
+            message = self.receive()
+            self.assertEqual("registration.new", message["type"])
+            self.assertEqual({"osu_user_id": i}, json.loads(message["message"]))
+
+    def test_single_dispatcher(self):
+        RegistrationEvent.objects.create(type="registration.new", message={"osu_user_id": 0})
+        connection = fakeredis.FakeRedis()
+        lock = connection.lock(DISPATCH_LOCK_KEY)
+        lock.acquire()
+        self.assertEqual(0, dispatch_events(connection=connection))
+        lock.release()
+        self.assertEqual(1, dispatch_events(connection=connection))
+        self.assertFalse(connection.exists(DISPATCH_LOCK_KEY))
+
+    def test_dispatch_events_failure(self):
+        for i in range(3):
+            RegistrationEvent.objects.create(type="registration.new", message={"osu_user_id": i})
+        group_send = self.channel_layer.group_send
+        sent = []
+
+        async def flaky_group_send(group, message):
+            if sent:
+                raise ConnectionError("redis is down")
+            sent.append(message)
+            await group_send(group, message)
+
+        with patch.object(self.channel_layer, 'group_send', flaky_group_send):
+            self.assertEqual(1, dispatch_events(batch_size=2))
+        # the events left are sent by the next dispatch
+        self.assertEqual([1, 2], [event.message['osu_user_id'] for event in RegistrationEvent.objects.all()])
+        self.assertEqual(2, dispatch_events())
+        self.assertEqual([0, 1, 2], [json.loads(self.receive()["message"])["osu_user_id"] for _ in range(3)])
+
+
 class BadgeWeightedSeedingCalculationTestCase(TestCase):
     @parameterized.expand([
         (5, 832141, 113493),
@@ -802,3 +992,178 @@ class BadgeFilterTestCase(TestCase):
         else:
             filtered_badges = filter_badges(badges, [], cutoff_date=cutoff_date)
         self.assertCountEqual(filtered_badges, expected)
+
+
+class CompiledBadgeFilterTestCase(TestCase):
+    @parameterized.expand([
+        ("default_phrases", None),
+        ("no_phrases", []),
+        ("uppercase_phrases", ["WORLD CUP", "Winning"]),
+        ("regex_metacharacters", ["#6", "(canada)", "top 3 in the user/beatmap", ".*"]),
+        ("overlapping_phrases", ["world", "world cup", "cup"]),
+        ("empty_phrase", [""]),
+    ])
+    def test_matches_reference_implementation(self, _, filter_phrases):
+        rng = random.Random(727)
+        payloads = [generate_badges(rng.randint(0, 30), rng) for _ in range(50)]
+        for cutoff_date in (None, BADGE_CUTOFF_DATE):
+            expected = [reference_filter_badges(badges, filter_phrases, cutoff_date) for badges in payloads]
+            self.assertEqual(expected, [filter_badges(badges, filter_phrases, cutoff_date) for badges in payloads])
+            self.assertEqual(expected, filter_badges_many(payloads, filter_phrases, cutoff_date))
+
+    def test_unicode_case_folding(self):
+        badges = [{'awarded_at': '2023-01-01T00:00:00+00:00', 'description': 'ŚWIĘTO osu!'}]
+        self.assertEqual(reference_filter_badges(badges, ["święto"]), filter_badges(badges, ["święto"]))
+        self.assertEqual([], filter_badges(badges, ["święto"]))
+
+    def test_compiled_once_per_phrase_set(self):
+        self.assertIs(get_badge_filter(["a", "b"]), get_badge_filter(("b", "a")))
+        self.assertIs(get_badge_filter(), get_badge_filter(FILTER_PHRASES))
+
+    def test_bench_command(self):
+        out = StringIO()
+        call_command("bench_badge_filter", players=10, badges=5, repeat=1, stdout=out)
+        self.assertIn("filter_badges_many", out.getvalue())
+
+
+class BadgeEligibilityTestCase(TestCase):
+    def setUp(self):
+        team = TournamentTeam.objects.create(osu_flag="CA")
+        self.player = TournamentPlayer.objects.create(user=User.objects.create(),
+                                                      team=team,
+                                                      osu_user_id=1,
+                                                      osu_stats_updated=datetime.datetime.now(datetime.timezone.utc))
+        self.osu_data = {'badges': [
+            {"awarded_at": "2023-11-19T21:25:58+00:00",
+             "description": "Outstanding contribution to the osu! tournament scene and the World Cups",
+             "image@2x_url": "", "image_url": "", "url": ""},
+            {"awarded_at": "2020-12-06T19:38:15+00:00",
+             "description": "osu! World Cup 2020 3rd Place (Canada)",
+             "image@2x_url": "", "image_url": "", "url": ""},
+            {"awarded_at": "2023-04-30T11:49:15+00:00",
+             "description": "Spring Flower Scramble: Wisteria Winning Team",
+             "image@2x_url": "", "image_url": "", "url": ""},
+        ]}
+
+    def test_prep_badges_keeps_ineligible_badges(self):
+        eligible_badges, db_badges = prep_badges_for_db(self.osu_data, self.player)
+
+        self.assertEqual(self.osu_data['badges'][1:], eligible_badges)
+        self.assertEqual([False, True, True], [badge.badge.is_eligible for badge in db_badges])
+        self.assertTrue(all(badge.badge.filter_version == get_badge_filter().version for badge in db_badges))
+
+    def test_prep_badges_shares_catalog(self):
+        other_player = TournamentPlayer.objects.create(user=User.objects.create(username="other"),
+                                                       team=self.player.team,
+                                                       osu_user_id=2,
+                                                       osu_stats_updated=self.player.osu_stats_updated)
+        _, db_badges = prep_badges_for_db(self.osu_data, self.player)
+        TournamentPlayerBadge.objects.bulk_create(db_badges)
+        with self.assertNumQueries(1):  # every badge is already in the catalog
+            _, other_db_badges = prep_badges_for_db(self.osu_data, other_player)
+        TournamentPlayerBadge.objects.bulk_create(other_db_badges)
+
+        self.assertEqual(3, Badge.objects.count())
+        self.assertEqual(6, TournamentPlayerBadge.objects.count())
+        self.assertEqual([badge.badge_id for badge in db_badges], [badge.badge_id for badge in other_db_badges])
+
+    def test_refresh_after_phrase_change(self):
+        _, db_badges = prep_badges_for_db(self.osu_data, self.player)
+        TournamentPlayerBadge.objects.bulk_create(db_badges)
+        self.assertEqual(0, refresh_badge_eligibility())
+
+        with patch('userauth.authentication.FILTER_PHRASES', {"world cup"}):
+            self.assertEqual(3, refresh_badge_eligibility())
+            self.assertEqual(0, refresh_badge_eligibility())
+            self.assertEqual(["Spring Flower Scramble: Wisteria Winning Team"],
+                             list(Badge.objects.filter(is_eligible=True).values_list('description', flat=True)))
+            self.assertEqual({self.player.pk: 1}, count_eligible_badges(cutoff_date=None))
+
+    def test_stale_eligibility_evaluated_after_migrate(self):
+        # as left by the migration of badges stored before eligibility was: every badge flagged eligible
+        for badge in self.osu_data['badges']:
+            catalog_badge = Badge.objects.create(key=Badge.make_key(badge['description'], badge['image_url']),
+                                                 description=badge['description'],
+                                                 is_eligible=True,
+                                                 filter_version='')
+            TournamentPlayerBadge.objects.create(user=self.player, badge=catalog_badge,
+                                                 award_date=datetime.datetime.fromisoformat(badge['awarded_at']))
+        self.assertEqual({self.player.pk: 2}, count_eligible_badges())  # read as stored, not re-evaluated
+        call_command("migrate", verbosity=0)
+        self.assertEqual({self.player.pk: 1}, count_eligible_badges())
+        self.assertFalse(Badge.objects.exclude(filter_version=get_badge_filter().version).exists())
+
+class RecomputeBwsTestCase(TestCase):
+    def setUp(self):
+        team = TournamentTeam.objects.create(osu_flag="CA")
+        self.players = []
+        for pk, (rank, badge_descriptions) in enumerate([
+            (1292, ["osu! World Cup 2020 3rd Place (Canada)", "Spring Flower Scramble: Wisteria Winning Team",
+                    "Longstanding commitment to World Cup Pooling (3 years)"]),
+            (69727, ["OWCT 2018 Winning Team"] * 4),
+            (42387, []),
+            (None, ["Villoux Tournament #6 Winner"]),
+        ]):
+            user = User.objects.create(pk=pk + 1, username=f"user_{pk + 1}")
+            player = TournamentPlayer.objects.create(user=user,
+                                                     team=team,
+                                                     osu_user_id=pk + 1,
+                                                     osu_rank_std=rank,
+                                                     osu_rank_std_bws=1,
+                                                     osu_stats_updated=datetime.datetime.now(datetime.timezone.utc))
+            TournamentPlayerBadge.objects.bulk_create([
+                TournamentPlayerBadge(user=player,
+                                      badge=self.get_catalog_badge(description),
+                                      award_date=datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc))
+                for description in badge_descriptions
+            ])
+            self.players.append(player)
+        # too old to count
+        TournamentPlayerBadge.objects.create(user=self.players[2],
+                                             badge=self.get_catalog_badge("osu! World Cup 2019 Winner"),
+                                             award_date=datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc))
+
+    @staticmethod
+    def get_catalog_badge(description):
+        badge, _ = Badge.objects.get_or_create(key=Badge.make_key(description, ""),
+                                               defaults={'description': description,
+                                                         'image_url': "",
+                                                         'image_url_2x': ""})
+        return badge
+
+    def test_recompute_bws(self):
+        with patch('discord.tasks.api_client') as mocked_api_client, \
+                CaptureQueriesContext(connection) as queries:
+            updated = recompute_bws(batch_size=2)
+            self.assertFalse(mocked_api_client.mock_calls)
+
+        self.assertEqual(4, updated)
+        # one UPDATE per batch, each in its own transaction (a savepoint within the test's)
+        updates = [i for i, query in enumerate(queries.captured_queries)
+                   if query['sql'].startswith('UPDATE "userauth_tournamentplayer"')]
+        self.assertEqual(2, len(updates))
+        for i in updates:
+            self.assertTrue(queries.captured_queries[i - 1]['sql'].startswith('SAVEPOINT'))
+        expected = [bws(2, 1292), bws(4, 69727), bws(0, 42387), None]
+        for player, expected_bws in zip(self.players, expected):
+            player.refresh_from_db()
+            self.assertEqual(expected_bws, player.osu_rank_std_bws)
+
+    def test_recompute_bws_custom_filter(self):
+        recompute_bws(filter_phrases=["owct"], cutoff_date=None)
+
+        expected = [bws(3, 1292), bws(0, 69727), bws(1, 42387)]
+        for player, expected_bws in zip(self.players, expected):
+            player.refresh_from_db()
+            self.assertEqual(expected_bws, player.osu_rank_std_bws)
+
+    def test_recompute_bws_unchanged(self):
+        recompute_bws()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(0, recompute_bws())
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith('UPDATE')])
+
+    def test_recompute_bws_command(self):
+        out = StringIO()
+        call_command("recompute_bws", stdout=out)
+        self.assertIn("4 players changed", out.getvalue())
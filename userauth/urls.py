@@ -13,6 +13,10 @@ router.register('users', views.UserViewSet)
 
 
 urlpatterns = [
+    # async views, ahead of the router so they serve what used to be viewset actions
+    path('osu/code/', views.OsuCallback.as_view()),
+    path('discord/discord_code/', views.DiscordCallback.as_view()),
+    path('session/login/', views.SessionLogin.as_view()),
     path('', include(router.urls)),
     path('login', views.login_frontend)
 ]
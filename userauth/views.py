@@ -1,26 +1,32 @@
 import json
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, redirect
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, status, serializers
-import requests
+import httpx
 import urllib.parse
 from django.conf import settings
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from django.contrib.auth import authenticate, login, logout
+from django.db import transaction
 import django.dispatch
 
+from fivedigitworldcup.http import get_async_api_client
+from fivedigitworldcup.ratelimit import osu_api_limiter
 from userauth.models import DisqualifiedUser
+from userauth.outbox import record_event
 
 login_signal = django.dispatch.Signal()
 
 
 def parse_return_page(request):
-    return_page: str | None = request.query_params.get("state", "")  # default retval will cause "starts with /" to fail
+    return_page: str | None = request.GET.get("state", "")  # default retval will cause "starts with /" to fail
     return_page = urllib.parse.unquote(return_page)
 
     # TODO: add this back when frontend/backend are hosted together or add FRONTEND_BASEURL env var and check against it
@@ -49,27 +55,6 @@ class SessionDetails(viewsets.ViewSet):
         logout(request)
         return Response({"ok": "logged out"}, status=status.HTTP_200_OK)
 
-    @action(methods=['get', 'post'], detail=False)
-    def login(self, request):
-        osu_user_data = request.session.get("osu_user_data")
-
-        if request.session.get("discord_user_data") is None or osu_user_data is None:
-            return Response({"error": "failed to authenticate", "msg": "required discord or osu! session missing"},
-                            status=status.HTTP_401_UNAUTHORIZED)
-        is_user_disqualified = DisqualifiedUser.objects.filter(osu_user_id=osu_user_data['id']).exists()
-        if is_user_disqualified:
-            return Response({"error": "user disqualified",
-                             "msg": f"osu user id {osu_user_data['id']} has been disqualified by an administrator"},
-                            status=status.HTTP_403_FORBIDDEN)
-
-        user: User = authenticate(request,
-                                  discord_user_data=request.session.get("discord_user_data"),
-                                  osu_user_data=osu_user_data)
-        if user is not None:
-            login(request, user)
-            return Response({"ok": "logged in", "user": user.username})
-        return Response({"error": "failed to authenticate"}, status=status.HTTP_401_UNAUTHORIZED)
-
     @action(methods=['delete'], detail=False)
     def delete_account(self, request):
         # todo: using authentication classes would make this a lot easier no?
@@ -77,23 +62,55 @@ class SessionDetails(viewsets.ViewSet):
             return Response({"error": "not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
         user = request.user
 
-        try:
-            channel_layer = get_channel_layer()
-            # noinspection PyArgumentList
-            async_to_sync(channel_layer.group_send)(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
-                                                    {
-                                                        "type": "registration.delete",
-                                                        "message": json.dumps({
-                                                            "discord_user_id": user.tournamentplayer.discord_user_id,
-                                                            "osu_user_id": user.tournamentplayer.osu_user_id,
-                                                            "action": "delete"  # errr... this should really be done at
-                                                            # the consumer.py side of things
-                                                        })
-                                                    })
-        finally:
-            logout(request)
+        logout(request)
+        with transaction.atomic():
+            if hasattr(user, 'tournamentplayer'):
+                # errr... "action" should really be done at the consumer.py side of things
+                record_event("registration.delete", {"discord_user_id": user.tournamentplayer.discord_user_id,
+                                                     "osu_user_id": user.tournamentplayer.osu_user_id,
+                                                     "action": "delete"})
             user.delete()
-            return Response(None, status=status.HTTP_204_NO_CONTENT)
+        return Response(None, status=status.HTTP_204_NO_CONTENT)
+
+
+async def get_session_data(request, *keys) -> list:
+    """
+    Session values, read in a thread as loading the session hits the session store.
+    """
+    return await sync_to_async(lambda: [request.session.get(key) for key in keys])()
+
+
+async def set_session_data(request, key, value):
+    await sync_to_async(request.session.__setitem__)(key, value)
+
+
+@method_decorator(csrf_exempt, name='dispatch')  # like the DRF action it replaces
+class SessionLogin(View):
+    """
+    `GET/POST /auth/session/login/`, async so that logins don't hold a worker thread.
+    """
+
+    async def get(self, request):
+        discord_user_data, osu_user_data = await get_session_data(request, "discord_user_data", "osu_user_data")
+
+        if discord_user_data is None or osu_user_data is None:
+            return JsonResponse({"error": "failed to authenticate", "msg": "required discord or osu! session missing"},
+                                status=status.HTTP_401_UNAUTHORIZED)
+        if await DisqualifiedUser.objects.filter(osu_user_id=osu_user_data['id']).aexists():
+            return JsonResponse({"error": "user disqualified",
+                                 "msg": f"osu user id {osu_user_data['id']} has been disqualified by an administrator"},
+                                status=status.HTTP_403_FORBIDDEN)
+
+        user: User = await sync_to_async(authenticate)(request,
+                                                       discord_user_data=discord_user_data,
+                                                       osu_user_data=osu_user_data)
+        if user is not None:
+            await sync_to_async(login)(request, user)
+            return JsonResponse({"ok": "logged in", "user": user.username})
+        return JsonResponse({"error": "failed to authenticate"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    async def post(self, request):
+        return await self.get(request)
 
 
 class OauthWithRedirect:
@@ -109,6 +126,53 @@ class OauthWithRedirect:
 
 
 # todo: on osu login, invalidate previous logged-in user
+class OsuCallback(View, OauthWithRedirect):
+    """
+    `GET /auth/osu/code/`: trades the OAuth code for a token and fetches the osu! user into the session. Async, so
+    the two upstream requests don't hold a worker thread while waiting.
+    """
+    REDIRECT_SUFFIX = settings.OSU_REDIRECT_URI_SUFFIX
+
+    async def get(self, request):
+        code = request.GET.get("code", None)
+        return_page = parse_return_page(request)
+        if code is None:
+            return JsonResponse({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # token exchange and user lookup
+        if not await osu_api_limiter.async_acquire(2, timeout=settings.OSU_API_RATE_LIMIT_TIMEOUT, use_reserve=True):
+            return JsonResponse({"error": "too many osu! logins at once, please try again in a moment"},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        client = get_async_api_client()
+        try:
+            r = await client.post(f'{settings.OSU_OAUTH_ENDPOINT}/token',
+                                  data={'grant_type': 'authorization_code',
+                                        'code': code,
+                                        'redirect_uri': self.get_redirect_url(request)},
+                                  headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                  auth=(settings.OSU_CLIENT_ID, settings.OSU_CLIENT_SECRET))
+            if r.status_code != 200:
+                try:
+                    return JsonResponse(r.json(), status=r.status_code, safe=False)
+                except json.JSONDecodeError:
+                    print(r.content)
+                    return HttpResponse(r.content, status=r.status_code)
+
+            auth_data = r.json()
+            # fetch user information
+            r = await client.get(f"{settings.OSU_API_ENDPOINT}/me/osu",
+                                 headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
+        except httpx.HTTPError as e:
+            return JsonResponse({"error": f"osu! is not responding: {e}"}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        if r.status_code != 200:
+            return JsonResponse(r.json(), status=r.status_code, safe=False)
+        user_data = r.json()
+        await set_session_data(request, "osu_user_data", user_data)
+        if return_page is not None:
+            return redirect(return_page)
+        return JsonResponse(user_data, status=r.status_code)
+
+
 class OsuAuth(viewsets.ViewSet, OauthWithRedirect):
     REDIRECT_SUFFIX = settings.OSU_REDIRECT_URI_SUFFIX
 
@@ -125,65 +189,22 @@ class OsuAuth(viewsets.ViewSet, OauthWithRedirect):
             uri += f"&state={return_page}"
         return HttpResponseRedirect(redirect_to=uri)
 
-    @action(methods=['get'], detail=False)
-    def code(self, request):
-        code = request.query_params.get("code", None)
-        return_page = parse_return_page(request)
-        if code is None:
-            return Response({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
-
-        r = requests.post(f'{settings.OSU_OAUTH_ENDPOINT}/token',
-                          data={'grant_type': 'authorization_code',
-                                'code': code,
-                                'redirect_uri': self.get_redirect_url(request)},
-                          headers={'Content-Type': 'application/x-www-form-urlencoded'},
-                          auth=(settings.OSU_CLIENT_ID, settings.OSU_CLIENT_SECRET))
-        if r.status_code != 200:
-            try:
-                return Response(r.json(), status=r.status_code)
-            except json.JSONDecodeError:
-                print(r.content)
-                return Response(r.content, status=r.status_code)
-
-        auth_data = r.json()
-        # fetch user information
-        r = requests.get(f"{settings.OSU_API_ENDPOINT}/me/osu",
-                         headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
-        if r.status_code != 200:
-            return Response(r.json(), status=r.status_code)
-        user_data = r.json()
-        request.session["osu_user_data"] = user_data
-        if return_page is not None:
-            return redirect(return_page)
-        return Response(user_data, status=r.status_code)
-
     @staticmethod
     def list(request):
         return Response({"727": "when you see it"})
 
 
-class DiscordAuth(viewsets.ViewSet, OauthWithRedirect):
+class DiscordCallback(View, OauthWithRedirect):
+    """
+    `GET /auth/discord/discord_code/`, the Discord counterpart of `OsuCallback`.
+    """
     REDIRECT_SUFFIX = settings.DISCORD_REDIRECT_URI_SUFFIX
 
-    @action(methods=['get'], detail=False)
-    def prompt_login(self, request):
-        return_page = request.query_params.get("return_page", None)
-        uri = (f"https://discord.com/oauth2/authorize"
-               f"?response_type=code"
-               f"&client_id={settings.DISCORD_CLIENT_ID}"
-               f"&scope=identify"
-               f"&redirect_uri={urllib.parse.quote(self.get_redirect_url(request))}"
-               f"&prompt=consent")
-        if return_page is not None:
-            uri += f"&state={return_page}"
-        return HttpResponseRedirect(redirect_to=uri)
-
-    @action(methods=['get'], detail=False)
-    def discord_code(self, request):
-        code = request.query_params.get("code", None)
+    async def get(self, request):
+        code = request.GET.get("code", None)
         return_page = parse_return_page(request)
         if code is None:
-            return Response({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
 
         # access token exchange
         data = {
@@ -192,29 +213,47 @@ class DiscordAuth(viewsets.ViewSet, OauthWithRedirect):
             'redirect_uri': self.get_redirect_url(request)
         }
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        r = requests.post(f'{settings.DISCORD_API_ENDPOINT}/oauth2/token',
-                          data=data,
-                          headers=headers,
-                          auth=(settings.DISCORD_CLIENT_ID, settings.DISCORD_CLIENT_SECRET))
-        if r.status_code != 200:
-            return Response({"message": "failed trading code for token",
-                             "payload": {k: v if k != 'code' else '<redacted>' for k, v in data.items()},
-                             "error": r.json()}, status=r.status_code)
-        auth_data = r.json()
-
-        # fetch user information
-        r = requests.get(f"{settings.DISCORD_API_ENDPOINT}/oauth2/@me",
-                         headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
+        client = get_async_api_client()
+        try:
+            r = await client.post(f'{settings.DISCORD_API_ENDPOINT}/oauth2/token',
+                                  data=data,
+                                  headers=headers,
+                                  auth=(settings.DISCORD_CLIENT_ID, settings.DISCORD_CLIENT_SECRET))
+            if r.status_code != 200:
+                return JsonResponse({"message": "failed trading code for token",
+                                     "payload": {k: v if k != 'code' else '<redacted>' for k, v in data.items()},
+                                     "error": r.json()}, status=r.status_code)
+            auth_data = r.json()
+
+            # fetch user information
+            r = await client.get(f"{settings.DISCORD_API_ENDPOINT}/oauth2/@me",
+                                 headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
+        except httpx.HTTPError as e:
+            return JsonResponse({"error": f"Discord is not responding: {e}"}, status=status.HTTP_504_GATEWAY_TIMEOUT)
         if r.status_code != 200:
-            return Response(r.json(), status=r.status_code)
+            return JsonResponse(r.json(), status=r.status_code, safe=False)
         user_data = r.json().get("user")
-        request.session["discord_user_data"] = user_data
+        await set_session_data(request, "discord_user_data", user_data)
         if return_page is not None:
             return redirect(return_page)
-        return Response(user_data, status=r.status_code)
+        return JsonResponse(user_data, status=r.status_code, safe=False)
+
+
+class DiscordAuth(viewsets.ViewSet, OauthWithRedirect):
+    REDIRECT_SUFFIX = settings.DISCORD_REDIRECT_URI_SUFFIX
 
-        # check if user exists
-        # if TournamentPlayer.objects.filter(discord_user_id)
+    @action(methods=['get'], detail=False)
+    def prompt_login(self, request):
+        return_page = request.query_params.get("return_page", None)
+        uri = (f"https://discord.com/oauth2/authorize"
+               f"?response_type=code"
+               f"&client_id={settings.DISCORD_CLIENT_ID}"
+               f"&scope=identify"
+               f"&redirect_uri={urllib.parse.quote(self.get_redirect_url(request))}"
+               f"&prompt=consent")
+        if return_page is not None:
+            uri += f"&state={return_page}"
+        return HttpResponseRedirect(redirect_to=uri)
 
     @action(methods=['get'], detail=False)
     def token(self, request):